@@ -20,6 +20,12 @@ import networkx as nx
 
 from scipy.optimize import linear_sum_assignment
 
+### For approximate radius queries in feature explore mode
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
 import os, sys
 sys.path.append("..")
 from partfield.utils import *
@@ -33,6 +39,9 @@ class Options:
 
     """System Options"""
     device: str = "cuda"  #  Device
+    feat_dtype: str = "float32"  # float32 or float16, buffer of the normalized features on device
+    ann: bool = False  # approximate radius queries (faiss IVF index) for feature explore, needs faiss
+    ann_nprobe: int = 16  # inverted lists visited per query, higher is slower and more exact
     debug: bool = False  #  enable debug checks
     extras: bool = False # include extra output for viz/debugging
 
@@ -61,6 +70,7 @@ class Options:
 
     feature_range: float = 0.1
     continuous_explore: bool = False
+    last_query: tuple = None  # (face, range) shown, continuous explore only recomputes on change
 
     viz_mode: str = "faces"
 
@@ -71,15 +81,19 @@ class Options:
 
 modes_list = ['feature_explore', "co-segmentation"]
 
-def load_features(feature_filename, mesh_filename, viz_mode):
+# Below this many faces the exact distances are interactive, no index is built
+ANN_MIN_FACES = 100000
+
+def load_features(feature_filename, mesh_filename, viz_mode, device='cuda', feat_dtype='float32', ann=False, ann_nprobe=16):
     
     print("Reading features:")
     print(f"  Feature filename: {feature_filename}")
     print(f"  Mesh filename: {mesh_filename}")
 
-    # load features
+    # load features, L2-normalized once: cosine distances are then a single matrix-vector product
     feat = np.load(feature_filename, allow_pickle=True)
     feat = feat.astype(np.float32)
+    feat = np.ascontiguousarray(feat / np.linalg.norm(feat, axis=1, keepdims=True))
 
     # load mesh things
     tm =  load_mesh_util(mesh_filename)
@@ -102,7 +116,8 @@ def load_features(feature_filename, mesh_filename, viz_mode):
         'F' : F, 
         'pca_colors' : pca_colors, 
         'feat_np' : feat,
-        'feat_pt' : torch.tensor(feat, device='cuda'),
+        'feat_pt' : torch.from_numpy(feat).to(device=device, dtype=getattr(torch, feat_dtype)).contiguous(),
+        'index' : build_feature_index(feat, ann_nprobe) if ann else None,
         'trimesh' : tm,
         'label' : None,
         'num_cluster' : 1,
@@ -120,17 +135,45 @@ def viz_pca_colors(m):
 def viz_feature(m, ind):
     m['ps_mesh'].add_scalar_quantity('pca colors', m['feat_np'][:,ind], cmap='turbo', enabled=True, defined_on=m["viz_mode"])
 
+def build_feature_index(feat, nprobe=16):
+    # IVF index over the normalized features, inner product is the cosine similarity
+    if faiss is None:
+        print("faiss is not installed, using exact feature distances")
+        return None
+    if feat.shape[0] < ANN_MIN_FACES:
+        return None
+
+    nlist = int(min(np.sqrt(feat.shape[0]), 1024))
+    quantizer = faiss.IndexFlatIP(feat.shape[1])
+    index = faiss.IndexIVFFlat(quantizer, feat.shape[1], nlist, faiss.METRIC_INNER_PRODUCT)
+    # 40 training points per list are enough for the coarse centroids
+    train_idx = np.random.default_rng(0).choice(feat.shape[0], min(feat.shape[0], 40 * nlist), replace=False)
+    index.train(feat[train_idx])
+    index.add(feat)
+    index.nprobe = nprobe
+    return index
+
+def feature_distance_ann(index, query_feat, radius):
+    # faces within radius (cosine distance) get their distance, the other ones radius, the end of the colormap
+    _, sims, ids = index.range_search(np.ascontiguousarray(query_feat[None, :], dtype=np.float32), 1. - 2. * radius)
+    cos_dist = np.full(index.ntotal, radius, dtype=np.float32)
+    cos_dist[ids] = np.minimum((1. - sims) / 2., radius)
+    return cos_dist
+
+# feats and query_feat are L2-normalized (load_features)
 def feature_distance_np(feats, query_feat):
-    # normalize
-    feats = feats / np.linalg.norm(feats,axis=1)[:,None]
-    query_feat = query_feat / np.linalg.norm(query_feat)
     # cosine distance
     cos_sim = np.dot(feats, query_feat)
     cos_dist = (1 - cos_sim) / 2.
     return cos_dist
 
 def feature_distance_pt(feats, query_feat):
-    return (1. - torch.nn.functional.cosine_similarity(feats, query_feat[None,:], dim=-1)) / 2.
+    return (1. - feats @ query_feat) / 2.
+
+def feature_distances(m, query_np, query_pt, radius):
+    if m['index'] is not None:
+        return feature_distance_ann(m['index'], query_np, radius)
+    return feature_distance_pt(m['feat_pt'], query_pt).float().cpu().numpy()
 
 
 def ps_callback(opts):
@@ -139,6 +182,7 @@ def ps_callback(opts):
     changed, ind = psim.Combo("Mode", modes_list.index(opts.mode), modes_list)
     if changed:
         opts.mode = modes_list[ind]
+        opts.last_query = None
         m['ps_mesh'].remove_all_quantities()
         if opts.m_alt is not None:
             opts.m_alt['ps_mesh'].remove_all_quantities()
@@ -163,24 +207,35 @@ def ps_callback(opts):
                 f_hit = pick_result.structure_data['index']
                 bary_weights = np.array(pick_result.structure_data['bary_coords'])
 
-                # get the feature via interpolation
-                point_feat = m['feat_np'][f_hit,:]
-                point_feat_pt = torch.tensor(point_feat, device='cuda')
+                # the same face under the mouse gives the same distances
+                if opts.last_query != (f_hit, opts.feature_range):
+                    opts.last_query = (f_hit, opts.feature_range)
+
+                    # get the feature via interpolation
+                    point_feat = m['feat_np'][f_hit,:]
+                    point_feat_pt = m['feat_pt'][f_hit,:]
 
-                all_dists1 = feature_distance_pt(m['feat_pt'], point_feat_pt).detach().cpu().numpy()
-                m['ps_mesh'].add_scalar_quantity("distance", all_dists1, cmap='blues', vminmax=(0, opts.feature_range), enabled=True, defined_on=m["viz_mode"])
-                opts.m['scalar'] = all_dists1
+                    all_dists1 = feature_distances(m, point_feat, point_feat_pt, opts.feature_range)
+                    m['ps_mesh'].add_scalar_quantity("distance", all_dists1, cmap='blues', vminmax=(0, opts.feature_range), enabled=True, defined_on=m["viz_mode"])
+                    opts.m['scalar'] = all_dists1
 
-                if opts.m_alt is not None:
-                    all_dists2 = feature_distance_pt(opts.m_alt['feat_pt'], point_feat_pt).detach().cpu().numpy()
-                    opts.m_alt['ps_mesh'].add_scalar_quantity("distance", all_dists2, cmap='blues', vminmax=(0, opts.feature_range), enabled=True, defined_on=m["viz_mode"])
-                    opts.m_alt['scalar'] = all_dists2
+                    if opts.m_alt is not None:
+                        all_dists2 = feature_distances(opts.m_alt, point_feat, point_feat_pt, opts.feature_range)
+                        opts.m_alt['ps_mesh'].add_scalar_quantity("distance", all_dists2, cmap='blues', vminmax=(0, opts.feature_range), enabled=True, defined_on=m["viz_mode"])
+                        opts.m_alt['scalar'] = all_dists2
 
             else:
                 # not hit
                 pass
 
         if psim.Button("Export"):
+            ### Exact distances: with an ANN index the shown ones are clipped at the range
+            if opts.last_query is not None:
+                f_hit = opts.last_query[0]
+                for mesh in (opts.m, opts.m_alt):
+                    if mesh is not None and mesh['index'] is not None:
+                        mesh['scalar'] = feature_distance_pt(mesh['feat_pt'], opts.m['feat_pt'][f_hit,:]).float().cpu().numpy()
+
             ### Save output
             OUTPUT_FOL = opts.output_fol
             fname1 = opts.filename
@@ -234,7 +289,6 @@ def ps_callback(opts):
             ### Mesh 1
             num_clusters1 = opts.i_cluster
             point_feat1 = m['feat_np']
-            point_feat1 = point_feat1 / np.linalg.norm(point_feat1, axis=-1, keepdims=True)
             clustering1 = KMeans(n_clusters=num_clusters1, random_state=0, n_init="auto").fit(point_feat1)
 
             ### Get feature means per cluster
@@ -259,7 +313,6 @@ def ps_callback(opts):
 
             ### Mesh 2
             point_feat2 = opts.m_alt['feat_np']
-            point_feat2 = point_feat2 / np.linalg.norm(point_feat2, axis=-1, keepdims=True)
 
             clustering2 = KMeans(n_clusters=num_clusters2, random_state=0, init=init_mode).fit(point_feat2)
 
@@ -364,12 +417,12 @@ def main():
     # Initialize
     ps.init()
 
-    mesh_dict = load_features(feature_fname1, mesh_fname1, opts.viz_mode)
+    mesh_dict = load_features(feature_fname1, mesh_fname1, opts.viz_mode, opts.device, opts.feat_dtype, opts.ann, opts.ann_nprobe)
     prep_feature_mesh(mesh_dict)
     mesh_dict["viz_mode"] = opts.viz_mode
     opts.m = mesh_dict
 
-    mesh_dict_alt = load_features(feature_fname2, mesh_fname2, opts.viz_mode)
+    mesh_dict_alt = load_features(feature_fname2, mesh_fname2, opts.viz_mode, opts.device, opts.feat_dtype, opts.ann, opts.ann_nprobe)
     prep_feature_mesh(mesh_dict_alt, name='mesh_alt')
     mesh_dict_alt['ps_mesh'].translate((2.5, 0., 0.))
     mesh_dict_alt["viz_mode"] = opts.viz_mode
@@ -0,0 +1,60 @@
+"""
+Layer-level CPU benchmark of the TriplaneTransformer attention implementations
+(triplane_attention.impl: 'mha', 'sdpa', 'chunked') on one BasicBlock with the
+model's shape: 3 x 32 x 32 tokens, dim 1024, 8 heads.
+
+All implementations share the block's weights; the max abs difference to 'mha' is reported
+together with the size of the attention score buffer that the unfused path materializes.
+
+    python benchmarks/bench_triplane_attention.py --chunk_size 512 1024
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from partfield.model.triplane import BasicBlock
+
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', default=3 * 32 * 32, type=int)
+    parser.add_argument('--dim', default=1024, type=int)
+    parser.add_argument('--heads', default=8, type=int)
+    parser.add_argument('--chunk_size', default=[1024], type=int, nargs='+', help="query chunk sizes to sweep for 'chunked'")
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--threads', default=0, type=int, help="torch CPU threads, 0 keeps the default")
+    FLAGS = parser.parse_args()
+
+    if FLAGS.threads > 0:
+        torch.set_num_threads(FLAGS.threads)
+    torch.manual_seed(0)
+    block = BasicBlock(FLAGS.dim, FLAGS.heads, eps=1e-6).eval()
+    x = torch.randn(1, FLAGS.tokens, FLAGS.dim)
+
+    runs = [('mha', None), ('sdpa', None)] + [('chunked', c) for c in FLAGS.chunk_size]
+    ref = None
+    with torch.no_grad():
+        for impl, chunk_size in runs:
+            block.attn_impl = impl
+            if chunk_size is not None:
+                block.attn_chunk_size = chunk_size
+            t, out = timeit(lambda: block(x), FLAGS.repeat)
+            if ref is None:
+                ref = out
+            scores = FLAGS.heads * min(chunk_size or FLAGS.tokens, FLAGS.tokens) * FLAGS.tokens * 4 / 2 ** 20
+            name = impl if chunk_size is None else f"{impl}({chunk_size})"
+            print(f"{name:>14s}: {t * 1000:8.1f} ms   max abs diff {(out - ref).abs().max().item():.2e}   "
+                  f"unfused score buffer {scores:7.1f} MB")
@@ -0,0 +1,119 @@
+"""
+Accuracy gate for quantize dynamic_int8: compares the part features and the clustering of a
+quantized run against an fp32 run of the same sample set.
+
+1. Extract features twice, e.g.
+    python partfield_inference.py -c configs/final/demo.yaml --opts continue_ckpt model/model_objaverse.ckpt result_name partfield_features/gate_fp32 dataset.data_path data/gate_samples
+    python partfield_inference.py -c configs/final/demo.yaml --opts continue_ckpt model/model_objaverse.ckpt result_name partfield_features/gate_int8 dataset.data_path data/gate_samples quantize dynamic_int8
+2. Cluster both with run_part_clustering.py (same options, --dump_dir exp_results/clustering/gate_fp32 and gate_int8).
+3. Compare:
+    python benchmarks/quantization_regression.py --ref_feat exp_results/partfield_features/gate_fp32 --test_feat exp_results/partfield_features/gate_int8 \
+        --ref_clustering exp_results/clustering/gate_fp32 --test_clustering exp_results/clustering/gate_int8 --gt_dir PartObjaverse-Tiny_instance_gt
+
+Per shape, the cosine similarity of every face feature is reported (mean, 1st percentile, min).
+With --gt_dir (per-face labels [UID].npy, as used by compute_metric.py), the mIoU of both
+clusterings is computed with compute_metric.eval_single_gt_shape. The script exits with
+status 1 when the mean cosine similarity or the mIoU drop misses its threshold.
+"""
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from compute_metric import eval_single_gt_shape
+
+
+def load_features(feat_dir, uid, view_id=0):
+    for fname in [f"part_feat_{uid}_{view_id}_batch.npy", f"part_feat_{uid}_{view_id}.npy"]:
+        if os.path.exists(os.path.join(feat_dir, fname)):
+            return np.load(os.path.join(feat_dir, fname), mmap_mode='r')
+    return None
+
+
+def list_uids(feat_dir, view_id=0):
+    uids = []
+    for fname in sorted(glob.glob(os.path.join(feat_dir, f"part_feat_*_{view_id}*.npy"))):
+        name = os.path.basename(fname)[len("part_feat_"):]
+        uids.append(name[:name.rindex(f"_{view_id}")])
+    return sorted(set(uids))
+
+
+def cosine_per_row(a, b, block_size=200000):
+    out = np.empty(a.shape[0], dtype=np.float32)
+    for start in range(0, a.shape[0], block_size):
+        x = np.asarray(a[start:start + block_size], dtype=np.float32)
+        y = np.asarray(b[start:start + block_size], dtype=np.float32)
+        denom = np.linalg.norm(x, axis=1) * np.linalg.norm(y, axis=1)
+        out[start:start + block_size] = (x * y).sum(axis=1) / np.maximum(denom, 1e-12)
+    return out
+
+
+def best_miou(clustering_dir, uid, gt_label, max_num_clusters, view_id=0):
+    # Same protocol as compute_metric.eval_whole_dataset without merge_parts: best over cluster counts
+    best = None
+    for num_cluster in range(2, max_num_clusters):
+        fname = os.path.join(clustering_dir, "cluster_out", f"{uid}_{view_id}_{str(num_cluster).zfill(2)}.npy")
+        if not os.path.exists(fname):
+            continue
+        pred = np.squeeze(np.load(fname))
+        pred_masks = np.array([pred == label for label in np.unique(pred)])
+        miou = eval_single_gt_shape(gt_label, pred_masks)
+        best = miou if best is None else max(best, miou)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ref_feat', required=True, type=str, help="feature folder of the fp32 run")
+    parser.add_argument('--test_feat', required=True, type=str, help="feature folder of the quantized run")
+    parser.add_argument('--ref_clustering', default=None, type=str)
+    parser.add_argument('--test_clustering', default=None, type=str)
+    parser.add_argument('--gt_dir', default=None, type=str, help="per-face ground truth labels [UID].npy")
+    parser.add_argument('--max_num_clusters', default=20, type=int)
+    parser.add_argument('--min_cosine', default=0.99, type=float, help="gate on the mean per-face cosine similarity")
+    parser.add_argument('--max_miou_drop', default=1.0, type=float, help="gate on the mIoU drop, in points")
+    FLAGS = parser.parse_args()
+
+    passed = True
+    all_cos = []
+    for uid in list_uids(FLAGS.ref_feat):
+        ref, test = load_features(FLAGS.ref_feat, uid), load_features(FLAGS.test_feat, uid)
+        if test is None:
+            print(f"{uid}: missing in {FLAGS.test_feat}")
+            passed = False
+            continue
+        assert ref.shape == test.shape, f"{uid}: shape {ref.shape} vs {test.shape}"
+        cos = cosine_per_row(ref, test)
+        all_cos.append(cos)
+        print(f"{uid}: cosine mean {cos.mean():.5f}  p1 {np.percentile(cos, 1):.5f}  min {cos.min():.5f}")
+
+    if len(all_cos) > 0:
+        mean_cos = np.concatenate(all_cos).mean()
+        print(f"all faces: cosine mean {mean_cos:.5f}  (gate {FLAGS.min_cosine})")
+        passed &= bool(mean_cos >= FLAGS.min_cosine)
+
+    if FLAGS.gt_dir is not None and FLAGS.ref_clustering is not None and FLAGS.test_clustering is not None:
+        ref_mious, test_mious = [], []
+        for uid in list_uids(FLAGS.ref_feat):
+            gt_fname = os.path.join(FLAGS.gt_dir, uid + ".npy")
+            if not os.path.exists(gt_fname):
+                continue
+            gt_label = np.load(gt_fname)
+            ref_miou = best_miou(FLAGS.ref_clustering, uid, gt_label, FLAGS.max_num_clusters)
+            test_miou = best_miou(FLAGS.test_clustering, uid, gt_label, FLAGS.max_num_clusters)
+            if ref_miou is None or test_miou is None:
+                continue
+            ref_mious.append(ref_miou)
+            test_mious.append(test_miou)
+            print(f"{uid}: mIoU fp32 {ref_miou:.2f}  int8 {test_miou:.2f}")
+        if len(ref_mious) > 0:
+            drop = np.mean(ref_mious) - np.mean(test_mious)
+            print(f"mIoU over {len(ref_mious)} shapes: fp32 {np.mean(ref_mious):.2f}  int8 {np.mean(test_mious):.2f}  "
+                  f"drop {drop:.2f}  (gate {FLAGS.max_miou_drop})")
+            passed &= bool(drop <= FLAGS.max_miou_drop)
+
+    print("PASSED" if passed else "FAILED")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,38 @@
+from partfield.config import default_argument_parser, setup
+from partfield.export import TriplaneEncoder, ExportedEncoder, export_encoder, prepare_points
+import torch
+import numpy as np
+import time
+
+def main():
+    parser = default_argument_parser()
+    parser.add_argument("--output", type=str, default="model/partfield_encoder.onnx", help=".onnx or .pt (TorchScript)")
+    parser.add_argument("--n_points", type=int, default=None, help="static number of input points, cfg.pc_num_pts by default")
+    parser.add_argument("--check", action="store_true", help="run the artifact on the CPU and compare it with the eager model")
+    args = parser.parse_args()
+    cfg = setup(args, freeze=False)
+    n_points = args.n_points if args.n_points is not None else cfg.pc_num_pts
+    fmt = 'onnx' if args.output.endswith('.onnx') else 'torchscript'
+
+    from partfield.model_trainer_pvcnn_only_demo import Model
+    model = Model(cfg)
+    state_dict = torch.load(cfg.continue_ckpt, map_location='cpu', weights_only=False)['state_dict']
+    model.load_state_dict(model.inference_state_dict(state_dict))
+    encoder = TriplaneEncoder(model.pvcnn, model.triplane_transformer).cpu().eval()
+
+    start = time.perf_counter()
+    export_encoder(encoder, args.output, n_points, fmt=fmt, seed=cfg.seed)
+    print(f"Exported {fmt} encoder with {n_points} input points to {args.output} in {time.perf_counter() - start:.1f}s")
+
+    if args.check:
+        points = prepare_points(np.random.default_rng(cfg.seed).random((n_points, 3)), n_points=n_points, seed=cfg.seed)
+        with torch.no_grad():
+            ref = encoder(torch.from_numpy(points)[None])[0].numpy()
+        runner = ExportedEncoder(args.output)
+        start = time.perf_counter()
+        out = runner(points)
+        print(f"load {runner.load_time:.2f}s, inference {time.perf_counter() - start:.2f}s, "
+              f"output {out.shape}, max abs diff to eager {np.abs(out - ref).max():.2e}")
+
+if __name__ == '__main__':
+    main()
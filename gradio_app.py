@@ -5,26 +5,69 @@ A web-based frontend for running PartField 3D part segmentation on RunPod.
 """
 
 import argparse
+import asyncio
+import json
+import multiprocessing
 import os
+import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import uuid
-from datetime import datetime, timedelta
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from datetime import datetime
 from pathlib import Path
 from typing import Optional, Tuple, List
 
 import gradio as gr
+import numpy as np
+import psutil
+
+import run_part_clustering as clustering
+from partfield import metrics
+from partfield.planner import plan_sampling
+from partfield.utils import mesh_size
+from partfield.jobs import FINISHED_STATES, Job, JobScheduler, JobStore
 
 # ==================== Configuration ====================
 
 DEFAULT_JOBS_DIR = "/workspace/jobs"
 DEFAULT_PORT = 7860
+# Prometheus metrics, served on localhost only
+DEFAULT_METRICS_PORT = 9464
 MODEL_CHECKPOINT = "model/model_objaverse.ckpt"
 CONFIG_FILE = "configs/final/demo.yaml"
 SUPPORTED_EXTENSIONS = {".obj", ".glb", ".off", ".ply"}
+# Inputs picked up by the inference dataset (partfield/dataloader.py) in a batch folder
+MESH_EXTENSIONS = {".obj", ".glb", ".off"}
+PC_EXTENSIONS = {".ply"}
+MAX_FILE_SIZE_MB = 100
+MAX_BATCH_FILES = 500
+# Filenames skipped by the inference engine
+RESERVED_NAMES = {"car", "complex_car"}
 JOB_EXPIRY_HOURS = 24
+MAX_STORAGE_GB = 10
+EVICTION_INTERVAL_SECONDS = 60
+POLL_INTERVAL_SECONDS = 1.0
+# Line printed by partfield_inference.py once the PCA visualization is written
+PCA_SAVED_PREFIX = "Saved PLY file: "
+# Colored meshes of the result levels kept on disk, for all sessions together
+MESH_CACHE_SIZE = 16
+# Memory budgets of the sampling planner when not given: shares of the detected memory, and the
+# VRAM of the RunPod L4 when no GPU can be queried
+DEVICE_BUDGET_FRACTION = 0.9
+HOST_BUDGET_FRACTION = 0.8
+FALLBACK_DEVICE_MEMORY_GB = 24
+# Preview quality tier: fewer encoder points, vertex features, KMeans fit on a subsample of the
+# features and a few levels, refined on demand by a full-quality job
+PREVIEW_PC_NUM_PTS = 20000
+PREVIEW_FIT_SAMPLES = 20000
+PREVIEW_LEVELS = 4
 
 
 # ==================== Utility Functions ====================
@@ -39,27 +82,6 @@ def get_partfield_dir() -> Path:
     return Path("/workspace/partfield")
 
 
-def cleanup_old_jobs(jobs_dir: Path, expiry_hours: int = JOB_EXPIRY_HOURS) -> int:
-    """Remove job directories older than expiry_hours. Returns count of removed jobs."""
-    if not jobs_dir.exists():
-        return 0
-
-    cutoff = datetime.now() - timedelta(hours=expiry_hours)
-    removed = 0
-
-    for job_dir in jobs_dir.iterdir():
-        if job_dir.is_dir():
-            try:
-                mtime = datetime.fromtimestamp(job_dir.stat().st_mtime)
-                if mtime < cutoff:
-                    shutil.rmtree(job_dir)
-                    removed += 1
-            except Exception:
-                pass
-
-    return removed
-
-
 def clear_gpu_memory():
     """Clear GPU memory cache."""
     try:
@@ -71,6 +93,27 @@ def clear_gpu_memory():
         pass
 
 
+def detect_memory_budgets(device_gb: float, host_gb: float) -> Tuple[int, int]:
+    """
+    Device and host memory budgets in bytes for the sampling planner. Values <= 0 are replaced
+    by a share of the memory detected. nvidia-smi is queried rather than torch, so that the server
+    does not hold a CUDA context of its own.
+    """
+    if device_gb <= 0:
+        try:
+            output = subprocess.run(
+                ["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
+                capture_output=True, text=True, timeout=10, check=True
+            ).stdout
+            device_gb = DEVICE_BUDGET_FRACTION * int(output.split()[0]) / 1024
+        except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+            print(f"Could not query the GPU memory, planning for {FALLBACK_DEVICE_MEMORY_GB} GB")
+            device_gb = DEVICE_BUDGET_FRACTION * FALLBACK_DEVICE_MEMORY_GB
+    if host_gb <= 0:
+        host_gb = HOST_BUDGET_FRACTION * psutil.virtual_memory().total / 1024 ** 3
+    return int(device_gb * 1024 ** 3), int(host_gb * 1024 ** 3)
+
+
 def validate_file(file_path: str) -> Tuple[bool, str]:
     """Validate uploaded file. Returns (is_valid, message)."""
     if not file_path:
@@ -84,49 +127,24 @@ def validate_file(file_path: str) -> Tuple[bool, str]:
     if ext not in SUPPORTED_EXTENSIONS:
         return False, f"Unsupported format: {ext}. Supported: {', '.join(SUPPORTED_EXTENSIONS)}"
 
-    # Check file size (max 100MB)
+    # Check file size
     size_mb = path.stat().st_size / (1024 * 1024)
-    if size_mb > 100:
-        return False, f"File too large: {size_mb:.1f}MB (max 100MB)"
+    if size_mb > MAX_FILE_SIZE_MB:
+        return False, f"File too large: {size_mb:.1f}MB (max {MAX_FILE_SIZE_MB}MB)"
 
     # Check for filenames silently skipped by the inference engine
     stem = path.stem.lower()
-    if stem in ("car", "complex_car"):
+    if stem in RESERVED_NAMES:
         return False, f"The filename '{path.name}' is reserved and will be skipped by the model. Please rename your file."
 
     return True, "File valid"
 
 
-def run_command(cmd: List[str], cwd: Path, log_callback=None) -> Tuple[bool, str]:
-    """Run a command and capture output. Returns (success, output)."""
-    try:
-        process = subprocess.Popen(
-            cmd,
-            cwd=str(cwd),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1
-        )
-
-        output_lines = []
-        for line in iter(process.stdout.readline, ''):
-            output_lines.append(line)
-            if log_callback:
-                log_callback(''.join(output_lines))
-
-        process.wait()
-        output = ''.join(output_lines)
-
-        return process.returncode == 0, output
-
-    except Exception as e:
-        return False, f"Command failed: {str(e)}"
-
-
 # ==================== Processing Pipeline ====================
 
-def process_3d_file(
+def submit_job(
+    scheduler: JobScheduler,
+    store: JobStore,
     file_path: str,
     is_point_cloud: bool,
     max_clusters: int,
@@ -136,12 +154,15 @@ def process_3d_file(
     add_knn_edges: bool,
     points_per_face: int,
     jobs_dir: str,
-    progress=gr.Progress()
-) -> Tuple[str, List[str], Optional[str], str]:
+    quality: str = "full"
+) -> Tuple[Optional[str], str]:
     """
-    Main processing function.
+    Validate the upload, create the job directory and queue the job. Returns immediately,
+    the stages run on the scheduler pools.
 
     Args:
+        scheduler: Job scheduler running the stages
+        store: Job store accounting the disk usage of the job
         file_path: Path to uploaded file
         is_point_cloud: True for point cloud, False for mesh
         max_clusters: Maximum number of clusters (2-30)
@@ -151,62 +172,307 @@ def process_3d_file(
         add_knn_edges: Whether to add KNN edges
         points_per_face: Points sampled per face (memory control)
         jobs_dir: Directory for job storage
-        progress: Gradio progress tracker
+        quality: "full", or "preview" for a fast approximate run (see PREVIEW_LEVELS)
 
     Returns:
-        (status_message, list_of_ply_paths, pca_visualization_path, log_output)
+        (job_id or None if the job was rejected, status_message)
     """
-    log_output = []
-
-    def log(msg: str):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_output.append(f"[{timestamp}] {msg}")
-        return '\n'.join(log_output)
-
     # Validate file
     is_valid, msg = validate_file(file_path)
     if not is_valid:
-        return f"Error: {msg}", [], None, log(f"Validation failed: {msg}")
-
-    log("File validated successfully")
+        return None, f"Error: {msg}"
 
     # Setup job directory
+    job_id, job_dir, input_dir, output_dir = create_job_dir(jobs_dir)
+
+    # Copy input file
+    input_path = Path(file_path)
+    shutil.copy2(file_path, input_dir / input_path.name)
+
+    params = {
+        "input_name": input_path.name,
+        "input_dir": input_dir,
+        "output_dir": output_dir,
+        "is_point_cloud": is_point_cloud,
+        "max_clusters": max_clusters,
+        "use_agglomerative": use_agglomerative,
+        "preprocess_mesh": preprocess_mesh,
+        "adjacency_option": adjacency_option,
+        "add_knn_edges": add_knn_edges,
+        "points_per_face": points_per_face,
+        "quality": quality,
+        # Stage timings and memory peaks of every process of the job
+        "trace_file": job_dir / "trace.jsonl",
+    }
+
+    return queue_job(scheduler, store, job_id, params)
+
+
+def submit_refine(scheduler: JobScheduler, store: JobStore, preview_id: str, jobs_dir: str) -> Tuple[Optional[str], str]:
+    """
+    Queue the full-quality job of a finished preview with the same parameters. The mesh the
+    preview was segmented on, already loaded, cleaned and normalized, is its input, so that
+    preprocessing is not repeated; its UV coordinates are carried over.
+
+    Returns:
+        (job_id or None if the job was rejected, status_message)
+    """
+    preview = scheduler.get(preview_id) if preview_id else None
+    if preview is None or preview.params.get("quality") != "preview":
+        return None, "Error: Run a preview first"
+    if preview.status != "done":
+        return None, "Error: The preview has not finished"
+    geometry = preview.result.get("geometry")
+    if geometry is None or not Path(geometry["path"]).exists():
+        return None, "Error: The preview results have expired, process the file again"
+
+    job_id, job_dir, input_dir, output_dir = create_job_dir(jobs_dir)
+    params = dict(preview.params)
+    params.update({
+        "input_dir": input_dir,
+        "output_dir": output_dir,
+        "quality": "full",
+        "trace_file": job_dir / "trace.jsonl",
+        "preview_id": preview.id,
+        "preview_seconds": preview.snapshot()["elapsed"],
+    })
+    if geometry["is_pc"]:
+        shutil.copy2(geometry["path"], input_dir / params["input_name"])
+    else:
+        # OFF keeps the vertex order the UV coordinates refer to; the mesh is not cleaned again
+        params["input_name"] = Path(params["input_name"]).stem + ".off"
+        clustering.load_mesh_util(geometry["path"]).export(input_dir / params["input_name"])
+        params["preprocess_mesh"] = False
+        params["uv_file"] = geometry["uv_file"]
+
+    job_id, status = queue_job(scheduler, store, job_id, params)
+    if job_id is not None:
+        status = f"Refining preview {preview.id}: {status}"
+    return job_id, status
+
+
+def preview_levels(max_clusters: int) -> List[int]:
+    """Numbers of clusters of a preview: PREVIEW_LEVELS of them spread from 2 to max_clusters - 1."""
+    return sorted(set(np.linspace(2, max(2, max_clusters - 1), PREVIEW_LEVELS).round().astype(int).tolist()))
+
+
+def preview_note(params: dict) -> str:
+    """Settings of a preview job that it does not apply, for the status line ("" for full jobs)."""
+    if params.get("quality") != "preview" or params["is_point_cloud"]:
+        return ""
+    ignored = ["points per face"]
+    if params["use_agglomerative"]:
+        ignored.insert(0, "agglomerative clustering")
+    return f"Preview, {' and '.join(ignored)} ignored"
+
+
+def create_job_dir(jobs_dir: str) -> Tuple[str, Path, Path, Path]:
+    """Create the folder of a new job. Returns (job_id, job_dir, input_dir, output_dir)."""
     job_id = str(uuid.uuid4())[:8]
-    jobs_path = Path(jobs_dir)
-    job_dir = jobs_path / job_id
+    job_dir = Path(jobs_dir) / job_id
     input_dir = job_dir / "input"
     output_dir = job_dir / "output"
 
     input_dir.mkdir(parents=True, exist_ok=True)
     output_dir.mkdir(parents=True, exist_ok=True)
+    return job_id, job_dir, input_dir, output_dir
 
-    log(f"Created job directory: {job_id}")
 
-    # Copy input file
-    input_path = Path(file_path)
-    dest_path = input_dir / input_path.name
-    shutil.copy2(file_path, dest_path)
-    log(f"Copied input file: {input_path.name}")
+def queue_job(scheduler: JobScheduler, store: JobStore, job_id: str, params: dict) -> Tuple[Optional[str], str]:
+    """Account the job folder and queue the job, the folder is removed if the scheduler is full."""
+    store.add(job_id)
+    try:
+        scheduler.submit(params, job_id=job_id)
+    except RuntimeError as e:
+        store.remove(job_id)
+        return None, f"Error: {e}"
 
-    # Cleanup old jobs
-    progress(0.05, desc="Cleaning up old jobs...")
-    removed = cleanup_old_jobs(jobs_path)
-    if removed > 0:
-        log(f"Cleaned up {removed} old job(s)")
+    return job_id, f"Job {job_id} submitted"
+
+
+def batch_file_name(name: str, taken: set) -> str:
+    """
+    Flat, unique file name for a batch input, whose stem is used as the shape uid by the
+    inference and clustering scripts (no dots or path separators, never a reserved name).
+    """
+    path = Path(name)
+    stem = re.sub(r"[^A-Za-z0-9_-]", "_", path.stem) or "shape"
+    candidate, i = stem, 1
+    while candidate.lower() in taken or candidate.lower() in RESERVED_NAMES:
+        candidate = f"{stem}_{i}"
+        i += 1
+    taken.add(candidate.lower())
+    return candidate + path.suffix.lower()
+
+
+def collect_batch_inputs(file_paths: List[str], input_dir: Path, is_point_cloud: bool) -> Tuple[dict, List[str]]:
+    """
+    Copy the uploaded files, and the members of the uploaded zip archives, flat into input_dir.
+
+    Args:
+        file_paths: Uploaded 3D files and zip archives
+        input_dir: Input folder of the batch job
+        is_point_cloud: Selects the accepted formats, point clouds or meshes
+
+    Returns:
+        (uid -> original name of every accepted shape, messages about the skipped files)
+    """
+    extensions = PC_EXTENSIONS if is_point_cloud else MESH_EXTENSIONS
+    sources = {}
+    skipped = []
+    taken = set()
+
+    for file_path in file_paths:
+        path = Path(file_path)
+        if path.suffix.lower() != ".zip":
+            is_valid, msg = validate_file(file_path)
+            if is_valid and path.suffix.lower() not in extensions:
+                is_valid, msg = False, f"Unsupported format for this input type: {path.suffix}"
+            if not is_valid:
+                skipped.append(f"{path.name}: {msg}")
+            elif len(sources) >= MAX_BATCH_FILES:
+                skipped.append(f"{path.name}: more than {MAX_BATCH_FILES} files")
+            else:
+                name = batch_file_name(path.name, taken)
+                shutil.copy2(file_path, input_dir / name)
+                sources[Path(name).stem] = path.name
+            continue
+
+        try:
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    member = Path(info.filename)
+                    if info.is_dir() or "__MACOSX" in member.parts or member.name.startswith("."):
+                        continue
+                    if member.suffix.lower() not in extensions:
+                        skipped.append(f"{info.filename}: unsupported format")
+                    elif info.file_size > MAX_FILE_SIZE_MB * 1024 * 1024:
+                        skipped.append(f"{info.filename}: larger than {MAX_FILE_SIZE_MB}MB")
+                    elif len(sources) >= MAX_BATCH_FILES:
+                        skipped.append(f"{info.filename}: more than {MAX_BATCH_FILES} files")
+                    else:
+                        # Members are written under a sanitized flat name, never their archive path
+                        name = batch_file_name(member.name, taken)
+                        with archive.open(info) as src, open(input_dir / name, "wb") as dst:
+                            shutil.copyfileobj(src, dst)
+                        sources[Path(name).stem] = f"{path.name}/{info.filename}"
+        except zipfile.BadZipFile:
+            skipped.append(f"{path.name}: not a valid zip archive")
+
+    return sources, skipped
+
+
+def submit_batch(
+    scheduler: JobScheduler,
+    store: JobStore,
+    file_paths: List[str],
+    is_point_cloud: bool,
+    max_clusters: int,
+    use_agglomerative: bool,
+    preprocess_mesh: bool,
+    adjacency_option: int,
+    add_knn_edges: bool,
+    points_per_face: int,
+    jobs_dir: str
+) -> Tuple[Optional[str], str]:
+    """
+    Queue one job for a whole batch of shapes: a single inference run over the job input
+    folder, then the shapes are clustered in parallel on the clustering pool.
+
+    Args:
+        file_paths: Uploaded 3D files and zip archives of 3D files
+        (other arguments as in submit_job)
+
+    Returns:
+        (job_id or None if the job was rejected, status_message)
+    """
+    if not file_paths:
+        return None, "Error: No file uploaded"
+
+    job_id, job_dir, input_dir, output_dir = create_job_dir(jobs_dir)
+    sources, skipped = collect_batch_inputs(file_paths, input_dir, is_point_cloud)
+    if not sources:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return None, "Error: No supported file in the upload" + (f" ({'; '.join(skipped[:5])})" if skipped else "")
+
+    params = {
+        "batch": True,
+        "input_name": f"{len(sources)} files",
+        "input_dir": input_dir,
+        "output_dir": output_dir,
+        "sources": sources,
+        "skipped": skipped,
+        "is_point_cloud": is_point_cloud,
+        "max_clusters": max_clusters,
+        "use_agglomerative": use_agglomerative,
+        "preprocess_mesh": preprocess_mesh,
+        "adjacency_option": adjacency_option,
+        "add_knn_edges": add_knn_edges,
+        "points_per_face": points_per_face,
+        "trace_file": job_dir / "trace.jsonl",
+    }
+
+    job_id, status = queue_job(scheduler, store, job_id, params)
+    if job_id is not None and skipped:
+        status += f", {len(skipped)} file(s) skipped"
+    return job_id, status
+
+
+def plan_job(job: Job, device_budget: int, host_budget: int) -> Optional[dict]:
+    """
+    Sampling plan of a mesh job from the size of its input, the largest input of a batch, see
+    partfield.planner.plan_sampling. Sizes are read from the file headers where the format
+    allows it (partfield.utils.mesh_size), the meshes are not loaded. None for point clouds,
+    which have no sampling parameters.
+    """
+    params = job.params
+    if params["is_point_cloud"]:
+        return None
+
+    num_faces, num_vertices = 0, 0
+    for path in sorted(params["input_dir"].iterdir()):
+        try:
+            faces, vertices = mesh_size(str(path))
+        except Exception as e:
+            # The inference run reports it, the other shapes of a batch are still planned
+            job.log(f"Could not read {path.name} for planning: {e}")
+            continue
+        if faces > num_faces:
+            num_faces, num_vertices = faces, vertices
+
+    plan = plan_sampling(num_faces, num_vertices, params["points_per_face"], device_budget, host_budget,
+                         vertex_feature=params.get("quality") == "preview")
+    plan.update(num_faces=num_faces, num_vertices=num_vertices,
+                device_budget_mb=device_budget // 2 ** 20, host_budget_mb=host_budget // 2 ** 20)
+    return plan
+
+
+def extract_features(job: Job, device_budget: int, host_budget: int):
+    """
+    Feature extraction stage: plans the sampling parameters for the memory budgets (bytes),
+    then runs partfield_inference.py on the job input.
+    """
+    params = job.params
+    job.log(f"Input file: {params['input_name']}")
+
+    plan = plan_job(job, device_budget, host_budget)
+    if plan is not None:
+        job.update_result(plan=plan)
+        feature_kind = "vertex features" if plan["vertex_feature"] else f"{plan['n_point_per_face']} points per face"
+        job.log(f"Memory plan for {plan['num_faces']} faces: {feature_kind}, blocks of {plan['n_sample_each']} points, "
+                f"estimated peak {plan['estimated_device_mb']} MB device / {plan['estimated_host_mb']} MB host "
+                f"(budgets {plan['device_budget_mb']} / {plan['host_budget_mb']} MB)"
+                + "".join(f"; {note}" for note in plan["notes"]))
+        if not plan["fits"]:
+            raise RuntimeError(f"Mesh too large for the memory budget ({plan['num_faces']} faces): {plan['notes'][-1]}")
 
     # Clear GPU memory
-    progress(0.1, desc="Preparing GPU...")
     clear_gpu_memory()
-    log("GPU memory cleared")
 
     partfield_dir = get_partfield_dir()
-
-    # ==================== Step 1: Feature Extraction ====================
-    progress(0.15, desc="Extracting features...")
-    log("Starting feature extraction...")
-
-    result_name = f"job_{job_id}"
-    actual_features_dir = partfield_dir / "exp_results" / result_name
+    result_name = f"job_{job.id}"
+    features_dir = partfield_dir / "exp_results" / result_name
+    job.update_result(features_dir=features_dir)
 
     inference_cmd = [
         sys.executable, "partfield_inference.py",
@@ -214,138 +480,392 @@ def process_3d_file(
         "--opts",
         "continue_ckpt", MODEL_CHECKPOINT,
         "result_name", result_name,
-        "dataset.data_path", str(input_dir),
-        "is_pc", str(is_point_cloud),
-        "n_point_per_face", str(points_per_face),
+        "dataset.data_path", str(params["input_dir"]),
+        "is_pc", str(params["is_point_cloud"]),
+        "n_point_per_face", str(params["points_per_face"]),
         "dataset.val_num_workers", "2",
         "dataset.val_batch_size", "1",
     ]
 
-    if preprocess_mesh and not is_point_cloud:
+    if params.get("quality") == "preview":
+        inference_cmd.extend(["pc_num_pts", str(PREVIEW_PC_NUM_PTS)])
+
+    if plan is not None:
+        # Later --opts override the requested value
+        inference_cmd.extend([
+            "n_point_per_face", str(plan["n_point_per_face"]),
+            "n_sample_each", str(plan["n_sample_each"]),
+            "vertex_feature", str(plan["vertex_feature"]),
+        ])
+
+    if params["preprocess_mesh"] and not params["is_point_cloud"]:
         inference_cmd.extend(["preprocess_mesh", "True"])
 
-    log(f"Running: {' '.join(inference_cmd[:5])}...")
+    job.log(f"Running: {' '.join(inference_cmd[:5])}...")
 
-    def update_log(output):
-        # Only keep last 50 lines to prevent overflow
-        lines = output.split('\n')[-50:]
-        return '\n'.join(log_output) + '\n--- Inference Output ---\n' + '\n'.join(lines)
+    def on_line(line: str):
+        # Show the PCA view as soon as it is written, before the inference process exits
+        if line.startswith(PCA_SAVED_PREFIX):
+            job.update_result(pca_file=str(partfield_dir / line[len(PCA_SAVED_PREFIX):].strip()))
 
-    success, inference_output = run_command(inference_cmd, partfield_dir, update_log)
+    # The inference process and its dataloader workers append to the job trace
+    env = {**os.environ, metrics.TRACE_ENV: str(params["trace_file"])}
+    success, inference_output = job.run_command(inference_cmd, partfield_dir, on_line, env=env)
 
-    if not success:
+    if not success and params.get("batch") and any(features_dir.glob("part_feat_*.npy")):
+        # A failing shape ends the run, the shapes extracted before it are still clustered
+        job.log(f"Feature extraction stopped early, continuing with the extracted shapes:\n{inference_output[-1000:]}")
+    elif not success:
         # Check for OOM error
         if "CUDA out of memory" in inference_output or "OutOfMemoryError" in inference_output:
-            return (
-                "Error: GPU out of memory. Try reducing 'Points per face' in advanced options.",
-                [], None,
-                log(f"Feature extraction failed: GPU out of memory\n{inference_output[-500:]}")
-            )
-        return (
-            "Error: Feature extraction failed",
-            [], None,
-            log(f"Feature extraction failed:\n{inference_output[-1000:]}")
-        )
+            job.log(f"Feature extraction failed: GPU out of memory\n{inference_output[-500:]}")
+            raise RuntimeError("GPU out of memory despite the memory plan. Try reducing 'Points per face' in advanced options "
+                               "or start the app with a lower --device-memory-gb.")
+        job.log(f"Feature extraction failed:\n{inference_output[-1000:]}")
+        raise RuntimeError("Feature extraction failed")
 
-    log("Feature extraction completed")
-    progress(0.5, desc="Features extracted")
+    job.log("Feature extraction completed")
 
     # Find PCA visualization file
-    pca_file = None
-    for f in actual_features_dir.glob("feat_pca_*.ply"):
-        pca_file = str(f)
-        break
-
-    # ==================== Step 2: Clustering ====================
-    progress(0.55, desc="Running clustering...")
-    log("Starting clustering...")
-
-    # Build clustering command
-    clustering_cmd = [
-        sys.executable, "run_part_clustering.py",
-        "--root", str(actual_features_dir),
-        "--dump_dir", str(output_dir),
-        "--source_dir", str(input_dir),
-        "--max_num_clusters", str(max_clusters),
-        "--is_pc", str(is_point_cloud),
-        "--export_mesh", "True",
-    ]
+    if "pca_file" not in job.result:
+        for f in features_dir.glob("feat_pca_*.ply"):
+            job.update_result(pca_file=str(f))
+            break
 
-    if not is_point_cloud:
-        clustering_cmd.extend([
-            "--use_agglo", str(use_agglomerative),
-            "--option", str(adjacency_option),
-            "--with_knn", str(add_knn_edges),
-        ])
 
-    log(f"Running clustering with max {max_clusters} clusters...")
+def cluster_features(job: Job, clustering_pool: ProcessPoolExecutor):
+    """
+    Clustering stage: clusters the extracted features with run_part_clustering.solve_clustering_files
+    on the persistent clustering process pool, the tasks only carry the file paths. Only the labels of every level are written, the
+    colored meshes are generated on demand (see MeshCache). Batch jobs go to cluster_batch.
+    """
+    params = job.params
+    if params.get("batch"):
+        return cluster_batch(job, clustering_pool)
+
+    features_dir = job.result["features_dir"]
+    output_dir = params["output_dir"]
+    max_clusters = params["max_clusters"]
+    preview = params.get("quality") == "preview"
+    # Previews always use KMeans, fit on a subsample of the features
+    use_agglo = params["use_agglomerative"] and not params["is_point_cloud"] and not preview
+    levels_to_compute = preview_levels(max_clusters) if preview else list(range(2, max_clusters))
+
+    uids = feature_uids(features_dir)
+    if not uids:
+        raise RuntimeError("No features found")
+    uid = uids[0]
+    feature_files = sorted(features_dir.glob(f"part_feat_{uid}_0*.npy"))
+
+    # Keep the geometry the labels refer to, the feature folder is removed after clustering
+    mesh_file = None
+    if params["is_point_cloud"]:
+        geometry = {"path": str(params["input_dir"] / params["input_name"]), "uv_file": None, "is_pc": True}
+    else:
+        geometry_dir = output_dir / "geometry"
+        geometry_dir.mkdir(parents=True, exist_ok=True)
+        mesh_file = features_dir / f"input_{uid}_0.ply"
+        if not mesh_file.exists():
+            raise RuntimeError("No mesh found in the extracted features")
+        geometry = {"path": shutil.copy2(mesh_file, geometry_dir), "uv_file": None, "is_pc": False}
+        uv_file = features_dir / f"input_uv_{uid}_0.npz"
+        if uv_file.exists():
+            geometry["uv_file"] = shutil.copy2(uv_file, geometry_dir)
+        elif params.get("uv_file") and Path(params["uv_file"]).exists():
+            # Refined preview: the UV coordinates come from the preview
+            geometry["uv_file"] = shutil.copy2(params["uv_file"], geometry_dir)
+        mesh_file = geometry["path"]
+    job.update_result(geometry=geometry)
+
+    splat_index_file = features_dir / f"splat_index_{uid}_0.npy"
+
+    job.log(f"Running clustering with max {max_clusters} clusters...")
+
+    options = {
+        "use_agglo": use_agglo,
+        "max_num_clusters": max_clusters,
+        "option": params["adjacency_option"],
+        "with_knn": params["add_knn_edges"],
+        "splat_index_file": str(splat_index_file) if splat_index_file.exists() else None,
+        "vertex_feature": job.result.get("plan", {}).get("vertex_feature", False),
+        "fit_samples": PREVIEW_FIT_SAMPLES if preview else None,
+    }
+    # Workers append their timings and memory peak to the job trace
+    # KMeans on face features does not use the mesh, the workers only load it when it does
+    if not (use_agglo or options["vertex_feature"]):
+        mesh_file = None
+    solve = partial(metrics.traced_call, job.trace_file, clustering.solve_clustering_files, str(feature_files[0]), mesh_file)
+    if use_agglo:
+        # One fit gives every level
+        tasks = [clustering_pool.submit(solve, **options)]
+    else:
+        # KMeans levels are independent: one task per level, spread over the pool. Tasks are
+        # a few paths, the workers map the same feature file
+        tasks = [clustering_pool.submit(solve, num_clusters=[k], **options) for k in levels_to_compute]
+
+    cluster_dir = output_dir / "cluster_out"
+    cluster_dir.mkdir(parents=True, exist_ok=True)
+    levels = []
+    try:
+        for task in as_completed(tasks):
+            job.check_cancelled()
+            for num_clusters, labels in task.result().items():
+                labels_file = cluster_dir / f"{uid}_0_{num_clusters:02d}.npy"
+                np.save(labels_file, labels)
+                levels.append(str(labels_file))
+            # Publish every level as soon as its labels are saved
+            levels.sort(key=level_cluster_count)
+            job.update_result(levels=list(levels))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    job.log("Clustering completed")
+
+    if not levels:
+        job.log("Processing completed but no segmentation was generated")
+        raise RuntimeError("No output files generated")
 
-    success, clustering_output = run_command(clustering_cmd, partfield_dir, update_log)
+    # Clear GPU memory after processing
+    clear_gpu_memory()
 
-    if not success:
-        return (
-            "Error: Clustering failed",
-            [], pca_file,
-            log(f"Clustering failed:\n{clustering_output[-1000:]}")
-        )
+    # Meshes are exported as OBJ when UV maps are preserved
+    format_note = " (with UV maps)" if geometry["uv_file"] else ""
 
-    log("Clustering completed")
-    progress(0.9, desc="Clustering complete")
+    job.log(f"Generated {len(levels)} segmentation result(s){format_note}")
 
-    # ==================== Step 3: Collect Results ====================
-    progress(0.95, desc="Collecting results...")
+    if preview:
+        message = f"Preview ready: {len(levels)} segmentation(s){format_note}, click Refine for full quality"
+    else:
+        message = f"Success! Generated {len(levels)} segmentation(s) with 2 to {max_clusters} parts{format_note}"
+    job.update_result(levels=levels, message=message)
 
-    # Find all output mesh files (PLY and OBJ)
-    ply_dir = output_dir / "ply"
-    mesh_files = []
 
-    if ply_dir.exists():
-        # Sort by number of clusters (extracted from filename)
-        # Look for both .ply and .obj files (OBJ is used when UV maps are preserved)
-        mesh_list = list(ply_dir.glob("*.ply")) + list(ply_dir.glob("*.obj"))
+def cluster_batch(job: Job, clustering_pool: ProcessPoolExecutor):
+    """
+    Clustering stage of a batch job: every shape is clustered and exported by
+    run_part_clustering.solve_clustering on the clustering pool, all shapes in parallel.
+    The per-shape results and a summary.json are packed in one zip.
+    """
+    params = job.params
+    features_dir = job.result["features_dir"]
+    output_dir = params["output_dir"]
+    batch_dir = output_dir / "batch"
+    is_pc = params["is_point_cloud"]
+    start = time.time()
+
+    shapes = {uid: {"uid": uid, "source": source, "status": "failed", "error": "No features extracted", "levels": []}
+              for uid, source in params["sources"].items()}
+    uids = [uid for uid in feature_uids(features_dir) if uid in shapes]
+    if not uids:
+        raise RuntimeError("No features found")
+
+    job.log(f"Clustering {len(uids)} shape(s) with max {params['max_clusters']} clusters...")
+    solve = partial(metrics.traced_call, job.trace_file, clustering.solve_clustering)
+    tasks = {}
+    for uid in uids:
+        shape_dir = batch_dir / uid
+        (shape_dir / "ply").mkdir(parents=True, exist_ok=True)
+        (shape_dir / "cluster_out").mkdir(parents=True, exist_ok=True)
+        input_fname = str(params["input_dir"] / f"{uid}.ply") if is_pc else None
+        task = clustering_pool.submit(
+            solve, input_fname, uid, 0,
+            save_dir=str(features_dir),
+            out_render_fol=str(shape_dir),
+            use_agglo=params["use_agglomerative"] and not is_pc,
+            max_num_clusters=params["max_clusters"],
+            is_pc=is_pc,
+            option=params["adjacency_option"],
+            with_knn=params["add_knn_edges"],
+            vertex_feature=job.result.get("plan", {}).get("vertex_feature", False)
+        )
+        tasks[task] = uid
 
-        def get_cluster_count(path):
-            # Filename format: {uid}_{view_id}_{num_clusters}.ply or .obj
+    try:
+        for done, task in enumerate(as_completed(tasks), 1):
+            job.check_cancelled()
+            uid = tasks[task]
             try:
-                return int(path.stem.split('_')[-1])
-            except:
-                return 0
-
-        mesh_list.sort(key=get_cluster_count)
-        mesh_files = [str(f) for f in mesh_list]
-
-    if not mesh_files:
-        return (
-            "Warning: No output files generated",
-            [], pca_file,
-            log("Processing completed but no mesh files were generated")
-        )
+                task.result()
+                levels = sorted((batch_dir / uid / "cluster_out").glob("*.npy"), key=lambda f: level_cluster_count(str(f)))
+                shapes[uid]["levels"] = [level_cluster_count(str(f)) for f in levels]
+                if levels:
+                    shapes[uid]["status"] = "done"
+                    del shapes[uid]["error"]
+                else:
+                    shapes[uid]["error"] = "No segmentation generated"
+            except Exception as e:
+                shapes[uid]["error"] = str(e)
+            job.set_status("clustering", f"Clustered {done}/{len(tasks)} shapes")
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    succeeded = sum(shape["status"] == "done" for shape in shapes.values())
+    summary = {
+        "job_id": job.id,
+        "num_shapes": len(shapes),
+        "num_succeeded": succeeded,
+        "shapes": list(shapes.values()),
+        "skipped_files": params["skipped"],
+        "parameters": {key: params[key] for key in ("is_point_cloud", "max_clusters", "use_agglomerative", "preprocess_mesh",
+                                                    "adjacency_option", "add_knn_edges", "points_per_face")},
+        "plan": job.result.get("plan"),
+        "clustering_seconds": round(time.time() - start, 2),
+    }
+    job.log(f"Clustering completed: {succeeded}/{len(shapes)} shape(s) segmented")
+    if succeeded == 0:
+        raise RuntimeError("No shape could be segmented")
+
+    # One archive per job: summary.json, then {uid}/cluster_out (labels) and {uid}/ply (colored meshes)
+    zip_path = output_dir / f"partfield_batch_{job.id}.zip"
+    with metrics.timed("export", uid="batch"):
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("summary.json", json.dumps(summary, indent=2))
+            for f in sorted(batch_dir.rglob("*")):
+                if f.is_file():
+                    archive.write(f, f.relative_to(batch_dir).as_posix())
+    # The archive is the result, the unpacked copy is not kept
+    shutil.rmtree(batch_dir, ignore_errors=True)
+
+    job.update_result(
+        batch_zip=str(zip_path),
+        summary=summary,
+        message=f"Success! Segmented {succeeded}/{len(shapes)} shape(s)"
+    )
+
+
+def feature_uids(features_dir: Path) -> List[str]:
+    """Uids of the shapes with extracted features, from part_feat_{uid}_0[_batch].npy."""
+    uids = []
+    for f in sorted(features_dir.glob("part_feat_*_0*.npy")):
+        name = f.name[len("part_feat_"):]
+        uids.append(name[:name.rindex("_0")])
+    return sorted(set(uids))
 
-    # Clear GPU memory after processing
-    clear_gpu_memory()
+
+def finish_job(job: Job, store: JobStore):
+    """Called once a job is done, failed or cancelled: its features are no longer needed."""
+    # Timings and memory peaks of the whole job, from its trace
+    summary = metrics.summarize_trace(job.trace_file)
+    job.update_result(metrics=summary)
+    job.log(format_job_metrics(summary))
 
     # Cleanup feature files to save disk space
-    if actual_features_dir.exists():
-        shutil.rmtree(actual_features_dir, ignore_errors=True)
+    features_dir = job.result.get("features_dir")
+    if features_dir is not None and features_dir.exists():
+        shutil.rmtree(features_dir, ignore_errors=True)
+    store.finish(job.id)
 
-    # Check if OBJ files were generated (UV maps preserved)
-    has_obj = any(f.endswith('.obj') for f in mesh_files)
-    format_note = " (with UV maps)" if has_obj else ""
 
-    log(f"Generated {len(mesh_files)} segmentation result(s){format_note}")
-    progress(1.0, desc="Done!")
+def format_job_metrics(summary: dict) -> str:
+    """One log line with the stage timings and memory peaks of a job."""
+    parts = [f"{stage} {seconds:.2f}s" for stage, seconds in summary["stages"].items()]
+    parts += [f"peak RSS {scope} {mb} MB" for scope, mb in summary["peak_rss_mb"].items()]
+    if summary["peak_device_mb"] is not None:
+        parts.append(f"peak device {summary['peak_device_mb']} MB")
+    return "Metrics: " + (", ".join(parts) if parts else "none recorded")
 
-    return (
-        f"Success! Generated {len(mesh_files)} segmentation(s) with 2 to {max_clusters} parts{format_note}",
-        mesh_files,
-        pca_file,
-        '\n'.join(log_output)
-    )
+
+def level_cluster_count(path: str) -> int:
+    """Number of clusters of a result level."""
+    # Filename format: {uid}_{view_id}_{num_clusters}.npy
+    try:
+        return int(Path(path).stem.split('_')[-1])
+    except:
+        return 0
+
+
+def result_choices(levels: List[str], geometry: dict) -> Tuple[List[str], dict]:
+    """Dropdown labels of the result levels and the label -> (labels file, geometry) mapping."""
+    dropdown_choices = []
+    files_mapping = {}
+
+    for labels_file in levels:
+        # Indicate format in label if OBJ (has UV maps)
+        format_suffix = " (UV)" if geometry.get("uv_file") else ""
+        label = f"{Path(labels_file).stem.split('_')[-1]} parts{format_suffix}"
+
+        dropdown_choices.append(label)
+        files_mapping[label] = (labels_file, geometry)
+
+    return dropdown_choices, files_mapping
+
+
+# ==================== Result Meshes ====================
+
+def materialize_level(labels_file: str, geometry: dict) -> str:
+    """
+    Write the colored mesh (or point cloud) of one level next to the job outputs.
+
+    Args:
+        labels_file: Labels of the level, cluster_out/{uid}_{view_id}_{num_clusters}.npy
+        geometry: Geometry of the job, see cluster_features
+
+    Returns:
+        Path of the mesh, OBJ when the job has UV coordinates, PLY otherwise
+    """
+    labels = np.load(labels_file)
+    mesh_dir = Path(labels_file).parent.parent / "ply"
+    mesh_dir.mkdir(parents=True, exist_ok=True)
+    stem = Path(labels_file).stem
+
+    if geometry["is_pc"]:
+        mesh_path = mesh_dir / f"{stem}.ply"
+        tmp_path = mesh_dir / f"{stem}.tmp.ply"
+        points = clustering.load_ply_to_numpy(geometry["path"])
+        clustering.export_pointcloud_with_labels_to_ply(points, labels, filename=str(tmp_path))
+    else:
+        mesh = clustering.load_mesh_util(geometry["path"])
+        if geometry["uv_file"]:
+            mesh_path = mesh_dir / f"{stem}.obj"
+            tmp_path = mesh_dir / f"{stem}.tmp.obj"
+            uv_coords = np.load(geometry["uv_file"])["uv_coords"]
+            clustering.export_colored_mesh_obj_with_uv(mesh.vertices, mesh.faces, labels, uv_coords, filename=str(tmp_path))
+        else:
+            mesh_path = mesh_dir / f"{stem}.ply"
+            tmp_path = mesh_dir / f"{stem}.tmp.ply"
+            clustering.export_colored_mesh_ply(mesh.vertices, mesh.faces, labels, filename=str(tmp_path))
+
+    # Concurrent requests of the same level never see a partial file
+    os.replace(tmp_path, mesh_path)
+    return str(mesh_path)
+
+
+class MeshCache:
+    """
+    Small in-process LRU of the meshes generated by materialize_level, keyed by labels file.
+    Meshes pushed out of the cache are deleted from disk.
+    """
+
+    def __init__(self, capacity: int = MESH_CACHE_SIZE):
+        self.capacity = capacity
+        self.meshes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, labels_file: str, geometry: dict) -> str:
+        """Path of the mesh of a level, generated if it is not cached."""
+        with self.lock:
+            mesh_path = self.meshes.get(labels_file)
+            if mesh_path is not None and Path(mesh_path).exists():
+                self.meshes.move_to_end(labels_file)
+                return mesh_path
+
+        with metrics.timed('export'):
+            mesh_path = materialize_level(labels_file, geometry)
+
+        with self.lock:
+            self.meshes[labels_file] = mesh_path
+            self.meshes.move_to_end(labels_file)
+            while len(self.meshes) > self.capacity:
+                _, evicted = self.meshes.popitem(last=False)
+                Path(evicted).unlink(missing_ok=True)
+        return mesh_path
 
 
 # ==================== Gradio Interface ====================
 
-def create_interface(jobs_dir: str) -> gr.Blocks:
+def create_interface(jobs_dir: str, scheduler: JobScheduler, store: JobStore) -> gr.Blocks:
     """Create the Gradio interface."""
 
     with gr.Blocks(
@@ -396,6 +916,13 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                     info="Recommended for meshes. Uncheck for KMeans."
                 )
 
+                quality = gr.Radio(
+                    label="Quality",
+                    choices=[("Full", "full"), ("Preview (fast)", "preview")],
+                    value="full",
+                    info="Preview: fewer points, vertex features, KMeans and a few levels. Refine it for full quality."
+                )
+
                 # Advanced options
                 with gr.Accordion("Advanced Options", open=False):
                     preprocess_mesh = gr.Checkbox(
@@ -427,11 +954,24 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                         maximum=2000,
                         value=1000,
                         step=100,
-                        info="Lower = less memory, potentially less accurate"
+                        info="Upper bound, lowered automatically when the mesh does not fit the memory budget"
                     )
 
-                # Process button
-                process_btn = gr.Button("Process", variant="primary", size="lg")
+                # Process and cancel buttons
+                with gr.Row():
+                    process_btn = gr.Button("Process", variant="primary", size="lg")
+                    refine_btn = gr.Button("Refine (full quality)", size="lg")
+                    cancel_btn = gr.Button("Cancel", variant="stop", size="lg")
+
+                # Batch of files, with the parameters above
+                with gr.Accordion("Batch Processing", open=False):
+                    batch_files = gr.File(
+                        label="Upload 3D Files or Zip Archives",
+                        file_count="multiple",
+                        file_types=[".obj", ".glb", ".off", ".ply", ".zip"],
+                        type="filepath"
+                    )
+                    batch_btn = gr.Button("Process Batch", variant="primary")
 
             # Right column: Results
             with gr.Column(scale=2):
@@ -441,6 +981,7 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                     interactive=False,
                     lines=1
                 )
+                timings_text = gr.Markdown()
 
                 # 3D visualization
                 with gr.Tabs():
@@ -466,6 +1007,10 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                             height=400
                         )
 
+                    with gr.TabItem("Batch Results"):
+                        batch_zip = gr.File(label="Batch Results (zip)")
+                        batch_summary = gr.JSON(label="Summary")
+
                 # Processing log
                 with gr.Accordion("Processing Log", open=False):
                     log_output = gr.Textbox(
@@ -476,12 +1021,33 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                         elem_classes=["log-output"]
                     )
 
-        # State for storing results mapping (label -> path)
+        # State for storing results mapping (label -> labels file and geometry)
         result_files_state = gr.State({})
+        # Colored meshes of the levels, generated when a level is first shown or downloaded
+        mesh_cache = MeshCache()
+        # Id of the job of this session
+        job_id_state = gr.State("")
+
+        def started_job(job_id, status):
+            """Outputs of a submission: clear the results of the previous job, unless it was rejected."""
+            if job_id is None:
+                return status, gr.update(), gr.update(), gr.update(), status, gr.update(), gr.update(), ""
+            return (
+                status,
+                gr.Dropdown(choices=[], value=None),
+                None,
+                None,
+                "",
+                {},
+                "",
+                job_id
+            )
 
-        def on_process(file_path, is_pc, max_clust, use_agglo, preprocess, adj_opt, knn, ppf, progress=gr.Progress()):
-            """Handle process button click."""
-            status, mesh_files, pca_file, log = process_3d_file(
+        def on_process(file_path, is_pc, max_clust, use_agglo, preprocess, adj_opt, knn, ppf, qual):
+            """Handle process button click: submit the job and return at once."""
+            job_id, status = submit_job(
+                scheduler=scheduler,
+                store=store,
                 file_path=file_path,
                 is_point_cloud=is_pc,
                 max_clusters=max_clust,
@@ -491,56 +1057,151 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                 add_knn_edges=knn,
                 points_per_face=ppf,
                 jobs_dir=jobs_dir,
-                progress=progress
+                quality=qual
             )
-
-            # Create dropdown choices and file mapping
-            dropdown_choices = []
-            files_mapping = {}
-
-            for mesh_path in mesh_files:
-                path = Path(mesh_path)
-                # Extract cluster count from filename
-                try:
-                    cluster_count = path.stem.split('_')[-1]
-                    # Indicate format in label if OBJ (has UV maps)
-                    format_suffix = " (UV)" if path.suffix.lower() == '.obj' else ""
-                    label = f"{cluster_count} parts{format_suffix}"
-                except:
-                    label = path.stem
-
-                dropdown_choices.append(label)
-                files_mapping[label] = mesh_path
-
-            # Select first result by default
-            first_choice = dropdown_choices[0] if dropdown_choices else None
-            first_model = files_mapping.get(first_choice) if first_choice else None
-
-            return (
-                status,
-                gr.Dropdown(choices=dropdown_choices, value=first_choice),
-                first_model,
-                pca_file,
-                log,
-                files_mapping
+            return started_job(job_id, status)
+
+        def on_refine(preview_id):
+            """Handle refine button click: queue the full-quality job of the session preview."""
+            job_id, status = submit_refine(scheduler, store, preview_id, jobs_dir)
+            if job_id is None:
+                # Keep the preview and its results in the session, the watcher is not started
+                raise gr.Error(status)
+            return started_job(job_id, status)
+
+        def job_timings(job_id, snapshot) -> str:
+            """Duration of a finished preview, and of the preview and its refinement."""
+            job = scheduler.get(job_id)
+            if job is None or snapshot["status"] != "done":
+                return ""
+            if job.params.get("quality") == "preview":
+                return f"Preview: {snapshot['elapsed']:.1f}s"
+            if job.params.get("preview_seconds") is not None:
+                return f"Preview: {job.params['preview_seconds']:.1f}s, full: {snapshot['elapsed']:.1f}s"
+            return f"Full: {snapshot['elapsed']:.1f}s"
+
+        async def watch_job(job_id):
+            """
+            Stream the results of the session job as they are produced: the PCA view once the
+            features exist, then every segmentation level as soon as its labels are saved.
+            Only the outputs that changed are sent.
+            """
+            if not job_id:
+                return
+            shown = {"levels": []}
+            while True:
+                snapshot = scheduler.status(job_id)
+                if snapshot is None:
+                    yield f"Job {job_id} not found", gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+                    return
+
+                status = f"[{job_id}] {snapshot['message']} ({snapshot['elapsed']:.0f}s)"
+                job = scheduler.get(job_id)
+                note = preview_note(job.params) if job is not None else ""
+                if note:
+                    status += f" - {note}"
+                log = gr.update()
+                if snapshot["log"] != shown.get("log"):
+                    log = shown["log"] = snapshot["log"]
+
+                pca = gr.update()
+                pca_file = snapshot["result"].get("pca_file")
+                if pca_file and pca_file != shown.get("pca"):
+                    pca = shown["pca"] = pca_file
+
+                dropdown, model, files_mapping = gr.update(), gr.update(), gr.update()
+                levels = snapshot["result"].get("levels", [])
+                if levels != shown.get("levels"):
+                    shown["levels"] = levels
+                    dropdown_choices, files_mapping = result_choices(levels, snapshot["result"]["geometry"])
+                    if not shown.get("selected") and dropdown_choices:
+                        # Select the first level to arrive, later ones only extend the choices
+                        shown["selected"] = True
+                        dropdown = gr.Dropdown(choices=dropdown_choices, value=dropdown_choices[0])
+                        model = await asyncio.to_thread(mesh_cache.get, *files_mapping[dropdown_choices[0]])
+                    else:
+                        dropdown = gr.update(choices=dropdown_choices)
+
+                if snapshot["status"] in FINISHED_STATES:
+                    yield status, dropdown, model, pca, log, files_mapping, job_timings(job_id, snapshot)
+                    return
+                yield status, dropdown, model, pca, log, files_mapping, gr.update()
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+        def on_process_batch(files, is_pc, max_clust, use_agglo, preprocess, adj_opt, knn, ppf):
+            """Handle process batch button click: submit one job for all the files and return at once."""
+            job_id, status = submit_batch(
+                scheduler=scheduler,
+                store=store,
+                file_paths=files or [],
+                is_point_cloud=is_pc,
+                max_clusters=max_clust,
+                use_agglomerative=use_agglo,
+                preprocess_mesh=preprocess,
+                adjacency_option=adj_opt,
+                add_knn_edges=knn,
+                points_per_face=ppf,
+                jobs_dir=jobs_dir
             )
-
-        def on_select_result(selected_label, files_mapping):
-            """Handle dropdown selection change."""
+            if job_id is None:
+                return status, status, gr.update(), gr.update(), ""
+            return status, "", None, None, job_id
+
+        async def watch_batch(job_id):
+            """
+            Report the progress of the session batch job, then its zip and summary once it is done.
+            """
+            if not job_id:
+                return
+            shown_log = None
+            while True:
+                snapshot = scheduler.status(job_id)
+                if snapshot is None:
+                    yield f"Job {job_id} not found", gr.update(), gr.update(), gr.update()
+                    return
+
+                status = f"[{job_id}] {snapshot['message']} ({snapshot['elapsed']:.0f}s)"
+                log = gr.update()
+                if snapshot["log"] != shown_log:
+                    log = shown_log = snapshot["log"]
+
+                if snapshot["status"] in FINISHED_STATES:
+                    result = snapshot["result"]
+                    yield status, log, result.get("batch_zip"), result.get("summary")
+                    return
+                yield status, log, gr.update(), gr.update()
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+        def on_cancel(job_id):
+            """Handle cancel button click."""
+            if job_id and scheduler.cancel(job_id):
+                return f"[{job_id}] Cancelling..."
+            return gr.update()
+
+        def level_mesh(selected_label, files_mapping, job_id) -> Optional[str]:
+            """Mesh of the selected level, None if there is none or the job was evicted."""
             if selected_label and files_mapping and selected_label in files_mapping:
-                return files_mapping[selected_label]
+                labels_file, geometry = files_mapping[selected_label]
+                if Path(labels_file).exists():
+                    mesh_path = mesh_cache.get(labels_file, geometry)
+                    store.touch(job_id)
+                    store.refresh(job_id)
+                    return mesh_path
             return None
 
-        def on_download(selected_label, files_mapping):
+        def on_select_result(selected_label, files_mapping, job_id):
+            """Handle dropdown selection change: the mesh of the level is generated on demand."""
+            return level_mesh(selected_label, files_mapping, job_id)
+
+        def on_download(selected_label, files_mapping, job_id):
             """Handle download button click."""
-            if selected_label and files_mapping and selected_label in files_mapping:
-                path = files_mapping[selected_label]
-                if Path(path).exists():
-                    return gr.File(value=path, visible=True)
+            mesh_path = level_mesh(selected_label, files_mapping, job_id)
+            if mesh_path is not None:
+                return gr.File(value=mesh_path, visible=True)
             return gr.File(visible=False)
 
         # Connect events
-        process_btn.click(
+        process_event = process_btn.click(
             fn=on_process,
             inputs=[
                 input_file,
@@ -550,7 +1211,8 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                 preprocess_mesh,
                 adjacency_option,
                 add_knn_edges,
-                points_per_face
+                points_per_face,
+                quality
             ],
             outputs=[
                 status_text,
@@ -558,19 +1220,101 @@ def create_interface(jobs_dir: str) -> gr.Blocks:
                 result_model,
                 pca_model,
                 log_output,
-                result_files_state
+                result_files_state,
+                timings_text,
+                job_id_state
+            ]
+        )
+
+        watch_outputs = [
+            status_text,
+            result_selector,
+            result_model,
+            pca_model,
+            log_output,
+            result_files_state,
+            timings_text
+        ]
+
+        # The watcher only waits on the job record, the work runs on the scheduler pools
+        watch_event = process_event.then(
+            fn=watch_job,
+            inputs=[job_id_state],
+            outputs=watch_outputs,
+            show_progress="hidden",
+            concurrency_limit=None
+        )
+
+        # The refinement replaces the preview in the session, its results stream the same way
+        refine_event = refine_btn.click(
+            fn=on_refine,
+            inputs=[job_id_state],
+            outputs=[
+                status_text,
+                result_selector,
+                result_model,
+                pca_model,
+                log_output,
+                result_files_state,
+                timings_text,
+                job_id_state
             ]
         )
+        refine_watch_event = refine_event.then(
+            fn=watch_job,
+            inputs=[job_id_state],
+            outputs=watch_outputs,
+            show_progress="hidden",
+            concurrency_limit=None
+        )
+
+        batch_event = batch_btn.click(
+            fn=on_process_batch,
+            inputs=[
+                batch_files,
+                is_point_cloud,
+                max_clusters,
+                use_agglomerative,
+                preprocess_mesh,
+                adjacency_option,
+                add_knn_edges,
+                points_per_face
+            ],
+            outputs=[status_text, log_output, batch_zip, batch_summary, job_id_state],
+            api_name="submit_batch"
+        )
+
+        # API clients call batch_result with the job id to wait for the zip and the summary
+        batch_watch_event = batch_event.then(
+            fn=watch_batch,
+            inputs=[job_id_state],
+            outputs=[status_text, log_output, batch_zip, batch_summary],
+            show_progress="hidden",
+            concurrency_limit=None,
+            api_name="batch_result"
+        )
+
+        # A new submission replaces the watcher of the previous job
+        watchers = [watch_event, refine_watch_event, batch_watch_event]
+        process_btn.click(fn=None, cancels=watchers)
+        refine_btn.click(fn=None, cancels=watchers)
+        batch_btn.click(fn=None, cancels=watchers)
+
+        cancel_btn.click(
+            fn=on_cancel,
+            inputs=[job_id_state],
+            outputs=[status_text]
+        )
 
         result_selector.change(
             fn=on_select_result,
-            inputs=[result_selector, result_files_state],
+            inputs=[result_selector, result_files_state, job_id_state],
             outputs=[result_model]
         )
 
         download_btn.click(
             fn=on_download,
-            inputs=[result_selector, result_files_state],
+            inputs=[result_selector, result_files_state, job_id_state],
             outputs=[download_file]
         )
 
@@ -592,14 +1336,65 @@ def main():
     parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Server port")
     parser.add_argument("--share", action="store_true", help="Create public Gradio link")
     parser.add_argument("--jobs-dir", type=str, default=DEFAULT_JOBS_DIR, help="Directory for job storage")
+    parser.add_argument("--inference-workers", type=int, default=1,
+                        help="Jobs extracting features at the same time (each loads the model on the GPU)")
+    parser.add_argument("--clustering-workers", type=int, default=0,
+                        help="Jobs clustering at the same time, 0 for the number of CPU cores")
+    parser.add_argument("--job-ttl-hours", type=float, default=JOB_EXPIRY_HOURS,
+                        help="Jobs not accessed for that long are deleted")
+    parser.add_argument("--max-storage-gb", type=float, default=MAX_STORAGE_GB,
+                        help="Disk quota of the jobs and their features, least recently used jobs are deleted first (0: no quota)")
+    parser.add_argument("--metrics-port", type=int, default=DEFAULT_METRICS_PORT,
+                        help="Port of the Prometheus metrics endpoint on 127.0.0.1 (0: disabled)")
+    parser.add_argument("--device-memory-gb", type=float, default=0,
+                        help=f"GPU memory budget of a job for the sampling planner (0: {DEVICE_BUDGET_FRACTION:.0%} of the GPU)")
+    parser.add_argument("--host-memory-gb", type=float, default=0,
+                        help=f"RAM budget of a job for the sampling planner (0: {HOST_BUDGET_FRACTION:.0%} of the RAM)")
     args = parser.parse_args()
 
     # Ensure jobs directory exists
     jobs_path = Path(args.jobs_dir)
     jobs_path.mkdir(parents=True, exist_ok=True)
 
+    # Clustering runs in persistent worker processes, forked from a server that has already
+    # imported run_part_clustering (sklearn, open3d, networkx, ...)
+    clustering_workers = args.clustering_workers or os.cpu_count() or 1
+    mp_context = multiprocessing.get_context("forkserver")
+    mp_context.set_forkserver_preload(["run_part_clustering"])
+    clustering_pool = ProcessPoolExecutor(max_workers=clustering_workers, mp_context=mp_context)
+    # Start the fork server now rather than on the first job
+    clustering_pool.submit(os.getpid).result()
+
+    # Disk usage of the jobs and their feature folders, evicted in the background
+    store = JobStore(
+        jobs_dir=str(jobs_path),
+        features_dir=str(get_partfield_dir() / "exp_results"),
+        ttl_seconds=args.job_ttl_hours * 3600,
+        max_bytes=int(args.max_storage_gb * 1024 ** 3),
+        interval=EVICTION_INTERVAL_SECONDS
+    )
+    store.start()
+
+    # Sampling parameters are planned per job to fit these budgets
+    device_budget, host_budget = detect_memory_budgets(args.device_memory_gb, args.host_memory_gb)
+    print(f"Memory budgets per job: {device_budget / 1024 ** 3:.1f} GB GPU, {host_budget / 1024 ** 3:.1f} GB RAM")
+
+    # Feature extraction and clustering run on separate bounded pools
+    scheduler = JobScheduler(
+        extract_fn=partial(extract_features, device_budget=device_budget, host_budget=host_budget),
+        cluster_fn=partial(cluster_features, clustering_pool=clustering_pool),
+        extract_workers=args.inference_workers,
+        cluster_workers=clustering_workers,
+        on_finish=partial(finish_job, store=store)
+    )
+
+    # Stage histograms, memory peaks and job counts at http://127.0.0.1:<port>/metrics
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+        print(f"Metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+
     # Create and launch interface
-    app = create_interface(args.jobs_dir)
+    app = create_interface(args.jobs_dir, scheduler, store)
 
     app.launch(
         server_name="0.0.0.0",
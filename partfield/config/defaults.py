@@ -16,7 +16,11 @@ _C.num_neg_hard_emb = 128
 _C.vertex_feature = False  # if true, sample feature on vertices; if false, sample feature on faces
 _C.n_point_per_face = 2000
 _C.n_sample_each = 10000
+_C.pc_num_pts = 100000  # number of surface points fed to the encoder
+_C.stratified_sampling = False  # stratified (low-discrepancy) instead of i.i.d. surface sampling, seeded by cfg.seed
 _C.preprocess_mesh = False
+_C.quantize = ''  # 'dynamic_int8': int8 dynamic quantization of the transformer and MLP layers, runs on the CPU
+_C.claim_timeout = 21600  # seconds after which the claim of a shape by another host is considered stale, 0 never
 
 _C.regress_2d_feat = False
 
@@ -55,6 +59,17 @@ _C.dataset.val_num_workers = 32
 _C.dataset.train_batch_size = 2
 _C.dataset.val_batch_size = 2
 _C.dataset.all_files = []  # only used for correspondence demo
+_C.dataset.shard_index = 0  # this process handles files shard_index::num_shards (combined with the DDP rank)
+_C.dataset.num_shards = 1
+
+_C.splat = CN()
+_C.splat.enabled = False  # is_pc inputs are Gaussian splats: prune by opacity and importance-sample
+_C.splat.opacity_threshold = 0.05
+_C.splat.max_points = 200000
+
+_C.triplane_attention = CN()
+_C.triplane_attention.impl = 'mha'  # 'mha' (nn.MultiheadAttention), 'sdpa' (F.scaled_dot_product_attention) or 'chunked'
+_C.triplane_attention.chunk_size = 1024  # queries per chunk for 'chunked'
 
 _C.voxel2triplane = CN()
 _C.voxel2triplane.transformer_dim = 1024
@@ -78,6 +93,7 @@ _C.use_pvcnnonly = True
 _C.pvcnn = CN()
 _C.pvcnn.point_encoder_type = 'pvcnn'
 _C.pvcnn.use_point_scatter = True
+_C.pvcnn.voxel_conv = 'dense' # 'sparse' convolves around the occupied voxels only, same features and weights
 _C.pvcnn.z_triplane_channels = 64
 _C.pvcnn.z_triplane_resolution = 256
 _C.pvcnn.unet_cfg = CN()
@@ -90,3 +106,4 @@ _C.pvcnn.unet_cfg.use_initial_conv = False
 
 _C.use_2d_feat = False
 _C.inference_metrics_only = False
+_C.inference_only = False  # build only pvcnn and triplane_transformer, checkpoints are filtered on load
@@ -11,7 +11,6 @@ import skimage
 import trimesh
 import os
 from scipy.spatial import KDTree
-import gc
 from plyfile import PlyData
 
 ## For remeshing
@@ -25,6 +24,8 @@ import tempfile
 import pymeshlab
 
 from partfield.utils import *
+from partfield.sampling import sample_surface
+from partfield import metrics
 
 #########################
 ## To handle quad inputs
@@ -60,62 +61,116 @@ def quad_to_triangle_mesh(F):
     return new_faces
 #########################
 
+#########################
+## Sharding (file discovery is in partfield/utils.py)
+#########################
+def shard_files(data_list, shard_index=0, num_shards=1):
+    """
+    Take the shard_index-th of num_shards disjoint, interleaved slices of data_list.
+    """
+    if num_shards <= 1:
+        return data_list
+    assert 0 <= shard_index < num_shards, f"Invalid shard {shard_index} of {num_shards}"
+    return data_list[shard_index::num_shards]
+#########################
+
+#########################
+## Gaussian splat ingestion
+#########################
+SPLAT_PROPERTIES = ('x', 'y', 'z', 'opacity', 'scale_0', 'scale_1', 'scale_2')
+
+def load_splats(filename, opacity_threshold=0.05, max_points=200000, seed=0):
+    """
+    Load the centers of a Gaussian-splat PLY, drop near-transparent splats and
+    importance-sample the rest down to max_points.
+
+    Opacity is stored as a logit and scales as log-scales (3DGS convention). Splats are
+    kept with probability proportional to opacity * mean extent, sampled without
+    replacement with the Efraimidis-Spirakis keys u^(1/w). Plain point cloud PLYs
+    without these properties are only subsampled.
+
+    Parameters:
+        filename (str): Path to the PLY file.
+        opacity_threshold (float): Minimum opacity (after sigmoid) of a kept splat.
+        max_points (int): Maximum number of kept splats.
+        seed (int): Seed of the subsampling.
+
+    Returns:
+        tuple: (points, nearest_kept) where points (M, 3) are the kept splat centers and
+        nearest_kept (N,) is the index of the closest kept splat for every original splat.
+    """
+    header = read_ply_header(filename)
+    names = {p for name, _, props in header['elements'] if name == 'vertex' for p, _ in props}
+    columns = load_ply_vertex_columns(filename, [p for p in SPLAT_PROPERTIES if p in names])
+
+    points = np.stack([columns['x'], columns['y'], columns['z']], axis=-1).astype(np.float32)
+    n = points.shape[0]
+
+    weight = np.ones(n, dtype=np.float32)
+    keep = np.arange(n)
+    if 'opacity' in columns:
+        opacity = 1.0 / (1.0 + np.exp(-np.asarray(columns['opacity'], dtype=np.float32)))
+        weight = opacity
+        opaque = np.flatnonzero(opacity >= opacity_threshold)
+        if len(opaque) > 0:
+            keep = opaque
+    scale_names = [p for p in ('scale_0', 'scale_1', 'scale_2') if p in columns]
+    if scale_names:
+        log_scales = np.stack([np.asarray(columns[p], dtype=np.float32) for p in scale_names], axis=-1)
+        weight = weight * np.exp(log_scales).mean(axis=-1)
+
+    if len(keep) > max_points:
+        rng = np.random.default_rng(seed)
+        keys = np.log(rng.random(len(keep))) / np.maximum(weight[keep], 1e-12)
+        keep = np.sort(keep[np.argpartition(-keys, max_points)[:max_points]])
+
+    kept_points = points[keep]
+    if len(keep) == n:
+        nearest_kept = np.arange(n)
+    else:
+        _, nearest_kept = KDTree(kept_points).query(points, k=1, workers=-1)
+    print(f"splats: {n} in file, {len(keep)} kept")
+    return kept_points, nearest_kept
+#########################
+
 class Demo_Dataset(torch.utils.data.Dataset):
-    def __init__(self, cfg):
+    def __init__(self, cfg, shard_index=0, num_shards=1):
         super().__init__()
 
         self.data_path = cfg.dataset.data_path
         self.is_pc = cfg.is_pc
 
-        all_files = os.listdir(self.data_path)
+        all_files = discover_files(self.data_path, PC_EXTENSIONS if self.is_pc else MESH_EXTENSIONS)
 
-        selected = []
-        for f in all_files:
-            if ".ply" in f and self.is_pc:
-                selected.append(f)
-            elif (".obj" in f or ".glb" in f or ".off" in f) and not self.is_pc:
-                selected.append(f)
-
-        self.data_list = selected
-        self.pc_num_pts = 100000
+        self.data_list = shard_files(all_files, shard_index, num_shards)
+        self.pc_num_pts = cfg.pc_num_pts
+        self.seed = cfg.seed
+        self.stratified_sampling = cfg.stratified_sampling
 
         self.preprocess_mesh = cfg.preprocess_mesh
         self.result_name = cfg.result_name
+        self.splat = cfg.splat
 
+        if num_shards > 1:
+            print(f"shard {shard_index}/{num_shards}, {len(all_files)} files in total")
         print("val dataset len:", len(self.data_list))
 
     
     def __len__(self):
         return len(self.data_list)
 
-    def load_ply_to_numpy(self, filename):
-        """
-        Load a PLY file and extract the point cloud as a (N, 3) NumPy array.
-
-        Parameters:
-            filename (str): Path to the PLY file.
-
-        Returns:
-            numpy.ndarray: Point cloud array of shape (N, 3).
-        """
-        ply_data = PlyData.read(filename)
-
-        # Extract vertex data
-        vertex_data = ply_data["vertex"]
-        
-        # Convert to NumPy array (x, y, z)
-        points = np.vstack([vertex_data["x"], vertex_data["y"], vertex_data["z"]]).T
-
-        return points
-
+    @metrics.timed('preprocess')
     def get_model(self, ply_file):
 
-        uid = ply_file.split(".")[-2].replace("/", "_")
+        uid = file_uid(ply_file)
 
         ####
         if self.is_pc:
             ply_file_read = os.path.join(self.data_path, ply_file)
-            pc = self.load_ply_to_numpy(ply_file_read)
+            if self.splat.enabled:
+                pc, splat_index = load_splats(ply_file_read, self.splat.opacity_threshold, self.splat.max_points, seed=self.seed)
+            else:
+                pc = load_ply_to_numpy(ply_file_read)
 
             bbmin = pc.min(0)
             bbmax = pc.max(0)
@@ -173,19 +228,9 @@ class Demo_Dataset(torch.utils.data.Dataset):
                 print(mesh.vertices.shape)
                 print(mesh.faces.shape)
 
-            ### Save input
-            save_dir = f"exp_results/{self.result_name}"
-            os.makedirs(save_dir, exist_ok=True)
-            view_id = 0
-            mesh.export(f'{save_dir}/input_{uid}_{view_id}.ply')
-
-            # Save UV data if available
-            if uv_coords is not None:
-                np.savez(f'{save_dir}/input_uv_{uid}_{view_id}.npz',
-                         uv_coords=uv_coords, uv_type=uv_type)                
+            ### The input mesh is exported by the model's background writer (predict_step)
 
-
-            pc, _ = trimesh.sample.sample_surface(mesh, self.pc_num_pts) 
+            pc, _ = sample_surface(mesh.vertices, mesh.faces, self.pc_num_pts, seed=self.seed, stratified=self.stratified_sampling)
 
         result = {
                     'uid': uid
@@ -193,6 +238,9 @@ class Demo_Dataset(torch.utils.data.Dataset):
 
         result['pc'] = torch.tensor(pc, dtype=torch.float32)
 
+        if self.is_pc and self.splat.enabled:
+            result['splat_index'] = torch.from_numpy(np.asarray(splat_index, dtype=np.int64))
+
         if not self.is_pc:
             result['vertices'] = mesh.vertices
             result['faces'] = mesh.faces
@@ -204,33 +252,29 @@ class Demo_Dataset(torch.utils.data.Dataset):
         return result
 
     def __getitem__(self, index):
-        
-        gc.collect()
-
         return self.get_model(self.data_list[index])
 
 ##############
 
 ###############################
 class Demo_Remesh_Dataset(torch.utils.data.Dataset):
-    def __init__(self, cfg):
+    def __init__(self, cfg, shard_index=0, num_shards=1):
         super().__init__()
 
         self.data_path = cfg.dataset.data_path
 
-        all_files = os.listdir(self.data_path)
+        all_files = discover_files(self.data_path, (".obj", ".glb"))
 
-        selected = []
-        for f in all_files:
-            if (".obj" in f or ".glb" in f):
-                selected.append(f)
-
-        self.data_list = selected
-        self.pc_num_pts = 100000
+        self.data_list = shard_files(all_files, shard_index, num_shards)
+        self.pc_num_pts = cfg.pc_num_pts
+        self.seed = cfg.seed
+        self.stratified_sampling = cfg.stratified_sampling
 
         self.preprocess_mesh = cfg.preprocess_mesh
         self.result_name = cfg.result_name
 
+        if num_shards > 1:
+            print(f"shard {shard_index}/{num_shards}, {len(all_files)} files in total")
         print("val dataset len:", len(self.data_list))
 
     
@@ -238,9 +282,10 @@ class Demo_Remesh_Dataset(torch.utils.data.Dataset):
         return len(self.data_list)
 
 
+    @metrics.timed('preprocess')
     def get_model(self, ply_file):
 
-        uid = ply_file.split(".")[-2]
+        uid = file_uid(ply_file)
 
         ####
         obj_path = os.path.join(self.data_path, ply_file)
@@ -281,11 +326,9 @@ class Demo_Remesh_Dataset(torch.utils.data.Dataset):
             print(mesh.vertices.shape)
             print(mesh.faces.shape)
 
-        ### Save input
-        save_dir = f"exp_results/{self.result_name}"
-        os.makedirs(save_dir, exist_ok=True)
-        view_id = 0            
-        mesh.export(f'{save_dir}/input_{uid}_{view_id}.ply')   
+        ### The input mesh is exported by the model's background writer (predict_step)
+        input_vertices = np.asarray(mesh.vertices)
+        input_faces = np.asarray(mesh.faces)
 
         try:
             ###### Remesh ######
@@ -342,7 +385,7 @@ class Demo_Remesh_Dataset(torch.utils.data.Dataset):
             print("Error in tet.")
             mesh = mesh 
 
-        pc, _ = trimesh.sample.sample_surface(mesh, self.pc_num_pts) 
+        pc, _ = sample_surface(mesh.vertices, mesh.faces, self.pc_num_pts, seed=self.seed, stratified=self.stratified_sampling)
 
         result = {
                     'uid': uid
@@ -351,13 +394,12 @@ class Demo_Remesh_Dataset(torch.utils.data.Dataset):
         result['pc'] = torch.tensor(pc, dtype=torch.float32)
         result['vertices'] = mesh.vertices
         result['faces'] = mesh.faces
+        result['input_vertices'] = input_vertices
+        result['input_faces'] = input_faces
 
         return result
 
     def __getitem__(self, index):
-        
-        gc.collect()
-
         return self.get_model(self.data_list[index])
 
 
@@ -370,7 +412,9 @@ class Correspondence_Demo_Dataset(Demo_Dataset):
 
         self.data_list = cfg.dataset.all_files
 
-        self.pc_num_pts = 100000
+        self.pc_num_pts = cfg.pc_num_pts
+        self.seed = cfg.seed
+        self.stratified_sampling = cfg.stratified_sampling
 
         self.preprocess_mesh = cfg.preprocess_mesh
         self.result_name = cfg.result_name
@@ -0,0 +1,126 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from partfield.sampling import sample_surface
+
+#########################
+## Exportable point cloud -> triplane stage (pvcnn + triplane_transformer)
+#########################
+# 3D (5-D input) GridSample, used by the PVCNN devoxelization, needs opset 20
+ONNX_OPSET = 20
+
+
+class TriplaneEncoder(nn.Module):
+    """
+    The pvcnn and triplane_transformer of Model as one module with a single tensor input,
+    which is the graph that gets exported.
+
+    forward: normalized point cloud (1, N, 3) -> part feature planes (1, 3, C, 128, 128),
+    the part_planes of Model.predict_step.
+    """
+    def __init__(self, pvcnn, triplane_transformer, sdf_channels=64):
+        super().__init__()
+        self.pvcnn = pvcnn
+        self.triplane_transformer = triplane_transformer
+        self.sdf_channels = sdf_channels
+
+    def forward(self, pc):
+        planes = self.triplane_transformer(self.pvcnn(pc, pc))
+        return planes[:, :, self.sdf_channels:]
+
+
+def export_encoder(encoder, filename, n_points, fmt='onnx', seed=0):
+    """
+    Trace encoder with a static (1, n_points, 3) input and save it as ONNX or TorchScript.
+
+    Parameters:
+        encoder (TriplaneEncoder): Encoder on the CPU, in eval mode.
+        filename (str): Output path (.onnx or .pt).
+        n_points (int): Number of input points baked into the graph.
+        fmt (str): 'onnx' or 'torchscript'.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    example = (torch.rand(1, n_points, 3, generator=generator) - 0.5) * 0.9
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            traced = torch.jit.trace(encoder, example, check_trace=False)
+            traced.save(filename, _extra_files={'n_points': str(n_points)})
+        elif fmt == 'onnx':
+            torch.onnx.export(encoder, (example,), filename, opset_version=ONNX_OPSET, dynamo=False,
+                              input_names=['pc'], output_names=['part_planes'])
+        else:
+            raise ValueError(f"Unknown export format {fmt}")
+
+
+def normalize_points(points):
+    """
+    Center the bounding box and scale its longest side to 0.9, as the datasets do.
+    """
+    bbmin = points.min(0)
+    bbmax = points.max(0)
+    center = (bbmin + bbmax) * 0.5
+    scale = 2.0 * 0.9 / (bbmax - bbmin).max()
+    return (points - center) * scale
+
+
+def prepare_points(vertices, faces=None, n_points=100000, seed=0, stratified=False):
+    """
+    Encoder input with exactly n_points rows: surface samples of a mesh, or a point cloud
+    subsampled (or repeated) to n_points.
+
+    Returns:
+        np.ndarray: (n_points, 3) float32 normalized points.
+    """
+    vertices = normalize_points(np.asarray(vertices, dtype=np.float64))
+    if faces is not None and len(faces) > 0:
+        points, _ = sample_surface(vertices, faces, n_points, seed=seed, stratified=stratified)
+    else:
+        rng = np.random.default_rng(seed)
+        points = vertices[rng.choice(len(vertices), n_points, replace=len(vertices) < n_points)]
+    return points.astype(np.float32)
+
+
+class ExportedEncoder:
+    """
+    CPU runner of an artifact written by export_encoder: onnxruntime for .onnx files,
+    torch.jit for TorchScript. Neither needs Lightning or the model code.
+
+    Parameters:
+        filename (str): Path of the artifact.
+        num_threads (int): Intra-op threads, 0 keeps the runtime default.
+    """
+    def __init__(self, filename, num_threads=0):
+        start = time.perf_counter()
+        self.is_onnx = filename.endswith('.onnx')
+        if self.is_onnx:
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if num_threads > 0:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+            self.n_points = self.session.get_inputs()[0].shape[1]
+        else:
+            if num_threads > 0:
+                torch.set_num_threads(num_threads)
+            extra_files = {'n_points': ''}
+            self.module = torch.jit.load(filename, map_location='cpu', _extra_files=extra_files)
+            self.n_points = int(extra_files['n_points'])
+        self.load_time = time.perf_counter() - start
+
+    def __call__(self, points):
+        """
+        Parameters:
+            points (np.ndarray): (n_points, 3) normalized points, see prepare_points.
+
+        Returns:
+            np.ndarray: (3, C, 128, 128) float32 part feature planes.
+        """
+        assert points.shape == (self.n_points, 3), f"the artifact takes exactly {self.n_points} points"
+        pc = np.ascontiguousarray(points, dtype=np.float32)[None]
+        if self.is_onnx:
+            return self.session.run(None, {'pc': pc})[0][0]
+        with torch.no_grad():
+            return self.module(torch.from_numpy(pc))[0].numpy()
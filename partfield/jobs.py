@@ -0,0 +1,427 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from partfield import metrics
+
+#########################
+## Job scheduler of the Gradio service
+#########################
+JOB_STATES = ['queued', 'extracting', 'clustering', 'done', 'failed', 'cancelled']
+FINISHED_STATES = ['done', 'failed', 'cancelled']
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    State of one submitted job, shared between the worker running it and the UI polling it.
+
+    Parameters:
+        job_id (str): Id of the job, also the name of its folder.
+        params (dict): Arguments of the stage functions, params['trace_file'] is the JSONL
+            trace of the job (see partfield.metrics), if any.
+    """
+    def __init__(self, job_id, params):
+        self.id = job_id
+        self.params = params
+        self.status = 'queued'
+        self.message = 'Waiting in queue'
+        self.result = {}
+        # Incremented on every change of result, so that watchers only resend what changed
+        self.version = 0
+        self.log_lines = []
+        self.process_output = ''
+        self.created = time.time()
+        self.finished = None
+        # Entered the queue of its current stage
+        self.queued = self.created
+        self.trace_file = params.get('trace_file')
+        self.cancel_event = threading.Event()
+        self.process = None
+        self.future = None
+        self.lock = threading.Lock()
+
+    def log(self, msg):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        with self.lock:
+            self.log_lines.append(f"[{timestamp}] {msg}")
+
+    def update_result(self, **values):
+        with self.lock:
+            self.result.update(values)
+            self.version += 1
+
+    def set_status(self, status, message):
+        with self.lock:
+            self.status = status
+            self.message = message
+            if status in FINISHED_STATES:
+                self.finished = time.time()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def run_command(self, cmd, cwd, on_line=None, env=None):
+        """
+        Run a command streaming its output to the job log. The command is terminated when
+        the job is cancelled.
+
+        Parameters:
+            on_line (callable): Called with every output line as it is printed, e.g. to
+                publish partial results.
+            env (dict): Environment of the command, the one of the server by default.
+
+        Returns:
+            (bool, str): success and the output of the command.
+        """
+        self.check_cancelled()
+        process = subprocess.Popen(
+            cmd,
+            cwd=str(cwd),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            env=env
+        )
+        with self.lock:
+            self.process = process
+            self.process_output = ''
+        if self.cancel_event.is_set():
+            # Cancelled while the command was starting
+            process.terminate()
+        output_lines = []
+        try:
+            for line in iter(process.stdout.readline, ''):
+                output_lines.append(line)
+                with self.lock:
+                    self.process_output = ''.join(output_lines[-50:])
+                if on_line is not None:
+                    on_line(line.rstrip('\n'))
+            process.wait()
+        finally:
+            with self.lock:
+                self.process = None
+                self.process_output = ''
+        self.check_cancelled()
+        return process.returncode == 0, ''.join(output_lines)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Copy of the job state, safe to read while the job runs.
+        """
+        with self.lock:
+            log = '\n'.join(self.log_lines)
+            if self.process_output:
+                # Only keep the last 50 lines of the running command to prevent overflow
+                lines = self.process_output.split('\n')[-50:]
+                log += '\n--- Command Output ---\n' + '\n'.join(lines)
+            return {
+                'id': self.id,
+                'status': self.status,
+                'message': self.message,
+                'result': dict(self.result),
+                'version': self.version,
+                'log': log,
+                'elapsed': (self.finished or time.time()) - self.created,
+            }
+
+
+class JobScheduler:
+    """
+    Runs jobs in two stages on separate bounded pools: feature extraction, which holds the
+    device, then clustering, which is CPU bound. A job leaves the extraction pool as soon as
+    its features exist, so the next job can use the device while it is being clustered.
+
+    Stage functions take the Job, publish their outputs, partial ones included, with
+    job.update_result and raise to fail the job.
+
+    Parameters:
+        extract_fn (callable): Feature extraction stage.
+        cluster_fn (callable): Clustering stage.
+        extract_workers (int): Jobs extracting features at the same time.
+        cluster_workers (int): Jobs clustering at the same time, the number of cores by default.
+        max_pending (int): Unfinished jobs accepted before submit refuses new ones.
+        max_finished (int): Finished jobs kept for status queries.
+        on_finish (callable): Called with the Job once it is done, failed or cancelled.
+    """
+    def __init__(self, extract_fn, cluster_fn, extract_workers=1, cluster_workers=None,
+                 max_pending=32, max_finished=256, on_finish=None):
+        self.extract_fn = extract_fn
+        self.cluster_fn = cluster_fn
+        self.on_finish = on_finish
+        self.extract_pool = ThreadPoolExecutor(max_workers=extract_workers, thread_name_prefix='extract')
+        self.cluster_pool = ThreadPoolExecutor(max_workers=cluster_workers or os.cpu_count() or 1,
+                                               thread_name_prefix='cluster')
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, params, job_id=None):
+        """
+        Queue a job for feature extraction.
+
+        Returns:
+            str: Id of the job.
+        """
+        with self.lock:
+            pending = sum(job.status not in FINISHED_STATES for job in self.jobs.values())
+            if pending >= self.max_pending:
+                raise RuntimeError(f"Server busy: {pending} jobs are already queued or running")
+            job = Job(job_id or str(uuid.uuid4())[:8], params)
+            self.jobs[job.id] = job
+            self._forget_finished()
+        job.log(f"Queued job {job.id}")
+        job.future = self.extract_pool.submit(self._run_stage, job, 'extracting', self.extract_fn, self._start_clustering)
+        return job.id
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        """
+        Returns:
+            dict or None: Snapshot of the job, see Job.snapshot, None for unknown ids.
+        """
+        job = self.get(job_id)
+        return job.snapshot() if job is not None else None
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job. A queued job is dropped from its pool, a running one
+        has its command terminated and stops at its next check.
+
+        Returns:
+            bool: False if the job is unknown or already finished.
+        """
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED_STATES:
+            return False
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            job.log("Cancelled before start")
+            self._finish(job, 'cancelled', 'Cancelled')
+        with job.lock:
+            process = job.process
+        if process is not None and process.poll() is None:
+            process.terminate()
+        return True
+
+    def shutdown(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+        self.extract_pool.shutdown(wait=False)
+        self.cluster_pool.shutdown(wait=False)
+
+    def _start_clustering(self, job):
+        job.set_status('queued', 'Features extracted, waiting for a clustering worker')
+        job.queued = time.time()
+        job.future = self.cluster_pool.submit(self._run_stage, job, 'clustering', self.cluster_fn, None)
+
+    def _run_stage(self, job, status, stage_fn, next_stage):
+        messages = {'extracting': 'Extracting features', 'clustering': 'Running clustering'}
+        try:
+            job.check_cancelled()
+            with metrics.tracing(job.trace_file):
+                metrics.observe('queue_wait', time.time() - job.queued, queue=status)
+                job.set_status(status, messages[status])
+                stage_fn(job)
+            job.check_cancelled()
+        except JobCancelled:
+            job.log("Cancelled")
+            self._finish(job, 'cancelled', 'Cancelled')
+            return
+        except Exception as e:
+            job.log(f"{messages[status]} failed: {e}")
+            self._finish(job, 'failed', f"Error: {e}")
+            return
+        if next_stage is not None:
+            next_stage(job)
+        else:
+            self._finish(job, 'done', job.result.get('message', 'Done'))
+
+    def _finish(self, job, status, message):
+        metrics.REGISTRY.inc('jobs_total', status=status)
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                job.log(f"Cleanup failed: {e}")
+        job.set_status(status, message)
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED_STATES]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+
+#########################
+## Job storage with background eviction
+#########################
+def dir_size(path):
+    """
+    Total size in bytes of the files under path, 0 if it does not exist.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class JobStore:
+    """
+    Disk usage of the jobs of the Gradio service: the job folder (jobs_dir/<id>) and the feature
+    folder (features_dir/job_<id>) of every job, evicted by a background thread once they are
+    older than the TTL, or least recently accessed first while the total is over max_bytes.
+
+    Sizes are kept in an index, measured per job when it is added or refreshed, so that requests
+    never walk the whole storage. The storage is only scanned once, when the thread starts, to
+    index the folders left by a previous run.
+
+    Parameters:
+        jobs_dir (str): Folder of the job folders.
+        features_dir (str): Folder of the feature folders (exp_results).
+        ttl_seconds (float): Jobs not accessed for that long are removed.
+        max_bytes (int): Quota of the jobs and feature folders together, 0 for no quota.
+        interval (float): Seconds between two eviction passes.
+    """
+    FEATURES_PREFIX = 'job_'
+
+    def __init__(self, jobs_dir, features_dir, ttl_seconds, max_bytes, interval=60.0):
+        self.jobs_dir = jobs_dir
+        self.features_dir = features_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.interval = interval
+        # job id -> {'bytes', 'last_access', 'active'}, in least recently accessed order
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def job_paths(self, job_id):
+        return [os.path.join(self.jobs_dir, job_id), os.path.join(self.features_dir, self.FEATURES_PREFIX + job_id)]
+
+    def add(self, job_id):
+        """
+        Index a new job. It is active, and never evicted, until finish is called.
+        """
+        with self.lock:
+            self.index[job_id] = {'bytes': 0, 'last_access': time.time(), 'active': True}
+        self.refresh(job_id)
+
+    def touch(self, job_id):
+        with self.lock:
+            entry = self.index.get(job_id)
+            if entry is not None:
+                entry['last_access'] = time.time()
+                self.index.move_to_end(job_id)
+
+    def refresh(self, job_id):
+        """
+        Measure the folders of one job again, after it wrote or removed files.
+        """
+        size = sum(dir_size(path) for path in self.job_paths(job_id))
+        with self.lock:
+            entry = self.index.get(job_id)
+            if entry is not None:
+                self.total_bytes += size - entry['bytes']
+                entry['bytes'] = size
+
+    def finish(self, job_id):
+        """
+        Mark a job as finished, from then on it can be evicted.
+        """
+        with self.lock:
+            entry = self.index.get(job_id)
+            if entry is not None:
+                entry['active'] = False
+        self.refresh(job_id)
+        self.touch(job_id)
+
+    def remove(self, job_id):
+        with self.lock:
+            entry = self.index.pop(job_id, None)
+            if entry is not None:
+                self.total_bytes -= entry['bytes']
+        for path in self.job_paths(job_id):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def evict(self, now=None):
+        """
+        Remove the expired jobs, then the least recently accessed ones while over the quota.
+
+        Returns:
+            list: Ids of the removed jobs.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            expired = [job_id for job_id, entry in self.index.items()
+                       if not entry['active'] and now - entry['last_access'] > self.ttl_seconds]
+            total = self.total_bytes - sum(self.index[job_id]['bytes'] for job_id in expired)
+            for job_id, entry in self.index.items():
+                if self.max_bytes <= 0 or total <= self.max_bytes:
+                    break
+                if not entry['active'] and job_id not in expired:
+                    expired.append(job_id)
+                    total -= entry['bytes']
+        for job_id in expired:
+            self.remove(job_id)
+        return expired
+
+    def scan(self):
+        """
+        Index the folders already on disk, using their modification time as last access.
+        """
+        job_ids = set()
+        if os.path.isdir(self.jobs_dir):
+            job_ids.update(name for name in os.listdir(self.jobs_dir) if os.path.isdir(os.path.join(self.jobs_dir, name)))
+        if os.path.isdir(self.features_dir):
+            job_ids.update(name[len(self.FEATURES_PREFIX):] for name in os.listdir(self.features_dir)
+                           if name.startswith(self.FEATURES_PREFIX))
+        found = []
+        for job_id in job_ids:
+            paths = [path for path in self.job_paths(job_id) if os.path.exists(path)]
+            found.append((max(os.path.getmtime(path) for path in paths), job_id, sum(dir_size(path) for path in paths)))
+        with self.lock:
+            # Newest first, each one ends up in front of the previous, so the oldest is first
+            for last_access, job_id, size in sorted(found, reverse=True):
+                if job_id not in self.index:
+                    self.index[job_id] = {'bytes': size, 'last_access': last_access, 'active': False}
+                    self.index.move_to_end(job_id, last=False)
+                    self.total_bytes += size
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='job-store-eviction', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        self.scan()
+        while True:
+            try:
+                self.evict()
+            except Exception as e:
+                print(f"Job eviction failed: {e}")
+            if self.stop_event.wait(self.interval):
+                return
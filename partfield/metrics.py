@@ -0,0 +1,303 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#########################
+## Stage timings and memory peaks, exposed in the Prometheus text format
+#########################
+STAGES = ['queue_wait', 'model_load', 'preprocess', 'encoder', 'face_sampling', 'pca', 'adjacency', 'clustering', 'export']
+# Bucket upper bounds of the stage durations, in seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Bucket upper bounds of the memory peaks of the jobs, in bytes
+MEMORY_BUCKETS = tuple(2 ** i * 2 ** 20 for i in range(7, 17))  # 128 MB to 64 GB
+# JSONL trace of the current job, inherited by the processes a job starts (inference, dataloader workers)
+TRACE_ENV = 'PARTFIELD_TRACE'
+
+
+class Histogram:
+    """
+    Cumulative histogram of one labelled series, as in the Prometheus exposition format.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Histograms and counters of one process, keyed by metric name and labels.
+
+    Parameters:
+        prefix (str): Prefix of every metric name.
+    """
+    def __init__(self, prefix='partfield'):
+        self.prefix = prefix
+        # name -> (type, description, buckets)
+        self.metrics = {}
+        # name -> {sorted label items: Histogram or float}
+        self.series = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.register('stage_duration_seconds', 'histogram', 'Duration of the pipeline stages', DURATION_BUCKETS)
+        self.register('job_peak_rss_bytes', 'histogram', 'Peak resident memory of a job, per process kind', MEMORY_BUCKETS)
+        self.register('job_peak_device_bytes', 'histogram', 'Peak device memory allocated by a job', MEMORY_BUCKETS)
+        self.register('jobs_total', 'counter', 'Finished jobs by status')
+
+    def register(self, name, kind, description, buckets=None):
+        self.metrics[name] = (kind, description, buckets)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            if key not in series:
+                series[key] = Histogram(self.metrics[name][2])
+            series[key].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[name][key] = self.series[name].get(key, 0) + value
+
+    def render(self):
+        """
+        Returns:
+            str: Every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        with self.lock:
+            for name, (kind, description, _) in self.metrics.items():
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {full_name} {description}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                for key, value in sorted(self.series[name].items()):
+                    if kind == 'histogram':
+                        for bound, count in zip(value.buckets, value.counts):
+                            lines.append(f"{full_name}_bucket{format_labels(key + (('le', str(bound)),))} {count}")
+                        lines.append(f"{full_name}_bucket{format_labels(key + (('le', '+Inf'),))} {value.count}")
+                        lines.append(f"{full_name}_sum{format_labels(key)} {value.sum}")
+                        lines.append(f"{full_name}_count{format_labels(key)} {value.count}")
+                    else:
+                        lines.append(f"{full_name}{format_labels(key)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(items):
+    if len(items) == 0:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+REGISTRY = MetricsRegistry()
+
+
+#########################
+## Per-job JSONL trace
+#########################
+_local = threading.local()
+
+
+def trace_file():
+    """
+    Trace of the job running in this thread: set by tracing, else inherited through TRACE_ENV.
+    """
+    return getattr(_local, 'trace_file', None) or os.environ.get(TRACE_ENV) or None
+
+
+@contextmanager
+def tracing(filename):
+    """
+    Append the events of this thread to filename, None keeps the current trace.
+    """
+    previous = getattr(_local, 'trace_file', None)
+    _local.trace_file = str(filename) if filename is not None else previous
+    try:
+        yield
+    finally:
+        _local.trace_file = previous
+
+
+def record(event):
+    """
+    Append one event to the current trace, if any. Events are single lines written with
+    O_APPEND, so that the processes of a job can share its trace.
+    """
+    filename = trace_file()
+    if filename is None:
+        return
+    event = dict(event, time=time.time(), pid=os.getpid())
+    with open(filename, 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+def observe(stage, seconds, **fields):
+    """
+    Record a stage duration in the registry of this process and in the current trace.
+    """
+    REGISTRY.observe('stage_duration_seconds', seconds, stage=stage)
+    record(dict(fields, stage=stage, seconds=seconds))
+
+
+@contextmanager
+def timed(stage, **fields):
+    """
+    Time the enclosed block as one run of stage. Also usable as a function decorator.
+    Extra fields (uid, number of clusters, ...) only go to the trace.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **fields)
+
+
+#########################
+## Memory peaks
+#########################
+def peak_rss_bytes():
+    """
+    High-water mark of the resident memory of this process, since its start or the last reset_peak_rss.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the high-water mark of peak_rss_bytes, so that a reused worker process reports the
+    peak of its current task. Only supported on Linux, elsewhere the peak stays the process one.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_device_bytes():
+    """
+    Peak device memory allocated by torch in this process, None if CUDA was never initialized.
+    """
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda.max_memory_allocated()
+
+
+def record_memory(scope, **fields):
+    """
+    Record the memory peaks of this process in the current trace, scope names the process kind
+    (inference, clustering, ...).
+    """
+    record(dict(fields, memory=scope, peak_rss_bytes=peak_rss_bytes(), peak_device_bytes=peak_device_bytes()))
+
+
+def traced_call(filename, fn, *args, **kwargs):
+    """
+    Run fn in a reused worker process with the stage timings and the memory peak of the call
+    going to the trace filename.
+    """
+    reset_peak_rss()
+    with tracing(filename):
+        result = fn(*args, **kwargs)
+        record_memory('clustering')
+    return result
+
+
+def read_trace(filename):
+    events = []
+    if filename is None or not os.path.exists(filename):
+        return events
+    with open(filename) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # Line cut by a killed process
+                pass
+    return events
+
+
+def summarize_trace(filename, registry=REGISTRY):
+    """
+    Aggregate the trace of a finished job and add to the registry what the other processes of
+    the job observed: their stage durations and the job memory peaks.
+
+    Returns:
+        dict: {'stages': {stage: total seconds}, 'peak_rss_mb': {scope: MB}, 'peak_device_mb': MB or None}
+    """
+    stages = defaultdict(float)
+    peak_rss = {}
+    peak_device = None
+    for event in read_trace(filename):
+        if 'stage' in event:
+            stages[event['stage']] += event['seconds']
+            if event['pid'] != os.getpid():
+                registry.observe('stage_duration_seconds', event['seconds'], stage=event['stage'])
+        elif 'memory' in event:
+            scope = event['memory']
+            peak_rss[scope] = max(peak_rss.get(scope, 0), event['peak_rss_bytes'])
+            if event.get('peak_device_bytes') is not None:
+                peak_device = max(peak_device or 0, event['peak_device_bytes'])
+
+    for scope, value in peak_rss.items():
+        registry.observe('job_peak_rss_bytes', value, process=scope)
+    if peak_device is not None:
+        registry.observe('job_peak_device_bytes', peak_device)
+    return {
+        'stages': {stage: round(stages[stage], 3) for stage in STAGES if stage in stages},
+        'peak_rss_mb': {scope: round(value / 2 ** 20) for scope, value in peak_rss.items()},
+        'peak_device_mb': round(peak_device / 2 ** 20) if peak_device is not None else None,
+    }
+
+
+#########################
+## Local HTTP endpoint
+#########################
+def start_metrics_server(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serve registry.render() at http://host:port/metrics from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The server, call shutdown() to stop it.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are periodic, keep them out of the server log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -13,7 +13,10 @@ import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torch_scatter import scatter_mean #, scatter_max
+try:
+    from torch_scatter import scatter_mean #, scatter_max
+except ImportError:
+    scatter_mean = None # generate_triplane_features only needs core PyTorch
 
 from .unet_3daware import setup_unet #UNetTriplane3dAware
 from .conv_pointnet import ConvPointnet
@@ -24,12 +27,51 @@ import einops
 
 from .dnnlib_util import ScopedTorchProfiler, printarr
 
+# coordinates spanning each feature plane
+PLANE_COORDS = {'xy': [0, 1], 'yz': [1, 2], 'xz': [0, 2]}
+
+def generate_triplane_features(p, c, resolution, planes=('xy', 'yz', 'xz'), padding=0.):
+    """
+    Scatter-mean point features onto several planes in one pass: a single scatter_add_ sums
+    the features, broadcast over the planes without a copy, into one B x C x n_planes x reso^2
+    fp32 buffer, with a count shared by the channels. Same result as generate_plane_features
+    for each plane.
+
+    Args:
+        p: (B,n_p,3)
+        c: (B,C,n_p)
+    Returns:
+        (B,n_planes,C,reso,reso)
+    """
+    B, c_dim, n_p = c.shape
+    n_planes = len(planes)
+
+    # normalize_coordinate + coordinate2index for the three axes at once
+    xyz = p / (1 + padding + 10e-6) + 0.5
+    xyz = torch.where(xyz >= 1, torch.full_like(xyz, 1 - 10e-6), xyz).clamp(min=0)
+    xyz = (xyz * resolution).long()
+    axes = [PLANE_COORDS[plane] for plane in planes]
+    index = xyz[:, :, [a[0] for a in axes]] + resolution * xyz[:, :, [a[1] for a in axes]] # B x n_p x n_planes
+    index = index.permute(0, 2, 1).unsqueeze(1) # B x 1 x n_planes x n_p
+
+    # accumulate in fp32 (c is only copied when it is not fp32), counts are shared by all channels
+    c = c.float().unsqueeze(2).expand(-1, -1, n_planes, -1) # B x C x n_planes x n_p, a view
+    count = c.new_zeros(B, 1, n_planes, resolution**2)
+    count.scatter_add_(3, index, c.new_ones(1, 1, 1, 1).expand(B, 1, n_planes, n_p))
+    fea_plane = c.new_zeros(B, c_dim, n_planes, resolution**2)
+    fea_plane.scatter_add_(3, index.expand(-1, c_dim, -1, -1), c)
+    fea_plane = fea_plane / count.clamp(min=1)
+    return fea_plane.reshape(B, c_dim, n_planes, resolution, resolution).transpose(1, 2)
+
 def generate_plane_features(p, c, resolution, plane='xz'):
     """
     Args:
         p: (B,3,n_p)
         c: (B,C,n_p)
     """
+    if scatter_mean is None:
+        return generate_triplane_features(p, c, resolution, planes=(plane,))[:, 0].to(c.dtype)
+
     padding = 0.
     c_dim = c.size(1)
     # acquire indices of features in plane
@@ -89,33 +131,27 @@ def softclip(x, min, max, hardness=5):
     return x
 
 
+# (x, y), (y, z), (x, z): coordinates read by the xy, yz and xz planes
+TRIPLANE_AXES = [[0, 1], [1, 2], [0, 2]]
+
 def sample_triplane_feat(feature_triplane, normalized_pos):
     '''
         normalized_pos [-1, 1]
+        The three planes are folded into the batch dimension and queried with a single grid_sample.
     '''
-    tri_plane = torch.unbind(feature_triplane, dim=1)
-
-    x_feat = F.grid_sample(
-        tri_plane[0],
-        torch.cat(
-            [normalized_pos[:, :, 0:1], normalized_pos[:, :, 1:2]],
-            dim=-1).unsqueeze(dim=1), padding_mode='border',
-        align_corners=True)
-    y_feat = F.grid_sample(
-        tri_plane[1],
-        torch.cat(
-            [normalized_pos[:, :, 1:2], normalized_pos[:, :, 2:3]],
-            dim=-1).unsqueeze(dim=1), padding_mode='border',
+    B, n_planes, C, H, W = feature_triplane.shape
+    M = normalized_pos.shape[1]
+
+    # B x M x 3 x 2 -> (B * 3) x 1 x M x 2
+    grid = normalized_pos[:, :, TRIPLANE_AXES].permute(0, 2, 1, 3).reshape(B * n_planes, 1, M, 2)
+    feat = F.grid_sample(
+        feature_triplane.reshape(B * n_planes, C, H, W),
+        grid, padding_mode='border',
         align_corners=True)
+    feat = feat.reshape(B, n_planes, C, M)
 
-    z_feat = F.grid_sample(
-        tri_plane[2],
-        torch.cat(
-            [normalized_pos[:, :, 0:1], normalized_pos[:, :, 2:3]],
-            dim=-1).unsqueeze(dim=1), padding_mode='border',
-        align_corners=True)
-    final_feat = (x_feat + y_feat + z_feat)
-    final_feat = final_feat.squeeze(dim=2).permute(0, 2, 1)  # 32dimension
+    final_feat = (feat[:, 0] + feat[:, 1] + feat[:, 2])
+    final_feat = final_feat.permute(0, 2, 1)  # 32dimension
     return final_feat
 
 
@@ -138,6 +174,7 @@ class TriPlanePC2Encoder(torch.nn.Module):
             max_logsigma: (float) Soft clip upper range for logsigm
             min_logsigma: (float)
             point_encoder_type: (str) one of ['pvcnn', 'pointnet']
+            voxel_conv: (str) 'dense' or 'sparse' convolution of the pvcnn voxel branch
             pvcnn_flatten_voxels: (bool) for pvcnn whether to reduce voxel 
                 features (instead of scattering point features)
             unet_cfg: (dict)
@@ -164,7 +201,8 @@ class TriPlanePC2Encoder(torch.nn.Module):
         # self.resample_filter=[1, 3, 3, 1]
         if cfg.point_encoder_type == 'pvcnn':
             self.pc_encoder = PVCNNEncoder(point_encoder_out_dim, 
-            device=self.device, in_channels=in_channels, use_2d_feat=use_2d_feat)  # Encode it to a volume vector.
+            device=self.device, in_channels=in_channels, use_2d_feat=use_2d_feat,
+            voxel_conv=cfg.voxel_conv)  # Encode it to a volume vector.
         elif cfg.point_encoder_type == 'pointnet':
             # TODO the pointnet was buggy, investigate
             self.pc_encoder = ConvPointnet(c_dim=point_encoder_out_dim, 
@@ -198,12 +236,9 @@ class TriPlanePC2Encoder(torch.nn.Module):
                 # Scattering from PVCNN point features
                 points_feat_ = points_feat[0]
                 # shape: batch, latent size, resolution, resolution (e.g. 16, 256, 64, 64)
-                pc_feat_1 = generate_plane_features(point_cloud_xyz, points_feat_, 
-                                                    resolution=self.z_triplane_resolution, plane='xy') 
-                pc_feat_2 = generate_plane_features(point_cloud_xyz, points_feat_,
-                                                    resolution=self.z_triplane_resolution, plane='yz') 
-                pc_feat_3 = generate_plane_features(point_cloud_xyz, points_feat_,
-                                                    resolution=self.z_triplane_resolution, plane='xz') 
+                pc_feat_planes = generate_triplane_features(point_cloud_xyz, points_feat_,
+                                                            resolution=self.z_triplane_resolution, planes=('xy', 'yz', 'xz'))
+                pc_feat_1, pc_feat_2, pc_feat_3 = torch.unbind(pc_feat_planes.to(points_feat_.dtype), dim=1)
                 pc_feat = pc_feat[0]
 
             else:
@@ -7,7 +7,7 @@ from .pv_module import SharedMLP, PVConv
 
 def create_pointnet_components(
         blocks, in_channels, with_se=False, normalize=True, eps=0,
-        width_multiplier=1, voxel_resolution_multiplier=1, scale_pvcnn=False, device='cuda'):
+        width_multiplier=1, voxel_resolution_multiplier=1, scale_pvcnn=False, device='cuda', voxel_conv='dense'):
     r, vr = width_multiplier, voxel_resolution_multiplier
     layers, concat_channels = [], 0
     for out_channels, num_blocks, voxel_resolution in blocks:
@@ -17,7 +17,8 @@ def create_pointnet_components(
         else:
             block = functools.partial(
                 PVConv, kernel_size=3, resolution=int(vr * voxel_resolution),
-                with_se=with_se, normalize=normalize, eps=eps, scale_pvcnn=scale_pvcnn, device=device)
+                with_se=with_se, normalize=normalize, eps=eps, scale_pvcnn=scale_pvcnn, device=device,
+                voxel_conv=voxel_conv)
         for _ in range(num_blocks):
             layers.append(block(in_channels, out_channels))
             in_channels = out_channels
@@ -51,7 +52,7 @@ class PCMerger(nn.Module):
 
 
 class PVCNNEncoder(nn.Module):
-    def __init__(self, pvcnn_feat_dim, device='cuda', in_channels=3, use_2d_feat=False):
+    def __init__(self, pvcnn_feat_dim, device='cuda', in_channels=3, use_2d_feat=False, voxel_conv='dense'):
         super(PVCNNEncoder, self).__init__()
         self.device = device
         self.blocks = ((pvcnn_feat_dim, 1, 32), (128, 2, 16), (256, 1, 8))
@@ -65,7 +66,7 @@ class PVCNNEncoder(nn.Module):
         layers, channels_point, concat_channels_point = create_pointnet_components(
             blocks=self.blocks, in_channels=in_channels + self.append_channel, with_se=False, normalize=False,
             width_multiplier=1, voxel_resolution_multiplier=1, scale_pvcnn=True,
-            device=device
+            device=device, voxel_conv=voxel_conv
         )
         self.encoder = nn.ModuleList(layers)#.to(self.device)
         if self.use_2d_feat:
@@ -81,8 +82,10 @@ class PVCNNEncoder(nn.Module):
         zero_padding = torch.zeros(features.shape[0], self.append_channel, features.shape[-1], device=features.device, dtype=torch.float)
         features = torch.cat([features, zero_padding], dim=1)##################
 
+        # all layers see the same coords, voxel indices are computed once per resolution
+        voxel_cache = {}
         for i in range(len(self.encoder)):
-            features, _, voxel_feature = self.encoder[i]((features, coords))
+            features, _, voxel_feature = self.encoder[i]((features, coords, voxel_cache))
             if i == 0 and mv_feat is not None:
                features = self.merger(features, mv_feat.permute(0, 2, 1), pc2pc_idx)
             out_features_list.append(features)
@@ -1,7 +1,8 @@
 import torch.nn as nn
 
 from . import functional as F
-from .voxelization import Voxelization
+from .voxelization import Voxelization, voxelize, voxel_means, is_exporting
+from .sparse_conv import sparse_voxel_layers, use_sparse_voxel_layers
 from .shared_mlp import SharedMLP
 import torch
 
@@ -11,12 +12,14 @@ __all__ = ['PVConv']
 class PVConv(nn.Module):
     def __init__(
             self, in_channels, out_channels, kernel_size, resolution, with_se=False, normalize=True, eps=0, scale_pvcnn=False,
-            device='cuda'):
+            device='cuda', voxel_conv='dense'):
         super().__init__()
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.kernel_size = kernel_size
         self.resolution = resolution
+        assert voxel_conv in ('dense', 'sparse')
+        self.voxel_conv = voxel_conv
         self.voxelization = Voxelization(resolution, normalize=normalize, eps=eps, scale_pvcnn=scale_pvcnn)
         voxel_layers = [
             nn.Conv3d(in_channels, out_channels, kernel_size, stride=1, padding=kernel_size // 2, device=device),
@@ -30,9 +33,16 @@ class PVConv(nn.Module):
         self.point_features = SharedMLP(in_channels, out_channels, device=device)
 
     def forward(self, inputs):
-        features, coords = inputs
-        voxel_features, voxel_coords = self.voxelization(features, coords)
-        voxel_features = self.voxel_layers(voxel_features)
+        features, coords = inputs[:2]
+        voxel_cache = inputs[2] if len(inputs) > 2 else None
+        voxel_coords, voxel_index = self.voxelization.get_voxel_index(coords, voxel_cache)
+        if self.voxel_conv == 'sparse' and not is_exporting() and \
+                use_sparse_voxel_layers(voxel_index, self.resolution, features.shape[0]):
+            # same output as the dense branch, convolving around the occupied voxels only
+            voxel_features = sparse_voxel_layers(self.voxel_layers, voxel_means(features, voxel_index), voxel_index,
+                                                 self.resolution, features.shape[0])
+        else:
+            voxel_features = self.voxel_layers(voxelize(features, voxel_index, self.resolution))
         devoxel_features = F.trilinear_devoxelize(voxel_features, voxel_coords, self.resolution, self.training)
         fused_features = devoxel_features + self.point_features(features)
         return fused_features, coords, voxel_features
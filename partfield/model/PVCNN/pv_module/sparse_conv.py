@@ -0,0 +1,211 @@
+import itertools
+
+import torch
+
+__all__ = ['sparse_voxel_layers', 'use_sparse_voxel_layers']
+
+# Kernel offsets in the (kd, kh, kw) order of a flattened Conv3d weight
+OFFSETS = list(itertools.product([-1, 0, 1], repeat=3))
+# Above this fraction of active voxels in the second conv the dense Conv3d is faster (CPU, see benchmarks)
+SPARSE_MAX_ACTIVE = 0.5
+
+
+class VoxelSites:
+    """
+    Sorted set of active voxels of a (b, r, r, r) grid, used as a hash table by searchsorted.
+
+    Args:
+        keys: (M,) sorted flat keys batch * r^3 + x0 * r^2 + x1 * r + x2
+    """
+    def __init__(self, keys, resolution):
+        r = resolution
+        self.keys = keys
+        self.r = r
+        self.batch = keys // (r * r * r)
+        voxel = keys % (r * r * r)
+        self.voxel = voxel
+        self.xyz = torch.stack([voxel // (r * r), (voxel // r) % r, voxel % r], dim=1)
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def lookup(self, batch, xyz):
+        """
+        Returns (index into the table, found mask) for the voxels xyz (N, 3) of batch (N,).
+        Voxels outside the grid are never found.
+        """
+        r = self.r
+        in_grid = ((xyz >= 0) & (xyz < r)).all(dim=1)
+        keys = batch * (r * r * r) + xyz[:, 0] * (r * r) + xyz[:, 1] * r + xyz[:, 2]
+        index = torch.searchsorted(self.keys, keys).clamp_(max=len(self) - 1)
+        found = in_grid & (self.keys[index] == keys)
+        return index, found, in_grid
+
+    def dilate(self):
+        """
+        Active voxels of a 3x3x3 convolution whose input is active on these voxels.
+        """
+        r = self.r
+        offsets = torch.tensor(OFFSETS, device=self.xyz.device)
+        nbr = self.xyz.unsqueeze(1) + offsets.unsqueeze(0)
+        valid = ((nbr >= 0) & (nbr < r)).all(dim=2)
+        keys = self.batch.unsqueeze(1) * (r * r * r) + nbr[..., 0] * (r * r) + nbr[..., 1] * r + nbr[..., 2]
+        return VoxelSites(torch.unique(keys[valid]), r)
+
+
+def boundary_class(xyz, resolution):
+    """
+    Which of the 27 boundary cases (low edge / interior / high edge per axis) a voxel falls in.
+    """
+    cat = (xyz > 0).long() + (xyz == resolution - 1).long()
+    return cat[:, 0] * 9 + cat[:, 1] * 3 + cat[:, 2]
+
+
+def boundary_class_tables(resolution, device):
+    """
+    Returns:
+        valid: (27 classes, 27 offsets) whether the kernel offset stays inside the grid
+        total: (27,) number of grid voxels in every class
+    """
+    cats = torch.tensor(OFFSETS, device=device) + 1
+    offsets = torch.tensor(OFFSETS, device=device)
+    valid = ~(((cats.unsqueeze(1) == 0) & (offsets.unsqueeze(0) == -1))
+              | ((cats.unsqueeze(1) == 2) & (offsets.unsqueeze(0) == 1))).any(dim=2)
+    per_axis = torch.tensor([1, resolution - 2, 1], device=device)
+    total = per_axis[cats[:, 0]] * per_axis[cats[:, 1]] * per_axis[cats[:, 2]]
+    return valid, total
+
+
+def neighbor_table(in_sites, out_sites, batch_size):
+    """
+    Rulebook of a 3x3x3 convolution from in_sites to out_sites, shape (27, M_out).
+
+    Entries index the rows of cat([in_feat (M_in), fill (b), zeros (1)]): the active input voxel,
+    the fill row of the batch for other voxels inside the grid, or the zero row for the padding.
+    """
+    m_in = len(in_sites)
+    table = []
+    for offset in OFFSETS:
+        nbr = out_sites.xyz + torch.tensor(offset, device=out_sites.xyz.device)
+        index, found, in_grid = in_sites.lookup(out_sites.batch, nbr)
+        index = torch.where(found, index, torch.where(in_grid, m_in + out_sites.batch, m_in + batch_size))
+        table.append(index)
+    return torch.stack(table)
+
+
+def sparse_conv3d(in_feat, table, conv, fill):
+    """
+    Gather-based 3x3x3 convolution on the output voxels of table (see neighbor_table).
+    """
+    weight = conv.weight.to(in_feat.dtype)
+    weight = weight.reshape(weight.shape[0], weight.shape[1], -1)
+    rows = torch.cat([in_feat, fill, in_feat.new_zeros(1, in_feat.shape[1])])
+    out = in_feat.new_zeros(table.shape[1], weight.shape[0])
+    if conv.bias is not None:
+        out += conv.bias.to(in_feat.dtype)
+    for k in range(len(OFFSETS)):
+        out.addmm_(torch.index_select(rows, 0, table[k]), weight[:, :, k].t())
+    return out
+
+
+def build_rulebook(voxel_index, resolution, batch_size):
+    """
+    Active voxels and neighbor tables of the two convolutions, which only depend on the occupied
+    voxels. Stored in voxel_index, so that layers sharing a resolution build it once.
+    """
+    if 'rulebook' not in voxel_index:
+        r = resolution
+        occupied = VoxelSites(voxel_index['batch'] * (r * r * r) + voxel_index['voxel'], r)
+        sites1 = occupied.dilate()
+        sites2 = sites1.dilate()
+        class2 = boundary_class(sites2.xyz, r)
+        grid = torch.arange(r * r * r, device=occupied.keys.device)
+        voxel_index['rulebook'] = {
+            'sites1': sites1,
+            'sites2': sites2,
+            'table1': neighbor_table(occupied, sites1, batch_size),
+            'table2': neighbor_table(sites1, sites2, batch_size),
+            'count1': torch.bincount(sites1.batch, minlength=batch_size),
+            'count2': torch.bincount(sites2.batch * 27 + class2, minlength=batch_size * 27).reshape(batch_size, 27),
+            'grid_class': boundary_class(torch.stack([grid // (r * r), (grid // r) % r, grid % r], dim=1), r),
+        }
+    return voxel_index['rulebook']
+
+
+def use_sparse_voxel_layers(voxel_index, resolution, batch_size):
+    """
+    Whether the grid is sparse enough for sparse_voxel_layers to pay off.
+    """
+    rulebook = build_rulebook(voxel_index, resolution, batch_size)
+    return len(rulebook['sites2']) <= SPARSE_MAX_ACTIVE * batch_size * resolution ** 3
+
+
+def instance_norm_stats(site_values, site_batch, rest_values, rest_counts, n_voxels, eps):
+    """
+    InstanceNorm statistics over the full grid from the active voxels and the constant values
+    rest_values (b, K, C) taken by rest_counts (b, K) inactive voxels.
+    """
+    b = rest_values.shape[0]
+    total = site_values.new_zeros(b, site_values.shape[1]).index_add_(0, site_batch, site_values)
+    total += (rest_counts.unsqueeze(2) * rest_values).sum(dim=1)
+    mean = total / n_voxels
+    sq = site_values.new_zeros(b, site_values.shape[1]).index_add_(0, site_batch, (site_values - mean[site_batch]) ** 2)
+    sq += (rest_counts.unsqueeze(2) * (rest_values - mean.unsqueeze(1)) ** 2).sum(dim=1)
+    return mean, torch.rsqrt(sq / n_voxels + eps)
+
+
+def normalize(x, mean, rstd, norm):
+    x = (x - mean) * rstd
+    if norm.affine:
+        x = x * norm.weight + norm.bias
+    return x
+
+
+def sparse_voxel_layers(voxel_layers, vox_feature, voxel_index, resolution, batch_size):
+    """
+    Runs the PVConv voxel branch (Conv3d, InstanceNorm3d, LeakyReLU, twice) from the occupied
+    voxels only and returns the same dense (b, c, r, r, r) output as voxel_layers on the dense grid.
+
+    The convolutions are evaluated on the occupied voxels dilated once (first conv) and twice
+    (second conv). Every other voxel takes a value known in closed form: the first conv bias
+    there, and for the second conv a per boundary-class constant, which keeps the InstanceNorm
+    statistics over the full grid exact.
+
+    Args:
+        voxel_layers: the dense nn.Sequential of PVConv, its weights are used as is
+        vox_feature: (n_occupied, c) mean features of the occupied voxels
+        voxel_index: from Voxelization.get_voxel_index
+    """
+    conv1, norm1, act1, conv2, norm2, act2 = voxel_layers
+    r = resolution
+    b = batch_size
+    n_voxels = r * r * r
+    dtype = vox_feature.dtype
+    device = vox_feature.device
+    rulebook = build_rulebook(voxel_index, r, b)
+    sites1, sites2 = rulebook['sites1'], rulebook['sites2']
+
+    # First block: outside sites1 the conv only sees zeros and outputs its bias
+    y1 = sparse_conv3d(vox_feature, rulebook['table1'], conv1, vox_feature.new_zeros(b, vox_feature.shape[1]))
+    bias1 = conv1.bias.to(dtype) if conv1.bias is not None else y1.new_zeros(y1.shape[1])
+    rest1 = bias1.reshape(1, 1, -1).expand(b, 1, -1)
+    count1 = (n_voxels - rulebook['count1']).to(dtype).unsqueeze(1)
+    mean1, rstd1 = instance_norm_stats(y1, sites1.batch, rest1, count1, n_voxels, norm1.eps)
+    h1 = act1(normalize(y1, mean1[sites1.batch], rstd1[sites1.batch], norm1))
+    fill1 = act1(normalize(rest1[:, 0], mean1, rstd1, norm1))
+
+    # Second block: outside sites2 the conv sees fill1 inside the grid and zero padding outside
+    y2 = sparse_conv3d(h1, rulebook['table2'], conv2, fill1)
+    weight2 = conv2.weight.to(dtype).reshape(conv2.weight.shape[0], conv2.weight.shape[1], -1)
+    valid, total = boundary_class_tables(r, device)
+    rest2 = torch.einsum('ck,bok->bco', valid.to(dtype), torch.einsum('bi,oik->bok', fill1, weight2))
+    if conv2.bias is not None:
+        rest2 = rest2 + conv2.bias.to(dtype)
+    count2 = (total.unsqueeze(0) - rulebook['count2']).to(dtype)
+    mean2, rstd2 = instance_norm_stats(y2, sites2.batch, rest2, count2, n_voxels, norm2.eps)
+    h2 = act2(normalize(y2, mean2[sites2.batch], rstd2[sites2.batch], norm2))
+    rest2 = act2(normalize(rest2, mean2.unsqueeze(1), rstd2.unsqueeze(1), norm2))
+
+    dense = rest2.permute(0, 2, 1)[:, :, rulebook['grid_class']]
+    dense[sites2.batch, :, sites2.voxel] = h2
+    return dense.view(b, -1, r, r, r)
@@ -21,6 +21,81 @@ def my_voxelization(features, coords, resolution):
     vox_feature = out_feature[:, :-1, :] / cnt
     return vox_feature.view(b, c, resolution, resolution, resolution)
 
+
+def build_voxel_index(vox_coords, resolution):
+    """
+    Sort the voxel of every point once so that several layers can average into the same voxels.
+
+    Args:
+        vox_coords: (b, 3, n) integer-valued voxel coordinates
+    Returns:
+        dict with the occupied voxels (batch id, flat voxel id), the occupied voxel of every
+        point (inverse, flattened over the batch) and the number of points per occupied voxel
+    """
+    b, _, n = vox_coords.shape
+    r = resolution
+    r3 = r * r * r
+    indices = (vox_coords[:, 0] * (r * r) + vox_coords[:, 1] * r + vox_coords[:, 2]).long()
+    indices = indices + torch.arange(b, device=indices.device).unsqueeze(1) * r3
+    occupied, inverse, counts = torch.unique(indices.reshape(-1), sorted=True, return_inverse=True, return_counts=True)
+    return {
+        'batch': occupied // r3,
+        'voxel': occupied % r3,
+        'inverse': inverse,
+        'counts': counts,
+    }
+
+
+def voxel_means(features, voxel_index):
+    """
+    Average the point features falling into every occupied voxel of voxel_index, shape (n_occupied, c).
+    """
+    b, c, _ = features.shape
+    feats = features.permute(0, 2, 1).reshape(-1, c).float()
+    n_occupied = voxel_index['counts'].shape[0]
+    vox_feature = feats.new_zeros(n_occupied, c).index_add_(0, voxel_index['inverse'], feats)
+    return vox_feature / voxel_index['counts'].unsqueeze(1).to(vox_feature.dtype)
+
+
+def sparse_voxelization(features, voxel_index, resolution):
+    """
+    Same result as my_voxelization, but averages into the occupied voxels only and writes
+    them into the dense grid once, instead of scattering every channel into a (c+1) x r^3 buffer.
+    """
+    b, c, _ = features.shape
+    vox_feature = voxel_means(features, voxel_index)
+    dense = vox_feature.new_zeros(b, c, resolution * resolution * resolution)
+    dense[voxel_index['batch'], :, voxel_index['voxel']] = vox_feature
+    return dense.view(b, c, resolution, resolution, resolution)
+
+
+def scatter_voxelization(features, flat_index, resolution):
+    """
+    Same result as sparse_voxelization with plain scatter_add_ over the dense grid, used in
+    traced / exported graphs: ONNX has ScatterElements(add), but neither torch.unique with
+    inverse nor the multi-index writes of the sparse path.
+
+    Args:
+        flat_index: (b, n) flat voxel index of every point
+    """
+    b, c, n = features.shape
+    r3 = resolution * resolution * resolution
+    index = flat_index.unsqueeze(1)
+    sums = features.new_zeros(b, c, r3, dtype=torch.float).scatter_add_(2, index.expand(-1, c, -1), features.float())
+    counts = features.new_zeros(b, 1, r3, dtype=torch.float).scatter_add_(2, index, features.new_ones(b, 1, n, dtype=torch.float))
+    return (sums / counts.clamp(min=1)).view(b, c, resolution, resolution, resolution)
+
+
+def voxelize(features, voxel_index, resolution):
+    if 'flat' in voxel_index:
+        return scatter_voxelization(features, voxel_index['flat'], resolution)
+    return sparse_voxelization(features, voxel_index, resolution)
+
+
+def is_exporting():
+    return torch.jit.is_tracing() or torch.onnx.is_in_onnx_export()
+
+
 class Voxelization(nn.Module):
     def __init__(self, resolution, normalize=True, eps=0, scale_pvcnn=False):
         super().__init__()
@@ -30,7 +105,7 @@ class Voxelization(nn.Module):
         self.scale_pvcnn = scale_pvcnn
         assert not normalize
 
-    def forward(self, features, coords):
+    def voxelize_coords(self, coords):
         with torch.no_grad():
             coords = coords.detach()
 
@@ -43,7 +118,24 @@ class Voxelization(nn.Module):
                     norm_coords = (norm_coords + 1) / 2.0
             norm_coords = torch.clamp(norm_coords * self.r, 0, self.r - 1)
             vox_coords = torch.round(norm_coords)
-        new_vox_feat = my_voxelization(features, vox_coords, self.r)
+            if is_exporting():
+                r = self.r
+                voxel_index = {'flat': (vox_coords[:, 0] * (r * r) + vox_coords[:, 1] * r + vox_coords[:, 2]).long()}
+            else:
+                voxel_index = build_voxel_index(vox_coords, self.r)
+        return norm_coords, voxel_index
+
+    def get_voxel_index(self, coords, voxel_cache=None):
+        # Layers that share a resolution and coords (see PVCNNEncoder) reuse the sorted voxel index
+        if voxel_cache is None:
+            return self.voxelize_coords(coords)
+        if self.r not in voxel_cache:
+            voxel_cache[self.r] = self.voxelize_coords(coords)
+        return voxel_cache[self.r]
+
+    def forward(self, features, coords, voxel_cache=None):
+        norm_coords, voxel_index = self.get_voxel_index(coords, voxel_cache)
+        new_vox_feat = voxelize(features, voxel_index, self.r)
         return new_vox_feat, norm_coords
 
     def extra_repr(self):
@@ -15,41 +15,26 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from functools import partial
 
-def project_onto_planes(planes, coordinates):
-    """
-    Does a projection of a 3D point onto a batch of 2D planes,
-    returning 2D plane coordinates.
+# Plane axes of the (x, y), (x, z) and (z, y) planes: their projections are two coordinate columns
+PLANE_AXES_INDEX = [[0, 1], [0, 2], [2, 1]]
 
-    Takes plane axes of shape n_planes, 3, 3
-    # Takes coordinates of shape N, M, 3
-    # returns projections of shape N*n_planes, M, 2
+def sample_from_planes(plane_features, coordinates, mode='bilinear', padding_mode='zeros', box_warp=None):
     """
-    N, M, C = coordinates.shape
-    n_planes, _, _ = planes.shape
-    coordinates = coordinates.unsqueeze(1).expand(-1, n_planes, -1, -1).reshape(N*n_planes, M, 3)
-    inv_planes = torch.linalg.inv(planes).unsqueeze(0).expand(N, -1, -1, -1).reshape(N*n_planes, 3, 3)
-    projections = torch.bmm(coordinates, inv_planes)
-    return projections[..., :2]
+    Sample N x n_planes x C x H x W plane features at N x M x 3 coordinates, returns N x n_planes x M x C.
 
-def sample_from_planes(plane_features, coordinates, mode='bilinear', padding_mode='zeros', box_warp=None):
-    plane_axes = torch.tensor([[[1, 0, 0],
-                                [0, 1, 0],
-                                [0, 0, 1]],
-                                [[1, 0, 0],
-                                [0, 0, 1],
-                                [0, 1, 0]],
-                                [[0, 0, 1],
-                                [0, 1, 0],
-                                [1, 0, 0]]], dtype=torch.float32).cuda()
-    
+    The projection is a gather of two coordinate columns per plane (PLANE_AXES_INDEX), so no
+    plane matrices are built or inverted per call and the function runs on any device.
+    """
     assert padding_mode == 'zeros'
     N, n_planes, C, H, W = plane_features.shape
     _, M, _ = coordinates.shape
     plane_features = plane_features.view(N*n_planes, C, H, W)
 
-    projected_coordinates = project_onto_planes(plane_axes, coordinates).unsqueeze(1)
+    # N x M x n_planes x 2 -> N*n_planes x 1 x M x 2
+    projected_coordinates = coordinates[:, :, PLANE_AXES_INDEX].permute(0, 2, 1, 3).reshape(N*n_planes, 1, M, 2)
     output_features = torch.nn.functional.grid_sample(plane_features, projected_coordinates.float(), mode=mode, padding_mode=padding_mode, align_corners=False).permute(0, 3, 2, 1).reshape(N, n_planes, M, C)
     return output_features
 
@@ -62,16 +47,47 @@ def get_grid_coord(grid_size = 256, align_corners=False):
     coordinates = torch.stack((i, j, k), dim=-1).reshape(-1, 3)
     return coordinates
 
+ATTENTION_IMPLS = ['mha', 'sdpa', 'chunked']
+
+def self_attention(attn: nn.MultiheadAttention, x: torch.Tensor, impl: str = 'sdpa', chunk_size: int = 1024):
+    """
+    Self-attention with the projection weights of attn, computed by F.scaled_dot_product_attention
+    (fused flash / memory-efficient kernels where available) instead of nn.MultiheadAttention.
+
+    impl 'chunked' attends chunk_size queries at a time, so that at most chunk_size x L attention
+    scores per head are alive whatever kernel is picked.
+    """
+    N, L, D = x.shape
+    H = attn.num_heads
+    q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+    q, k, v = [t.reshape(N, L, H, D // H).transpose(1, 2) for t in (q, k, v)]  # [N, H, L, D/H]
+    dropout_p = attn.dropout if attn.training else 0.
+
+    if impl == 'chunked':
+        out = torch.cat([F.scaled_dot_product_attention(q[:, :, i:i + chunk_size], k, v, dropout_p=dropout_p)
+                         for i in range(0, L, chunk_size)], dim=2)
+    else:
+        out = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+    out = out.transpose(1, 2).reshape(N, L, D)
+    return F.linear(out, attn.out_proj.weight, attn.out_proj.bias)
+
 class BasicBlock(nn.Module):
     """
     Transformer block that is in its simplest form.
     Designed for PF-LRM architecture.
+
+    attn_impl selects the attention computation ('mha', 'sdpa' or 'chunked', see self_attention),
+    all three share the nn.MultiheadAttention parameters so checkpoints load unchanged.
     """
     # Block contains a self-attention layer and an MLP
     def __init__(self, inner_dim: int, num_heads: int, eps: float,
                  attn_drop: float = 0., attn_bias: bool = False,
-                 mlp_ratio: float = 4., mlp_drop: float = 0.):
+                 mlp_ratio: float = 4., mlp_drop: float = 0.,
+                 attn_impl: str = 'mha', attn_chunk_size: int = 1024):
         super().__init__()
+        assert attn_impl in ATTENTION_IMPLS, f"Unsupported attention: {attn_impl}"
+        self.attn_impl = attn_impl
+        self.attn_chunk_size = attn_chunk_size
         self.norm1 = nn.LayerNorm(inner_dim, eps=eps)
         self.self_attn = nn.MultiheadAttention(
             embed_dim=inner_dim, num_heads=num_heads,
@@ -88,7 +104,10 @@ class BasicBlock(nn.Module):
     def forward(self, x):
         # x: [N, L, D]
         before_sa = self.norm1(x)
-        x = x + self.self_attn(before_sa, before_sa, before_sa, need_weights=False)[0]
+        if self.attn_impl == 'mha':
+            x = x + self.self_attn(before_sa, before_sa, before_sa, need_weights=False)[0]
+        else:
+            x = x + self_attention(self.self_attn, before_sa, self.attn_impl, self.attn_chunk_size)
         x = x + self.mlp(self.norm2(x))
         return x
         
@@ -132,9 +151,11 @@ class TransformerDecoder(nn.Module):
     def __init__(self, block_type: str,
                  num_layers: int, num_heads: int,
                  inner_dim: int, cond_dim: int = None,
-                 eps: float = 1e-6):
+                 eps: float = 1e-6, attn_impl: str = 'mha', attn_chunk_size: int = 1024):
         super().__init__()
         self.block_type = block_type
+        self.attn_impl = attn_impl
+        self.attn_chunk_size = attn_chunk_size
         self.layers = nn.ModuleList([
             self._block_fn(inner_dim, cond_dim)(
                 num_heads=num_heads,
@@ -157,7 +178,8 @@ class TransformerDecoder(nn.Module):
     def _block_fn(self, inner_dim, cond_dim):
         assert inner_dim is not None, f"inner_dim must always be specified"
         if self.block_type == 'basic':
-            return partial(BasicBlock, inner_dim=inner_dim)
+            return partial(BasicBlock, inner_dim=inner_dim,
+                           attn_impl=self.attn_impl, attn_chunk_size=self.attn_chunk_size)
         elif self.block_type == 'cond':
             assert cond_dim is not None, f"Condition dimension must be specified for ConditionBlock"
             return partial(ConditionBlock, inner_dim=inner_dim, cond_dim=cond_dim)
@@ -254,7 +276,8 @@ class TriplaneTransformer(nn.Module):
     Full model of the basic single-view large reconstruction model.
     """
     def __init__(self, input_dim: int, transformer_dim: int, transformer_layers: int, transformer_heads: int,
-                 triplane_low_res: int, triplane_high_res: int, triplane_dim: int):
+                 triplane_low_res: int, triplane_high_res: int, triplane_dim: int,
+                 attn_impl: str = 'mha', attn_chunk_size: int = 1024):
         super().__init__()
         
         # attributes
@@ -268,6 +291,7 @@ class TriplaneTransformer(nn.Module):
             block_type='basic',
             num_layers=transformer_layers, num_heads=transformer_heads,
             inner_dim=transformer_dim,
+            attn_impl=attn_impl, attn_chunk_size=attn_chunk_size,
         )
       
         self.downsampler = nn.Sequential(
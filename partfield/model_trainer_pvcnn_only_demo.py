@@ -14,17 +14,56 @@ import numpy as np
 import h5py
 import torch.distributed as dist
 from partfield.model.PVCNN.encoder_pc import TriPlanePC2Encoder, sample_triplane_feat
+from partfield.sampling import sample_points_on_triangles, make_generator
+from partfield.utils import claim_owner, claim_uid, release_uid, AsyncWriter, export_input_mesh, resident_memory_mb
+from partfield.quantization import quantize_dynamic_int8
+from partfield import metrics
 import json
 import gc
 import time
 from plyfile import PlyData, PlyElement
 
 
+PCA_FIT_SAMPLES = 200000
+
+def pca_colors(point_feat, seed=0, n_fit=PCA_FIT_SAMPLES, block_size=1000000):
+    """
+    Map features to RGB with a 3-component PCA of the L2-normalized features.
+
+    The PCA is fit on at most n_fit rows and applied block by block, so point_feat can be
+    a memory-mapped array larger than RAM.
+
+    Returns:
+        np.ndarray: (N, 3) uint8 colors.
+    """
+    from sklearn.decomposition import PCA
+    n = point_feat.shape[0]
+    if n > n_fit:
+        fit_idx = np.sort(np.random.default_rng(seed).choice(n, n_fit, replace=False))
+    else:
+        fit_idx = slice(None)
+    fit_data = np.asarray(point_feat[fit_idx], dtype=np.float32)
+    pca = PCA(n_components=3)
+    pca.fit(fit_data / np.linalg.norm(fit_data, axis=-1, keepdims=True))
+
+    data_reduced = np.empty((n, 3), dtype=np.float32)
+    for start in range(0, n, block_size):
+        block = np.asarray(point_feat[start:start + block_size], dtype=np.float32)
+        data_reduced[start:start + block_size] = pca.transform(block / np.linalg.norm(block, axis=-1, keepdims=True))
+    data_reduced = (data_reduced - data_reduced.min()) / (data_reduced.max() - data_reduced.min())
+    return (data_reduced * 255).astype(np.uint8)
+
+
 class Model(pl.LightningModule):
     def __init__(self, cfg):
         super().__init__()
+        # model_load covers building the model, restoring the checkpoint and quantizing it
+        self.load_start = time.perf_counter()
 
-        self.save_hyperparameters()
+        # Inference builds skip the pickled hparams, the decoders, the losses and the 256^3 grid_coord
+        self.inference_only = cfg.inference_only
+        if not self.inference_only:
+            self.save_hyperparameters()
         self.cfg = cfg
         self.automatic_optimization = False
         self.triplane_resolution = cfg.triplane_resolution
@@ -37,21 +76,28 @@ class Model(pl.LightningModule):
             triplane_low_res=32,
             triplane_high_res=128,
             triplane_dim=cfg.triplane_channels_high,
+            attn_impl=cfg.triplane_attention.impl,
+            attn_chunk_size=cfg.triplane_attention.chunk_size,
         )
-        self.sdf_decoder = VanillaMLP(input_dim=64,
-                                      output_dim=1, 
-                                      out_activation="tanh", 
-                                      n_neurons=64, #64
-                                      n_hidden_layers=6) #6
+        if not self.inference_only:
+            self.sdf_decoder = VanillaMLP(input_dim=64,
+                                          output_dim=1, 
+                                          out_activation="tanh", 
+                                          n_neurons=64, #64
+                                          n_hidden_layers=6) #6
         self.use_pvcnn = cfg.use_pvcnnonly
         self.use_2d_feat = cfg.use_2d_feat
         if self.use_pvcnn:
             self.pvcnn = TriPlanePC2Encoder(
                 cfg.pvcnn,
-                device="cuda",
+                device="cuda" if torch.cuda.is_available() else "cpu",
                 shape_min=-1, 
                 shape_length=2,
                 use_2d_feat=self.use_2d_feat) #.cuda()
+        self.writer = None
+        if self.inference_only:
+            return
+
         self.logit_scale = nn.Parameter(torch.tensor([1.0], requires_grad=True))
         self.grid_coord = get_grid_coord(256)
         self.mse_loss = torch.nn.MSELoss()
@@ -64,13 +110,37 @@ class Model(pl.LightningModule):
                                 n_neurons=64, #64
                                 n_hidden_layers=6) #6
 
+    def inference_state_dict(self, state_dict):
+        """
+        Drop the checkpoint entries of modules that an inference build does not construct.
+        """
+        keys = set(self.state_dict().keys())
+        dropped = [k for k in state_dict if k not in keys]
+        if len(dropped) > 0:
+            print(f"Skipping {len(dropped)} checkpoint entries unused for inference")
+        return {k: v for k, v in state_dict.items() if k in keys}
+
+    def on_load_checkpoint(self, checkpoint):
+        if self.inference_only:
+            checkpoint['state_dict'] = self.inference_state_dict(checkpoint['state_dict'])
+
+    def get_shard(self):
+        # Shards given on the command line are split further across the DDP ranks of this run
+        rank, world_size = 0, 1
+        if self._trainer is not None:
+            rank, world_size = self.trainer.global_rank, self.trainer.world_size
+        shard_index = self.cfg.dataset.shard_index * world_size + rank
+        num_shards = self.cfg.dataset.num_shards * world_size
+        return shard_index, num_shards
+
     def predict_dataloader(self):
+        shard_index, num_shards = self.get_shard()
         if self.cfg.remesh_demo:
-            dataset = Demo_Remesh_Dataset(self.cfg)        
+            dataset = Demo_Remesh_Dataset(self.cfg, shard_index=shard_index, num_shards=num_shards)
         elif self.cfg.correspondence_demo:
             dataset = Correspondence_Demo_Dataset(self.cfg)
         else:
-            dataset = Demo_Dataset(self.cfg)
+            dataset = Demo_Dataset(self.cfg, shard_index=shard_index, num_shards=num_shards)
 
         dataloader = DataLoader(dataset, 
                             num_workers=self.cfg.dataset.val_num_workers,
@@ -82,6 +152,62 @@ class Model(pl.LightningModule):
         return dataloader           
 
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # Mesh arrays stay on the host, predict_step moves them to the device one block at a time
+        host = {k: batch.pop(k) for k in ('vertices', 'faces', 'input_vertices', 'input_faces', 'uv_coords', 'splat_index') if k in batch}
+        batch = super().transfer_batch_to_device(batch, device, dataloader_idx)
+        batch.update(host)
+        return batch
+
+    def get_writer(self):
+        if self.writer is None:
+            self.writer = AsyncWriter()
+        return self.writer
+
+    def on_predict_start(self):
+        # The checkpoint is loaded by now, quantized modules would not accept its fp32 state dict
+        if self.cfg.quantize == 'dynamic_int8':
+            quantize_dynamic_int8(self)
+        metrics.observe('model_load', time.perf_counter() - self.load_start)
+        print(f"Resident memory with the checkpoint loaded: {resident_memory_mb():.0f} MB")
+
+    def on_predict_end(self):
+        # Make sure every input artifact is on disk before the run exits
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def stream_face_features(self, part_planes, vertices, faces, n_point_per_face, out):
+        """
+        Average the triplane features of n_point_per_face random points inside every face.
+
+        Faces are processed in blocks of n_sample_each // n_point_per_face: the block's triangles
+        are gathered on the host, sampled and queried on the device, and the block means are
+        written to out (F, C). Peak memory only depends on the block size.
+        """
+        device = part_planes.device
+        face_block = max(1, self.cfg.n_sample_each // n_point_per_face)
+        generator = make_generator(self.cfg.seed, device)
+        for start in range(0, faces.shape[0], face_block):
+            triangles = vertices[faces[start:start + face_block].reshape(-1)].reshape(-1, 3, 3)
+            triangles = triangles.to(device=device, dtype=torch.float32, non_blocking=True)
+            points = sample_points_on_triangles(triangles, n_point_per_face,
+                                                generator=generator, stratified=self.cfg.stratified_sampling)
+            sampled_feature = sample_triplane_feat(part_planes, points.reshape(1, -1, 3))
+            sampled_feature = sampled_feature.reshape(-1, n_point_per_face, sampled_feature.shape[-1]).mean(dim=1)
+            out[start:start + face_block] = sampled_feature.float().cpu().numpy()
+
+    def stream_vertex_features(self, part_planes, vertices, out):
+        """
+        Query the triplane features at the vertices in blocks of n_sample_each, writing into out (V, C).
+        """
+        device = part_planes.device
+        n_sample_each = self.cfg.n_sample_each
+        for start in range(0, vertices.shape[0], n_sample_each):
+            points = vertices[start:start + n_sample_each].to(device=device, dtype=torch.float32, non_blocking=True)
+            sampled_feature = sample_triplane_feat(part_planes, points.reshape(1, -1, 3))
+            out[start:start + n_sample_each] = sampled_feature[0].float().cpu().numpy()
+
     @torch.no_grad()
     def predict_step(self, batch, batch_idx):
         save_dir = f"exp_results/{self.cfg.result_name}"
@@ -102,36 +228,66 @@ class Model(pl.LightningModule):
             print("Already processed "+uid)
             return
 
+        ### Skip if another process is working on this model
+        claim_dir = f"{save_dir}/claims"
+        if not claim_uid(claim_dir, uid, claim_owner(), self.cfg.claim_timeout):
+            print("Claimed by another process "+uid)
+            return
+
         N = batch['pc'].shape[0]
         assert N == 1
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+        ### Export the input mesh read back by clustering, off the critical path
+        if not self.cfg.is_pc:
+            if 'input_vertices' in batch:
+                input_vertices, input_faces = batch['input_vertices'][0], batch['input_faces'][0]
+            else:
+                input_vertices, input_faces = batch['vertices'][0], batch['faces'][0]
+            uv_coords = batch['uv_coords'][0].numpy() if 'uv_coords' in batch else None
+            uv_type = batch['uv_type'][0] if 'uv_type' in batch else None
+            self.get_writer().submit(export_input_mesh, save_dir, uid, view_id,
+                                     input_vertices.numpy(), input_faces.numpy(), uv_coords, uv_type)
 
         if self.use_2d_feat: 
             print("ERROR. Dataloader not implemented with input 2d feat.")
             exit()
         else:
-            pc_feat = self.pvcnn(batch['pc'], batch['pc'])
+            with metrics.timed('encoder', uid=uid):
+                pc_feat = self.pvcnn(batch['pc'], batch['pc'])
 
-        planes = pc_feat
-        planes = self.triplane_transformer(planes)
-        sdf_planes, part_planes = torch.split(planes, [64, planes.shape[2] - 64], dim=2)
+                planes = pc_feat
+                planes = self.triplane_transformer(planes)
+                sdf_planes, part_planes = torch.split(planes, [64, planes.shape[2] - 64], dim=2)
+                if part_planes.is_cuda:
+                    # Kernels run asynchronously, wait for them to time the encoder alone
+                    torch.cuda.synchronize()
 
         if self.cfg.is_pc:
-            tensor_vertices = batch['pc'].reshape(1, -1, 3).cuda().to(torch.float16)
-            point_feat = sample_triplane_feat(part_planes, tensor_vertices) # N, M, C
-            point_feat = point_feat.cpu().detach().numpy().reshape(-1, 448)
+            with metrics.timed('face_sampling', uid=uid):
+                tensor_vertices = batch['pc'].reshape(1, -1, 3).to(part_planes.device, torch.float16 if part_planes.is_cuda else torch.float32)
+                point_feat = sample_triplane_feat(part_planes, tensor_vertices) # N, M, C
+                point_feat = point_feat.cpu().detach().numpy().reshape(-1, 448)
 
-            np.save(f'{save_dir}/part_feat_{uid}_{view_id}.npy', point_feat)
+            with metrics.timed('export', uid=uid):
+                np.save(f'{save_dir}/part_feat_{uid}_{view_id}.npy', point_feat)
             print(f"Exported part_feat_{uid}_{view_id}.npy")
 
+            ### Splat inputs are pruned: point_feat[splat_index] gives the feature of every splat in the file
+            if 'splat_index' in batch:
+                np.save(f'{save_dir}/splat_index_{uid}_{view_id}.npy', batch['splat_index'][0].numpy())
+
             ###########
-            from sklearn.decomposition import PCA
-            data_scaled = point_feat / np.linalg.norm(point_feat, axis=-1, keepdims=True)
+            with metrics.timed('pca', uid=uid):
+                from sklearn.decomposition import PCA
+                data_scaled = point_feat / np.linalg.norm(point_feat, axis=-1, keepdims=True)
 
-            pca = PCA(n_components=3)
+                pca = PCA(n_components=3)
 
-            data_reduced = pca.fit_transform(data_scaled)
-            data_reduced = (data_reduced - data_reduced.min()) / (data_reduced.max() - data_reduced.min())
-            colors_255 = (data_reduced * 255).astype(np.uint8)
+                data_reduced = pca.fit_transform(data_scaled)
+                data_reduced = (data_reduced - data_reduced.min()) / (data_reduced.max() - data_reduced.min())
+                colors_255 = (data_reduced * 255).astype(np.uint8)
 
             points = batch['pc'].squeeze().detach().cpu().numpy()
 
@@ -140,17 +296,18 @@ class Model(pl.LightningModule):
             else:
                 assert colors_255.shape == points.shape, "Colors must have the same shape as points"
             
-            # Convert to structured array for PLY format
-            vertex_data = np.array(
-                [(*point, *color) for point, color in zip(points, colors_255)],
-                dtype=[("x", "f4"), ("y", "f4"), ("z", "f4"), ("red", "u1"), ("green", "u1"), ("blue", "u1")]
-            )
-
-            # Create PLY element
-            el = PlyElement.describe(vertex_data, "vertex")
-            # Write to file
-            filename = f'{save_dir}/feat_pca_{uid}_{view_id}.ply'
-            PlyData([el], text=True).write(filename)
+            with metrics.timed('export', uid=uid):
+                # Convert to structured array for PLY format
+                vertex_data = np.array(
+                    [(*point, *color) for point, color in zip(points, colors_255)],
+                    dtype=[("x", "f4"), ("y", "f4"), ("z", "f4"), ("red", "u1"), ("green", "u1"), ("blue", "u1")]
+                )
+
+                # Create PLY element
+                el = PlyElement.describe(vertex_data, "vertex")
+                # Write to file
+                filename = f'{save_dir}/feat_pca_{uid}_{view_id}.ply'
+                PlyData([el], text=True).write(filename)
             print(f"Saved PLY file: {filename}")
             ############
         
@@ -158,70 +315,37 @@ class Model(pl.LightningModule):
             use_cuda_version = True
             if use_cuda_version:
 
-                def sample_points(vertices, faces, n_point_per_face):
-                    # Generate random barycentric coordinates
-                    # borrowed from Kaolin https://github.com/NVIDIAGameWorks/kaolin/blob/master/kaolin/ops/mesh/trianglemesh.py#L43
-                    n_f = faces.shape[0]
-                    u = torch.sqrt(torch.rand((n_f, n_point_per_face, 1),
-                                                device=vertices.device,
-                                                dtype=vertices.dtype))
-                    v = torch.rand((n_f, n_point_per_face, 1),
-                                    device=vertices.device,
-                                    dtype=vertices.dtype)
-                    w0 = 1 - u
-                    w1 = u * (1 - v)
-                    w2 = u * v
-
-                    face_v_0 = torch.index_select(vertices, 0, faces[:, 0].reshape(-1))
-                    face_v_1 = torch.index_select(vertices, 0, faces[:, 1].reshape(-1))
-                    face_v_2 = torch.index_select(vertices, 0, faces[:, 2].reshape(-1))
-                    points = w0 * face_v_0.unsqueeze(dim=1) + w1 * face_v_1.unsqueeze(dim=1) + w2 * face_v_2.unsqueeze(dim=1)
-                    return points
-
-                def sample_and_mean_memory_save_version(part_planes, tensor_vertices, n_point_per_face):
-                    n_sample_each = self.cfg.n_sample_each # we iterate over this to avoid OOM
-                    n_v = tensor_vertices.shape[1]
-                    n_sample = n_v // n_sample_each + 1
-                    all_sample = []
-                    for i_sample in range(n_sample):
-                        sampled_feature = sample_triplane_feat(part_planes, tensor_vertices[:, i_sample * n_sample_each: i_sample * n_sample_each + n_sample_each,])
-                        assert sampled_feature.shape[1] % n_point_per_face == 0
-                        sampled_feature = sampled_feature.reshape(1, -1, n_point_per_face, sampled_feature.shape[-1])
-                        sampled_feature = torch.mean(sampled_feature, axis=-2)
-                        all_sample.append(sampled_feature)
-                    return torch.cat(all_sample, dim=1)
-                
-                if self.cfg.vertex_feature:
-                    tensor_vertices = batch['vertices'][0].reshape(1, -1, 3).to(torch.float32)
-                    point_feat = sample_and_mean_memory_save_version(part_planes, tensor_vertices, 1)
-                else:
-                    n_point_per_face = self.cfg.n_point_per_face
-                    tensor_vertices = sample_points(batch['vertices'][0], batch['faces'][0], n_point_per_face)
-                    tensor_vertices = tensor_vertices.reshape(1, -1, 3).to(torch.float32)
-                    point_feat = sample_and_mean_memory_save_version(part_planes, tensor_vertices, n_point_per_face)  # N, M, C
+                n_point_per_face = 1 if self.cfg.vertex_feature else self.cfg.n_point_per_face
+                n_out = batch['vertices'][0].shape[0] if self.cfg.vertex_feature else batch['faces'][0].shape[0]
+
+                # Features are streamed block by block into a memory-mapped file, renamed once complete
+                feat_fname = f'{save_dir}/part_feat_{uid}_{view_id}_batch.npy'
+                point_feat = np.lib.format.open_memmap(feat_fname + '.tmp', mode='w+', dtype=np.float32, shape=(n_out, part_planes.shape[2]))
+                with metrics.timed('face_sampling', uid=uid):
+                    if self.cfg.vertex_feature:
+                        self.stream_vertex_features(part_planes, batch['vertices'][0], point_feat)
+                    else:
+                        self.stream_face_features(part_planes, batch['vertices'][0], batch['faces'][0], n_point_per_face, point_feat)
+                    point_feat.flush()
+                os.replace(feat_fname + '.tmp', feat_fname)
 
                 #### Take mean feature in the triangle
                 print("Time elapsed for feature prediction: " + str(time.time() - starttime))
-                point_feat = point_feat.reshape(-1, 448).cpu().numpy()
-                np.save(f'{save_dir}/part_feat_{uid}_{view_id}_batch.npy', point_feat)
                 print(f"Exported part_feat_{uid}_{view_id}.npy")
 
                 ###########
-                from sklearn.decomposition import PCA
-                data_scaled = point_feat / np.linalg.norm(point_feat, axis=-1, keepdims=True)
-
-                pca = PCA(n_components=3)
-
-                data_reduced = pca.fit_transform(data_scaled)
-                data_reduced = (data_reduced - data_reduced.min()) / (data_reduced.max() - data_reduced.min())
-                colors_255 = (data_reduced * 255).astype(np.uint8)
+                with metrics.timed('pca', uid=uid):
+                    colors_255 = pca_colors(point_feat, seed=self.cfg.seed)
+                del point_feat
                 V = batch['vertices'][0].cpu().numpy()
                 F = batch['faces'][0].cpu().numpy()
-                if self.cfg.vertex_feature:
-                    colored_mesh = trimesh.Trimesh(vertices=V, faces=F, vertex_colors=colors_255, process=False)
-                else:
-                    colored_mesh = trimesh.Trimesh(vertices=V, faces=F, face_colors=colors_255, process=False)
-                colored_mesh.export(f'{save_dir}/feat_pca_{uid}_{view_id}.ply')
+                with metrics.timed('export', uid=uid):
+                    if self.cfg.vertex_feature:
+                        colored_mesh = trimesh.Trimesh(vertices=V, faces=F, vertex_colors=colors_255, process=False)
+                    else:
+                        colored_mesh = trimesh.Trimesh(vertices=V, faces=F, face_colors=colors_255, process=False)
+                    colored_mesh.export(f'{save_dir}/feat_pca_{uid}_{view_id}.ply')
+                print(f"Saved PLY file: {save_dir}/feat_pca_{uid}_{view_id}.ply")
                 ############
                 torch.cuda.empty_cache()
 
@@ -276,8 +400,11 @@ class Model(pl.LightningModule):
 
                 colored_mesh = trimesh.Trimesh(vertices=V, faces=F, face_colors=colors_255, process=False)
                 colored_mesh.export(f'{save_dir}/feat_pca_{uid}_{view_id}.ply')
+                print(f"Saved PLY file: {save_dir}/feat_pca_{uid}_{view_id}.ply")
                 ############
 
+        release_uid(claim_dir, uid)
+        metrics.record_memory('inference', uid=uid)
         print("Time elapsed: " + str(time.time()-starttime))
             
         return 
\ No newline at end of file
@@ -0,0 +1,110 @@
+#########################
+## Memory budget planner for feature extraction
+#########################
+# Rough peak model of one mesh through partfield_inference.py and run_part_clustering.py. The
+# constants are upper estimates for the demo config (pc_num_pts 100000, 16-mixed precision);
+# compare them with partfield_job_peak_device_bytes / partfield_job_peak_rss_bytes of the metrics
+# endpoint when the model or the hardware changes.
+FEATURE_DIM = 448
+# Model weights, encoder activations and the CUDA context
+DEVICE_BASE_BYTES = 4 * 2 ** 30
+# Per sampled point of a block: the three grid_sample outputs, their sum and the fp32 copy, with headroom
+DEVICE_BYTES_PER_POINT_CHANNEL = 6 * 4
+# Interpreter, torch, Lightning and the checkpoint in the inference process
+HOST_BASE_BYTES = 3 * 2 ** 30
+# Feature matrices alive at once while clustering: loaded, L2-normalized and the KMeans / ward working copy
+HOST_FEATURE_COPIES = 3
+# Rows fit and transformed at once by pca_colors (model_trainer_pvcnn_only_demo.py)
+PCA_FIT_ROWS = 200000
+PCA_BLOCK_ROWS = 1000000
+
+MIN_POINT_PER_FACE = 100
+# Blocks above this many points are not faster, they only hold more memory
+MAX_SAMPLE_EACH = 500000
+
+
+def estimate_device_bytes(n_point_per_face, n_sample_each, vertex_feature=False, feat_dim=FEATURE_DIM):
+    """
+    Peak device memory of the feature extraction of one shape. Faces are queried in blocks of
+    n_sample_each // n_point_per_face faces (at least one face), vertices in blocks of n_sample_each.
+    """
+    if vertex_feature:
+        block_points = n_sample_each
+    else:
+        block_points = max(1, n_sample_each // n_point_per_face) * n_point_per_face
+    return DEVICE_BASE_BYTES + block_points * feat_dim * DEVICE_BYTES_PER_POINT_CHANNEL
+
+
+def estimate_host_bytes(num_faces, num_vertices, vertex_feature=False, feat_dim=FEATURE_DIM):
+    """
+    Peak host memory of one shape: the larger of the inference process (PCA of the features)
+    and the clustering process (the feature matrix and its copies).
+    """
+    n_out = num_vertices if vertex_feature else num_faces
+    row_bytes = feat_dim * 4
+    mesh_bytes = num_vertices * 3 * 8 + num_faces * 3 * 8
+    pca = (min(n_out, PCA_FIT_ROWS) + 3 * min(n_out, PCA_BLOCK_ROWS)) * row_bytes
+    inference = HOST_BASE_BYTES + mesh_bytes + pca
+    clustering = mesh_bytes + HOST_FEATURE_COPIES * n_out * row_bytes
+    return max(inference, clustering)
+
+
+def plan_sampling(num_faces, num_vertices, n_point_per_face, device_budget, host_budget, vertex_feature=False,
+                  feat_dim=FEATURE_DIM, min_point_per_face=MIN_POINT_PER_FACE, max_sample_each=MAX_SAMPLE_EACH):
+    """
+    Choose the sampling parameters of a mesh so that its estimated peaks fit the budgets.
+
+    Face features are kept while the clustering copies fit the host budget, vertex features
+    (one query per vertex) are used otherwise. n_point_per_face is kept as requested unless one
+    face does not fit on the device, then it is lowered down to min_point_per_face before
+    switching to vertex features. n_sample_each, which only sets the block size, is the largest
+    that fits the device budget.
+
+    Parameters:
+        num_faces (int), num_vertices (int): Size of the mesh, the largest one for a batch.
+        n_point_per_face (int): Requested points per face, the upper bound of the plan.
+        device_budget (int), host_budget (int): Budgets in bytes.
+        vertex_feature (bool): Use vertex features whatever the budgets, e.g. for previews.
+
+    Returns:
+        dict: {'n_point_per_face', 'n_sample_each', 'vertex_feature', 'estimated_device_mb',
+        'estimated_host_mb', 'fits', 'notes'}. 'fits' is False when even the smallest plan
+        exceeds a budget.
+    """
+    notes = []
+    if not vertex_feature and estimate_host_bytes(num_faces, num_vertices, False, feat_dim) > host_budget and num_vertices < num_faces:
+        vertex_feature = True
+        notes.append("face features exceed the host budget, using vertex features")
+
+    # Points of one block that fit next to the model on the device
+    point_bytes = feat_dim * DEVICE_BYTES_PER_POINT_CHANNEL
+    block_points = max(0, (device_budget - DEVICE_BASE_BYTES) // point_bytes)
+
+    if not vertex_feature and block_points < n_point_per_face:
+        if block_points >= min_point_per_face:
+            notes.append(f"n_point_per_face lowered from {n_point_per_face} to {block_points} to fit the device budget")
+            n_point_per_face = int(block_points)
+        else:
+            vertex_feature = True
+            notes.append("one face block exceeds the device budget, using vertex features")
+
+    point_per_face = 1 if vertex_feature else n_point_per_face
+    n_sample_each = int(min(max(block_points, point_per_face), max_sample_each))
+    # Whole faces per block
+    n_sample_each -= n_sample_each % point_per_face
+
+    device = estimate_device_bytes(point_per_face, n_sample_each, vertex_feature, feat_dim)
+    host = estimate_host_bytes(num_faces, num_vertices, vertex_feature, feat_dim)
+    fits = device <= device_budget and host <= host_budget
+    if not fits:
+        notes.append("the smallest plan still exceeds the " + ("device" if device > device_budget else "host") + " budget")
+
+    return {
+        'n_point_per_face': n_point_per_face,
+        'n_sample_each': n_sample_each,
+        'vertex_feature': vertex_feature,
+        'estimated_device_mb': round(device / 2 ** 20),
+        'estimated_host_mb': round(host / 2 ** 20),
+        'fits': fits,
+        'notes': notes,
+    }
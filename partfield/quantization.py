@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+
+from partfield.model.PVCNN.pv_module import SharedMLP
+
+#########################
+## Dynamic int8 quantization for CPU inference
+#########################
+QUANTIZE_MODES = ['', 'dynamic_int8']
+
+
+class PointwiseLinear(nn.Module):
+    """
+    A 1x1 Conv1d of SharedMLP expressed as a Linear over the channel dimension, which
+    dynamic quantization supports (it does not quantize convolutions).
+    """
+    def __init__(self, conv):
+        super().__init__()
+        assert conv.kernel_size == (1,) and conv.groups == 1
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None,
+                                device=conv.weight.device, dtype=conv.weight.dtype)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight[:, :, 0])
+            if conv.bias is not None:
+                self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        # x: [B, C, N]
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def quantize_dynamic_int8(model):
+    """
+    Apply PyTorch dynamic int8 quantization (int8 weights, activations quantized on the fly)
+    in place to the CPU-heavy layers of a loaded Model: the Linear layers of the
+    TriplaneTransformer blocks and of its mlp head, and the 1x1 convs of every SharedMLP
+    of the PVCNN encoder. The attention projections and all other convolutions stay fp32.
+
+    Must run after the weights are loaded, and the model must run on the CPU.
+
+    Parameters:
+        model (Model): Model with pvcnn and triplane_transformer.
+
+    Returns:
+        Model: the same model.
+    """
+    model.cpu()
+    for module in model.pvcnn.modules():
+        if isinstance(module, SharedMLP):
+            for i, layer in enumerate(module.layers):
+                if isinstance(layer, nn.Conv1d):
+                    module.layers[i] = PointwiseLinear(layer)
+
+    # nn.MultiheadAttention.out_proj is a NonDynamicallyQuantizableLinear and is left as is
+    torch.ao.quantization.quantize_dynamic(model.pvcnn, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    torch.ao.quantization.quantize_dynamic(model.triplane_transformer, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
@@ -0,0 +1,149 @@
+import numpy as np
+import torch
+
+#########################
+## Surface sampling shared by the dataloaders and predict
+#########################
+def face_areas(vertices, faces):
+    """
+    Compute the area of every triangle of a mesh.
+
+    Parameters:
+        vertices (np.ndarray): Vertex array of shape (V, 3).
+        faces (np.ndarray): Triangle index array of shape (F, 3).
+
+    Returns:
+        np.ndarray: Face areas of shape (F,).
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces)
+    v0 = vertices[faces[:, 0]]
+    e1 = vertices[faces[:, 1]] - v0
+    e2 = vertices[faces[:, 2]] - v0
+    return 0.5 * np.linalg.norm(np.cross(e1, e2), axis=1)
+
+
+def sample_surface(vertices, faces, n_points, seed=0, stratified=False):
+    """
+    Area-weighted uniform sampling of a triangle mesh surface.
+
+    Faces are picked by binary search (searchsorted) in the cumulative face area,
+    and points are placed with the square-root barycentric warp. The result only
+    depends on the mesh and the seed.
+
+    With stratified=True, the cumulative area is sampled with one jittered sample
+    per stratum (every face receives its expected number of points up to +-1) and
+    the barycentric coordinates are Latin-hypercube samples. This covers the
+    surface more evenly than i.i.d. sampling for the same number of points.
+
+    Parameters:
+        vertices (np.ndarray): Vertex array of shape (V, 3).
+        faces (np.ndarray): Triangle index array of shape (F, 3).
+        n_points (int): Number of points to sample.
+        seed (int): Seed of the random generator.
+        stratified (bool): Use stratified instead of i.i.d. sampling.
+
+    Returns:
+        tuple: (points, face_index) of shapes (n_points, 3) and (n_points,).
+    """
+    rng = np.random.default_rng(seed)
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces)
+
+    area = face_areas(vertices, faces)
+    cdf = np.cumsum(area)
+    total = cdf[-1]
+    if not total > 0:
+        # Fully degenerate mesh, fall back to picking faces uniformly
+        cdf = np.arange(1, len(faces) + 1, dtype=np.float64)
+        total = cdf[-1]
+
+    if stratified:
+        r = (np.arange(n_points) + rng.random(n_points)) * (total / n_points)
+        u = (rng.permutation(n_points) + rng.random(n_points)) / n_points
+        v = (rng.permutation(n_points) + rng.random(n_points)) / n_points
+    else:
+        r = rng.random(n_points) * total
+        u = rng.random(n_points)
+        v = rng.random(n_points)
+
+    face_index = np.searchsorted(cdf, r, side='right')
+    face_index = np.minimum(face_index, len(faces) - 1)
+
+    # borrowed from Kaolin https://github.com/NVIDIAGameWorks/kaolin/blob/master/kaolin/ops/mesh/trianglemesh.py#L43
+    u = np.sqrt(u)[:, None]
+    v = v[:, None]
+    w0 = 1 - u
+    w1 = u * (1 - v)
+    w2 = u * v
+
+    tri = faces[face_index]
+    points = w0 * vertices[tri[:, 0]] + w1 * vertices[tri[:, 1]] + w2 * vertices[tri[:, 2]]
+    return points, face_index
+
+
+def sample_face_barycentrics(n_f, n_point_per_face, generator=None, stratified=False, device=None, dtype=torch.float32):
+    """
+    Draw the (u, v) unit-square samples used by sample_points_on_faces.
+
+    Returns:
+        tuple: (u, v), each of shape (n_f, n_point_per_face, 1).
+    """
+    shape = (n_f, n_point_per_face, 1)
+    if stratified:
+        strata = torch.arange(n_point_per_face, device=device, dtype=dtype).reshape(1, -1, 1)
+        perm = torch.argsort(torch.rand(shape, generator=generator, device=device), dim=1).to(dtype)
+        u = (perm + torch.rand(shape, generator=generator, device=device, dtype=dtype)) / n_point_per_face
+        v = (strata + torch.rand(shape, generator=generator, device=device, dtype=dtype)) / n_point_per_face
+    else:
+        u = torch.rand(shape, generator=generator, device=device, dtype=dtype)
+        v = torch.rand(shape, generator=generator, device=device, dtype=dtype)
+    return u, v
+
+
+def sample_points_on_faces(vertices, faces, n_point_per_face, generator=None, stratified=False):
+    """
+    Sample a fixed number of points inside every face (torch, runs on the device of vertices).
+
+    Parameters:
+        vertices (torch.Tensor): Vertex tensor of shape (V, 3).
+        faces (torch.Tensor): Triangle index tensor of shape (F, 3).
+        n_point_per_face (int): Number of points per face.
+        generator (torch.Generator): Optional seeded generator living on the same device as vertices.
+        stratified (bool): Latin-hypercube barycentrics instead of i.i.d. ones.
+
+    Returns:
+        torch.Tensor: Points of shape (F, n_point_per_face, 3).
+    """
+    face_v_0 = torch.index_select(vertices, 0, faces[:, 0].reshape(-1))
+    face_v_1 = torch.index_select(vertices, 0, faces[:, 1].reshape(-1))
+    face_v_2 = torch.index_select(vertices, 0, faces[:, 2].reshape(-1))
+    triangles = torch.stack([face_v_0, face_v_1, face_v_2], dim=1)
+    return sample_points_on_triangles(triangles, n_point_per_face, generator=generator, stratified=stratified)
+
+
+def sample_points_on_triangles(triangles, n_point_per_face, generator=None, stratified=False):
+    """
+    Same as sample_points_on_faces for triangles given by their corners, shape (F, 3, 3).
+    """
+    n_f = triangles.shape[0]
+    u, v = sample_face_barycentrics(n_f, n_point_per_face, generator=generator, stratified=stratified,
+                                    device=triangles.device, dtype=triangles.dtype)
+
+    # borrowed from Kaolin https://github.com/NVIDIAGameWorks/kaolin/blob/master/kaolin/ops/mesh/trianglemesh.py#L43
+    u = torch.sqrt(u)
+    w0 = 1 - u
+    w1 = u * (1 - v)
+    w2 = u * v
+
+    points = w0 * triangles[:, 0:1] + w1 * triangles[:, 1:2] + w2 * triangles[:, 2:3]
+    return points
+
+
+def make_generator(seed, device):
+    """
+    Create a torch.Generator on the given device seeded with seed.
+    """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
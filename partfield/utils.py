@@ -1,5 +1,13 @@
+import os
+import queue
+import re
+import socket
+import threading
+import time
 import trimesh
 import numpy as np
+import psutil
+from plyfile import PlyData
 
 def load_mesh_util(input_fname):
     mesh = trimesh.load(input_fname, force='mesh', process=False)
@@ -27,4 +35,357 @@ def extract_uv_data(mesh):
         if uv.shape[0] > 0:
             return np.array(uv), 'per-vertex'
 
-    return None, None
\ No newline at end of file
+    return None, None
+
+#########################
+## Input discovery, shared by the datasets and the clustering scripts
+#########################
+MESH_EXTENSIONS = (".obj", ".glb", ".off")
+PC_EXTENSIONS = (".ply",)
+
+def discover_files(data_path, extensions):
+    """
+    Recursively list the files under data_path with one of the given extensions.
+
+    Parameters:
+        data_path (str): Root folder.
+        extensions (tuple): Lower-case extensions to keep, e.g. (".obj", ".glb").
+
+    Returns:
+        list: Paths relative to data_path, sorted so that every process sees the same order.
+    """
+    selected = []
+    for root, dirs, files in os.walk(data_path, followlinks=True):
+        dirs.sort()
+        for f in files:
+            if os.path.splitext(f)[1].lower() in extensions:
+                selected.append(os.path.relpath(os.path.join(root, f), data_path))
+    return sorted(selected)
+
+
+def file_uid(rel_path):
+    """
+    Uid of an input file from its path relative to the input folder (discover_files): the
+    path without extension, nested folders joined with "_". Output files are named after it.
+    """
+    return rel_path.split(".")[-2].replace("/", "_")
+
+
+def clustered_uids(folder):
+    """
+    Uids with clustering outputs in folder, named {uid}_{view_id}_{num_clusters}.{ext}.
+    """
+    uids = set()
+    for name in os.listdir(folder):
+        match = re.match(r"(.+)_\d+_\d+\.\w+$", name)
+        if match:
+            uids.add(match.group(1))
+    return uids
+
+#########################
+## PLY point cloud / splat reading
+#########################
+_PLY_DTYPES = {
+    'char': 'i1', 'int8': 'i1',
+    'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2',
+    'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4',
+    'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4',
+    'double': 'f8', 'float64': 'f8',
+}
+
+
+def read_ply_header(filename):
+    """
+    Parse the header of a PLY file.
+
+    Parameters:
+        filename (str): Path to the PLY file.
+
+    Returns:
+        dict: {'format': str, 'header_size': int, 'elements': [(name, count, [(prop_name, prop_type or None for lists)])]}
+    """
+    elements = []
+    fmt = None
+    with open(filename, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError(f"Not a PLY file: {filename}")
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"Truncated PLY header: {filename}")
+            tokens = line.decode('ascii', errors='replace').split()
+            if not tokens or tokens[0] in ('comment', 'obj_info'):
+                continue
+            if tokens[0] == 'format':
+                fmt = tokens[1]
+            elif tokens[0] == 'element':
+                elements.append((tokens[1], int(tokens[2]), []))
+            elif tokens[0] == 'property':
+                if tokens[1] == 'list':
+                    elements[-1][2].append((tokens[-1], None))
+                else:
+                    elements[-1][2].append((tokens[2], tokens[1]))
+            elif tokens[0] == 'end_header':
+                break
+        header_size = f.tell()
+    return {'format': fmt, 'header_size': header_size, 'elements': elements}
+
+
+def mesh_size(filename):
+    """
+    Number of faces and vertices of a mesh file, without loading the mesh where the format
+    allows it: PLY and OFF headers (polygons count as one face), a line scan of OBJ files
+    (polygons count as their triangles). Other formats (GLB) are loaded.
+
+    Parameters:
+        filename (str): Path to the mesh file.
+
+    Returns:
+        (int, int): Number of faces and of vertices.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.ply':
+        counts = {name: count for name, count, _ in read_ply_header(filename)['elements']}
+        return counts.get('face', 0), counts.get('vertex', 0)
+    if ext == '.off':
+        with open(filename, 'rb') as f:
+            tokens = []
+            for line in f:
+                tokens += line.split(b'#')[0].split()
+                # Header keyword (OFF, COFF, ...), then the vertex and face counts
+                if len(tokens) >= 3 and not tokens[0].endswith(b'OFF'):
+                    return int(tokens[1]), int(tokens[0])
+                if len(tokens) >= 4:
+                    return int(tokens[2]), int(tokens[1])
+        raise ValueError(f"Truncated OFF header: {filename}")
+    if ext == '.obj':
+        num_faces, num_vertices = 0, 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                if line.startswith(b'v '):
+                    num_vertices += 1
+                elif line.startswith(b'f '):
+                    num_faces += len(line.split()) - 3
+        return num_faces, num_vertices
+    mesh = load_mesh_util(filename)
+    return len(mesh.faces), len(mesh.vertices)
+
+
+def load_ply_vertex_columns(filename, properties=('x', 'y', 'z')):
+    """
+    Read vertex properties of a PLY file as 1D arrays.
+
+    For binary PLYs the vertex block is memory-mapped with a structured dtype and the
+    returned arrays are column views into the file, so only the requested columns are
+    ever paged in (Gaussian-splat PLYs carry dozens of properties per vertex). ASCII PLYs
+    and layouts that cannot be mapped (list properties before/in the vertex element)
+    fall back to plyfile.
+
+    Parameters:
+        filename (str): Path to the PLY file.
+        properties (tuple): Names of the vertex properties to return.
+
+    Returns:
+        dict: property name -> numpy.ndarray of shape (N,).
+    """
+    header = read_ply_header(filename)
+    endian = {'binary_little_endian': '<', 'binary_big_endian': '>'}.get(header['format'])
+
+    offset = header['header_size']
+    vertex_dtype = None
+    if endian is not None:
+        for name, count, props in header['elements']:
+            if any(t is None for _, t in props):
+                break
+            dtype = np.dtype([(p, endian + _PLY_DTYPES[t]) for p, t in props])
+            if name == 'vertex':
+                vertex_dtype = dtype
+                n_vertices = count
+                break
+            offset += dtype.itemsize * count
+
+    if vertex_dtype is None:
+        vertex_data = PlyData.read(filename)["vertex"]
+        return {p: np.asarray(vertex_data[p]) for p in properties}
+
+    vertices = np.memmap(filename, dtype=vertex_dtype, mode='r', offset=offset, shape=(n_vertices,))
+    return {p: vertices[p] for p in properties}
+
+
+def load_ply_to_numpy(filename):
+    """
+    Load a PLY file and extract the point cloud as a (N, 3) NumPy array.
+
+    Parameters:
+        filename (str): Path to the PLY file.
+
+    Returns:
+        numpy.ndarray: Point cloud array of shape (N, 3).
+    """
+    columns = load_ply_vertex_columns(filename, ('x', 'y', 'z'))
+    points = np.stack([columns["x"], columns["y"], columns["z"]], axis=-1)
+    return points.astype(points.dtype.newbyteorder('='), copy=False)
+
+
+#########################
+## Per-uid claim files for sharded runs
+#########################
+def claim_owner():
+    """
+    Owner name of the claims of this process: host and pid, independent of how the input
+    files are sharded, so that a run restarted with another layout can tell dead claims.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_is_stale(owner, age, timeout=0):
+    """
+    Whether a claim held by owner (claim_owner) and age seconds old can be taken over: its
+    process is gone (same host), or it is older than timeout seconds (0 never times out).
+    Claims of other hosts, and of older runs named otherwise, can only time out.
+    """
+    host, _, pid = owner.rpartition(":")
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return timeout > 0 and age > timeout
+
+
+def claim_uid(claim_dir, uid, owner, timeout=0):
+    """
+    Atomically claim uid for owner by creating claim_dir/uid.claim.
+
+    A claim left behind by the same owner is taken over, and so is a stale claim (see
+    claim_is_stale), e.g. of a crashed process or of a run restarted with another number of
+    shards or ranks; a claim held by a live owner is respected.
+
+    Returns:
+        bool: True if the caller owns the claim.
+    """
+    os.makedirs(claim_dir, exist_ok=True)
+    claim_file = os.path.join(claim_dir, f"{uid}.claim")
+    if create_claim(claim_file, owner):
+        return True
+
+    try:
+        with open(claim_file, "r") as f:
+            current = f.read().strip()
+        age = time.time() - os.path.getmtime(claim_file)
+    except OSError:
+        # Released meanwhile
+        return create_claim(claim_file, owner)
+    if current == owner:
+        return True
+    if not claim_is_stale(current, age, timeout):
+        return False
+
+    # Move the stale claim aside: only one of the processes taking it over succeeds
+    stale_file = f"{claim_file}.{owner}.stale"
+    try:
+        os.rename(claim_file, stale_file)
+    except FileNotFoundError:
+        return False
+    with open(stale_file, "r") as f:
+        taken = f.read().strip()
+    if taken != current:
+        # A fresh claim replaced the stale one after it was read, give it back
+        try:
+            os.link(stale_file, claim_file)
+        except FileExistsError:
+            pass
+        os.remove(stale_file)
+        return False
+    os.remove(stale_file)
+    print(f"Taking over the stale claim of {uid} held by {current}")
+    return create_claim(claim_file, owner)
+
+
+def create_claim(claim_file, owner):
+    """
+    Create claim_file for owner if it does not exist (O_EXCL), returns whether it was created.
+    """
+    try:
+        fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(owner)
+    return True
+
+
+def release_uid(claim_dir, uid):
+    """
+    Remove the claim file of uid once its outputs are written.
+    """
+    try:
+        os.remove(os.path.join(claim_dir, f"{uid}.claim"))
+    except FileNotFoundError:
+        pass
+
+
+#########################
+## Background writer for side-effect outputs
+#########################
+class AsyncWriter:
+    """
+    Run write jobs on a background thread fed by a bounded queue.
+
+    submit() blocks once max_pending jobs are waiting, which bounds the memory held by
+    pending outputs. close() waits for every job and re-raises the first error.
+    """
+    def __init__(self, max_pending=8):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            fn, args, kwargs = job
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"AsyncWriter: {fn.__name__} failed: {e}")
+                if self.error is None:
+                    self.error = e
+
+    def submit(self, fn, *args, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((fn, args, kwargs))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def export_input_mesh(save_dir, uid, view_id, vertices, faces, uv_coords=None, uv_type=None):
+    """
+    Write the preprocessed input mesh (and its UV data if any) read back by the clustering scripts.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+    mesh.export(f'{save_dir}/input_{uid}_{view_id}.ply')
+
+    if uv_coords is not None:
+        np.savez(f'{save_dir}/input_uv_{uid}_{view_id}.npz',
+                 uv_coords=uv_coords, uv_type=uv_type)
+
+
+def resident_memory_mb():
+    """
+    Resident set size of the current process in MB.
+    """
+    return psutil.Process().memory_info().rss / 2**20
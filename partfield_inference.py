@@ -1,4 +1,5 @@
 from partfield.config import default_argument_parser, setup
+from partfield.quantization import QUANTIZE_MODES
 from lightning.pytorch import seed_everything, Trainer
 from lightning.pytorch.strategies import DDPStrategy
 from lightning.pytorch.callbacks import ModelCheckpoint
@@ -27,19 +28,29 @@ def predict(cfg):
         verbose=True
     )]
 
-    trainer = Trainer(devices=-1,
-                      accelerator="gpu",
-                      precision="16-mixed",
-                      strategy=DDPStrategy(find_unused_parameters=True),
+    if cfg.quantize not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantize mode '{cfg.quantize}', must be one of {QUANTIZE_MODES}")
+    if cfg.quantize == 'dynamic_int8':
+        # Dynamically quantized modules only run on the CPU, in fp32
+        device_kwargs = dict(devices=1, accelerator="cpu", precision="32-true", strategy="auto")
+    else:
+        device_kwargs = dict(devices=-1, accelerator="gpu", precision="16-mixed", strategy=DDPStrategy(find_unused_parameters=True))
+
+    trainer = Trainer(**device_kwargs,
                       max_epochs=cfg.training_epochs,
                       log_every_n_steps=1,
                       limit_train_batches=3500,
                       limit_val_batches=None,
+                      use_distributed_sampler=False,  # the dataset shards itself across ranks
                       callbacks=checkpoint_callbacks
                      )
 
     from partfield.model_trainer_pvcnn_only_demo import Model
-    model = Model(cfg)        
+    from partfield.utils import resident_memory_mb
+    rss_before = resident_memory_mb()
+    model = Model(cfg)
+    print(f"Resident memory before / after building the model: {rss_before:.0f} MB / {resident_memory_mb():.0f} MB"
+          f"{' (inference only)' if cfg.inference_only else ''}")
 
     if cfg.remesh_demo:
         cfg.n_point_per_face = 10
@@ -48,8 +59,14 @@ def predict(cfg):
         
 def main():
     parser = default_argument_parser()
+    parser.add_argument("--shard_index", type=int, default=None, help="index of the shard of the input files handled by this process")
+    parser.add_argument("--num_shards", type=int, default=None, help="number of processes splitting the input files")
     args = parser.parse_args()
     cfg = setup(args, freeze=False)
+    if args.shard_index is not None:
+        cfg.dataset.shard_index = args.shard_index
+    if args.num_shards is not None:
+        cfg.dataset.num_shards = args.num_shards
     predict(cfg)
     
 if __name__ == '__main__':
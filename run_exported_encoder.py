@@ -0,0 +1,36 @@
+from partfield.export import ExportedEncoder, prepare_points
+import argparse
+import numpy as np
+import trimesh
+import time
+import os
+
+#########################
+## Runs an exported encoder (export_encoder.py) on the CPU, without Lightning or the model code
+#########################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--artifact', default="model/partfield_encoder.onnx", type=str, help=".onnx or TorchScript .pt")
+    parser.add_argument('--input', required=True, type=str, nargs='+', help="meshes or point clouds (.ply)")
+    parser.add_argument('--output_dir', default="exp_results/exported_planes", type=str)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--num_threads', default=0, type=int)
+    args = parser.parse_args()
+
+    encoder = ExportedEncoder(args.artifact, num_threads=args.num_threads)
+    print(f"Loaded {args.artifact} in {encoder.load_time:.2f}s ({encoder.n_points} points)")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for fname in args.input:
+        geometry = trimesh.load(fname)
+        if isinstance(geometry, trimesh.Scene):
+            geometry = geometry.dump(concatenate=True)
+        faces = geometry.faces if isinstance(geometry, trimesh.Trimesh) else None
+        points = prepare_points(geometry.vertices, faces, n_points=encoder.n_points, seed=args.seed)
+
+        start = time.perf_counter()
+        part_planes = encoder(points)
+        uid = os.path.splitext(os.path.basename(fname))[0]
+        # Same planes as part_planes in Model.predict_step, query them with sample_triplane_feat
+        np.save(os.path.join(args.output_dir, f"part_planes_{uid}.npy"), part_planes)
+        print(f"{uid}: {part_planes.shape} in {time.perf_counter() - start:.2f}s")
@@ -12,6 +12,7 @@ from os.path import join
 from typing import List
 
 from collections import defaultdict
+from functools import lru_cache
 from scipy.sparse import coo_matrix, csr_matrix
 from scipy.sparse.csgraph import connected_components
 from sklearn.neighbors import NearestNeighbors
@@ -20,8 +21,19 @@ import networkx as nx
 from plyfile import PlyData
 import open3d as o3d
 from partfield.utils import *
+from partfield import metrics
 
 #### Export to file #####
+def label_palette(labels):
+    """
+    Index of every label among the sorted unique labels, and the tab20 RGBA color (floats in [0, 1])
+    of each unique label.
+    """
+    unique_labels, inverse = np.unique(np.squeeze(labels), return_inverse=True)
+    colormap = plt.get_cmap("tab20", len(unique_labels))
+    return inverse.reshape(-1), colormap(np.arange(len(unique_labels)))
+
+
 def export_colored_mesh_ply(V, F, FL, filename='segmented_mesh.ply'):
     """
     Export a mesh with per-face segmentation labels into a colored PLY file.
@@ -37,20 +49,11 @@ def export_colored_mesh_ply(V, F, FL, filename='segmented_mesh.ply'):
     assert F.shape[0] == FL.shape[0]
 
     # Generate distinct colors for each unique label
-    unique_labels = np.unique(FL)
-    colormap = plt.cm.get_cmap("tab20", len(unique_labels))
-    label_to_color = {
-        label: (np.array(colormap(i)[:3]) * 255).astype(np.uint8)
-        for i, label in enumerate(unique_labels)
-    }
+    inverse, colors = label_palette(FL)
+    colors = (colors[:, :3] * 255).astype(np.uint8)
 
     mesh = trimesh.Trimesh(vertices=V, faces=F)
-    FL = np.squeeze(FL)
-    for i, face in enumerate(F):
-        label = FL[i]
-        color = label_to_color[label]
-        color_with_alpha = np.append(color, 255)  # Add alpha value
-        mesh.visual.face_colors[i] = color_with_alpha
+    mesh.visual.face_colors = np.concatenate([colors[inverse], np.full((len(F), 1), 255, dtype=np.uint8)], axis=1)
 
     mesh.export(filename)
     print(f"Exported mesh to {filename}")
@@ -72,27 +75,17 @@ def export_colored_mesh_obj_with_uv(V, F, FL, uv_coords, filename='segmented_mes
     assert F.shape[0] == FL.shape[0]
 
     # Generate distinct colors for each unique label
-    unique_labels = np.unique(FL)
-    colormap = plt.cm.get_cmap("tab20", len(unique_labels))
-    label_to_color = {
-        label: (np.array(colormap(i)[:3]) * 255).astype(np.uint8)
-        for i, label in enumerate(unique_labels)
-    }
+    inverse, colors = label_palette(FL)
+    colors = (colors[:, :3] * 255).astype(np.uint8)
+    face_colors = np.concatenate([colors[inverse], np.full((len(F), 1), 255, dtype=np.uint8)], axis=1)
 
     # Build vertex colors from face labels (average for shared vertices)
-    vertex_colors = np.zeros((V.shape[0], 4), dtype=np.uint8)
-    vertex_counts = np.zeros(V.shape[0], dtype=np.int32)
-    FL_squeezed = np.squeeze(FL)
-    for i, face in enumerate(F):
-        label = FL_squeezed[i]
-        color = label_to_color[label]
-        color_with_alpha = np.append(color, 255)
-        for v_idx in face:
-            vertex_colors[v_idx] = vertex_colors[v_idx] + color_with_alpha
-            vertex_counts[v_idx] += 1
+    vertex_colors = np.zeros((V.shape[0], 4), dtype=np.int64)
+    vertex_counts = np.bincount(np.asarray(F).reshape(-1), minlength=V.shape[0])
+    np.add.at(vertex_colors, np.asarray(F).reshape(-1), np.repeat(face_colors, F.shape[1], axis=0))
     # Average colors for vertices shared by multiple faces
     vertex_counts[vertex_counts == 0] = 1  # Avoid division by zero
-    vertex_colors = (vertex_colors.T / vertex_counts).T.astype(np.uint8)
+    vertex_colors = (vertex_colors // vertex_counts[:, None]).astype(np.uint8)
 
     # Create mesh with UV texture
     if uv_coords is not None and len(uv_coords) == len(V):
@@ -102,12 +95,7 @@ def export_colored_mesh_obj_with_uv(V, F, FL, uv_coords, filename='segmented_mes
         mesh.visual.vertex_colors = vertex_colors
     else:
         mesh = trimesh.Trimesh(vertices=V, faces=F)
-        FL_squeezed = np.squeeze(FL)
-        for i, face in enumerate(F):
-            label = FL_squeezed[i]
-            color = label_to_color[label]
-            color_with_alpha = np.append(color, 255)
-            mesh.visual.face_colors[i] = color_with_alpha
+        mesh.visual.face_colors = face_colors
 
     mesh.export(filename)
     print(f"Exported mesh with UV to {filename}")
@@ -123,16 +111,9 @@ def export_pointcloud_with_labels_to_ply(V, VL, filename='colored_pointcloud.ply
     """
     assert V.shape[0] == VL.shape[0], "Number of vertices and labels must match"
 
-    # Generate unique colors for each label
-    unique_labels = np.unique(VL)
-    colormap = plt.cm.get_cmap("tab20", len(unique_labels))
-    label_to_color = {
-        label: colormap(i)[:3] for i, label in enumerate(unique_labels)
-    }
-
-    VL = np.squeeze(VL)
-    # Map labels to RGB colors
-    colors = np.array([label_to_color[label] for label in VL])
+    # Generate unique colors for each label and map labels to RGB colors
+    inverse, colors = label_palette(VL)
+    colors = colors[inverse, :3]
     
     # Open3D requires colors in float [0, 1]
     pcd = o3d.geometry.PointCloud()
@@ -629,6 +610,39 @@ def construct_face_adjacency_matrix_naive(face_list):
 
     return face_adjacency
 
+def construct_vertex_adjacency_matrix(face_list, num_vertices):
+    """
+    Vertex adjacency of the mesh edges, shape (num_vertices, num_vertices), used to cluster
+    vertex features. Connected components (isolated vertices included) are chained by dummy
+    edges, as in construct_face_adjacency_matrix_naive.
+    """
+    faces = np.asarray(face_list, dtype=np.int64)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edges = np.concatenate([edges, edges[:, ::-1]])
+    vertex_adjacency = coo_matrix(
+        (np.ones(len(edges), dtype=np.int8), (edges[:, 0], edges[:, 1])),
+        shape=(num_vertices, num_vertices)
+    ).tocsr()
+    vertex_adjacency.data[:] = 1
+
+    n_components, labels = connected_components(vertex_adjacency, directed=False)
+    if n_components > 1:
+        # First vertex of every component, linked to the next one
+        _, representatives = np.unique(labels, return_index=True)
+        row = np.concatenate([representatives[:-1], representatives[1:]])
+        col = np.concatenate([representatives[1:], representatives[:-1]])
+        dummy_mat = coo_matrix((np.ones(len(row), dtype=np.int8), (row, col)), shape=(num_vertices, num_vertices)).tocsr()
+        vertex_adjacency = vertex_adjacency + dummy_mat
+
+    return vertex_adjacency
+
+def face_labels_from_vertices(vertex_labels, faces):
+    """
+    Label of every face from the labels of its corners: the majority, the first corner if all differ.
+    """
+    corners = np.asarray(vertex_labels).reshape(-1)[np.asarray(faces)]
+    return np.where(corners[:, 1] == corners[:, 2], corners[:, 1], corners[:, 0])
+
 class UnionFind:
     def __init__(self, n):
         self.parent = list(range(n))
@@ -672,28 +686,124 @@ def hierarchical_clustering_labels(children, n_samples, max_cluster=20):
     
     return hierarchical_labels
 
-def load_ply_to_numpy(filename):
+def iter_clustering_levels(point_feat, vertices=None, faces=None, use_agglo=False, max_num_clusters=18, option=1, with_knn=True, splat_index=None, num_clusters=None, vertex_feature=False, fit_samples=None):
     """
-    Load a PLY file and extract the point cloud as a (N, 3) NumPy array.
+    Cluster PartField features in memory, one level (number of clusters) at a time.
 
     Parameters:
-        filename (str): Path to the PLY file.
+    - point_feat (np.ndarray): (N, C) features, one per face of the mesh or per point
+    - vertices (np.ndarray), faces (np.ndarray): Mesh arrays, used by agglomerative clustering and vertex features
+    - use_agglo, max_num_clusters, option, with_knn: As in solve_clustering
+    - splat_index (np.ndarray): Pruned splat inputs, index of the kept point of every splat
+    - num_clusters (list): KMeans only, the levels to compute, 2 to max_num_clusters - 1 by default
+    - vertex_feature (bool): point_feat has one row per mesh vertex: vertices are clustered (agglomerative
+      clustering over the mesh edges) and every face takes the majority label of its corners
+    - fit_samples (int): KMeans only, fit on at most that many rows drawn at random (seed 0), then
+      assign every row to its nearest center
+
+    Yields:
+    - (int, np.ndarray): Number of clusters and the labels of the level, as saved in cluster_out.
+      KMeans levels come in increasing order, agglomerative ones coarsest first.
+    """
+    point_feat = point_feat / np.linalg.norm(point_feat, axis=-1, keepdims=True)
+
+    if not use_agglo:
+        fit_feat = point_feat
+        if fit_samples is not None and point_feat.shape[0] > fit_samples:
+            fit_feat = point_feat[np.sort(np.random.default_rng(0).choice(point_feat.shape[0], fit_samples, replace=False))]
+
+        for num_cluster in (num_clusters if num_clusters is not None else range(2, max_num_clusters)):
+            with metrics.timed('clustering', num_clusters=num_cluster):
+                clustering = KMeans(n_clusters=num_cluster, random_state=0).fit(fit_feat)
+                labels = clustering.labels_ if fit_feat is point_feat else clustering.predict(point_feat)
+            if vertex_feature and faces is not None:
+                labels = face_labels_from_vertices(labels, faces)
+
+            pred_labels = np.zeros((len(labels), 1))
+            for i, label in enumerate(np.unique(labels)):
+                # print(i, label)
+                pred_labels[labels == label] = i  # Assign RGB values to each label
+
+            ### Pruned splat inputs: features exist for the kept splats, labels are mapped back to every splat
+            if splat_index is not None:
+                pred_labels = pred_labels[splat_index]
+
+            yield num_cluster, pred_labels
+
+    else:
+        assert faces is not None, "Agglomerative clustering only for mesh inputs."
+
+        with metrics.timed('adjacency', option=option):
+            if vertex_feature:
+                adj_matrix = construct_vertex_adjacency_matrix(faces, point_feat.shape[0])
+            elif option == 0:
+                adj_matrix = construct_face_adjacency_matrix_naive(faces)
+            elif option == 1:
+                adj_matrix = construct_face_adjacency_matrix_facemst(faces, vertices, with_knn=with_knn)
+            else:
+                adj_matrix = construct_face_adjacency_matrix_ccmst(faces, vertices, with_knn=with_knn)
+
+        with metrics.timed('clustering', num_clusters=max_num_clusters):
+            clustering = AgglomerativeClustering(connectivity=adj_matrix,
+                                        n_clusters=1,
+                                        ).fit(point_feat)
+            hierarchical_labels = hierarchical_clustering_labels(clustering.children_, point_feat.shape[0], max_cluster=max_num_clusters)
+
+        all_FL = []
+        for n_cluster in range(max_num_clusters):
+            print("Processing cluster: "+str(n_cluster))
+            labels = hierarchical_labels[n_cluster]
+            if vertex_feature:
+                labels = face_labels_from_vertices(labels, faces)
+            all_FL.append(labels)
+
+        all_FL = np.array(all_FL)
+
+        # Coarsest levels first, so that they are available while the finer ones are exported
+        for n_cluster in reversed(range(max_num_clusters)):
+            yield max_num_clusters - n_cluster, all_FL[n_cluster]
+
+
+def solve_clustering_labels(point_feat, vertices=None, faces=None, use_agglo=False, max_num_clusters=18, option=1, with_knn=True, splat_index=None, num_clusters=None, vertex_feature=False, fit_samples=None):
+    """
+    In-memory entry point of the clustering, see iter_clustering_levels for the arguments.
 
     Returns:
-        numpy.ndarray: Point cloud array of shape (N, 3).
+    - dict: Number of clusters -> labels of the level.
     """
-    # Read PLY file
-    ply_data = PlyData.read(filename)
-    
-    # Extract vertex data
-    vertex_data = ply_data["vertex"]
-    
-    # Convert to NumPy array (x, y, z)
-    points = np.vstack([vertex_data["x"], vertex_data["y"], vertex_data["z"]]).T
-    
-    return points
+    return dict(iter_clustering_levels(point_feat, vertices, faces, use_agglo=use_agglo, max_num_clusters=max_num_clusters,
+                                       option=option, with_knn=with_knn, splat_index=splat_index, num_clusters=num_clusters,
+                                       vertex_feature=vertex_feature, fit_samples=fit_samples))
+
+
+@lru_cache(maxsize=1)
+def load_mesh_arrays(mesh_file):
+    """
+    Vertices and faces of mesh_file, cached for the tasks of the same job that a worker runs
+    one after the other (one KMeans level each). Shared by the callers, not to be modified.
+    """
+    mesh = load_mesh_util(mesh_file)
+    return mesh.vertices, mesh.faces
+
+
+def solve_clustering_files(feature_file, mesh_file=None, splat_index_file=None, **kwargs):
+    """
+    solve_clustering_labels on files, for worker processes: tasks only carry paths, the features
+    are memory-mapped (shared through the page cache by the tasks of a job) and the mesh is
+    loaded in the worker. See iter_clustering_levels for the other arguments.
+
+    Returns:
+    - dict: Number of clusters -> labels of the level.
+    """
+    point_feat = np.load(feature_file, mmap_mode='r')
+    vertices, faces = None, None
+    if mesh_file is not None:
+        vertices, faces = load_mesh_arrays(mesh_file)
+    splat_index = np.load(splat_index_file) if splat_index_file is not None else None
+    return solve_clustering_labels(point_feat, vertices, faces, splat_index=splat_index, **kwargs)
+
 
-def solve_clustering(input_fname, uid, view_id, save_dir="test_results1", out_render_fol= "test_render_clustering", use_agglo=False, max_num_clusters=18, is_pc=False, option=1, with_knn=True, export_mesh=True, output_format='auto'):
+def solve_clustering(input_fname, uid, view_id, save_dir="test_results1", out_render_fol= "test_render_clustering", use_agglo=False, max_num_clusters=18, is_pc=False, option=1, with_knn=True, export_mesh=True, output_format='auto', vertex_feature=False):
     print(uid, view_id)
 
     uv_coords = None
@@ -725,93 +835,45 @@ def solve_clustering(input_fname, uid, view_id, save_dir="test_results1", out_re
             print(f'{save_dir}/part_feat_{uid}_{view_id}_batch.npy')
             return
 
-    point_feat = point_feat / np.linalg.norm(point_feat, axis=-1, keepdims=True)
+    ### Pruned splat inputs: features exist for the kept splats, labels are mapped back to every splat
+    splat_index = None
+    splat_index_file = f'{save_dir}/splat_index_{uid}_{view_id}.npy'
+    if is_pc and os.path.exists(splat_index_file):
+        splat_index = np.load(splat_index_file)
 
-    if not use_agglo:
-        for num_cluster in range(2, max_num_clusters):
-            clustering = KMeans(n_clusters=num_cluster, random_state=0).fit(point_feat)
-            labels = clustering.labels_
+    if use_agglo and is_pc:
+        print("Not implemented error. Agglomerative clustering only for mesh inputs.")
+        exit()
 
-            
-            pred_labels = np.zeros((len(labels), 1))
-            for i, label in enumerate(np.unique(labels)):
-                # print(i, label)
-                pred_labels[labels == label] = i  # Assign RGB values to each label
+    levels = iter_clustering_levels(point_feat, None if is_pc else mesh.vertices, None if is_pc else mesh.faces,
+                                    use_agglo=use_agglo, max_num_clusters=max_num_clusters, option=option,
+                                    with_knn=with_knn, splat_index=splat_index, vertex_feature=vertex_feature and not is_pc)
 
-            fname_clustering = os.path.join(out_render_fol, "cluster_out", str(uid) + "_" + str(view_id) + "_" + str(num_cluster).zfill(2))
-            np.save(fname_clustering, pred_labels)
-            
+    for num_cluster, pred_labels in levels:
+        name = str(uid) + "_" + str(view_id) + "_" + str(num_cluster).zfill(2)
 
-            if not is_pc:
-                V = mesh.vertices
-                F = mesh.faces
-
-                if export_mesh:
+        with metrics.timed('export', uid=uid, num_clusters=num_cluster):
+            if export_mesh:
+                if not is_pc:
                     # Determine output format
                     use_obj = (output_format == 'obj') or (output_format == 'auto' and uv_coords is not None)
                     if use_obj and uv_coords is not None:
-                        fname_mesh = os.path.join(out_render_fol, "ply", str(uid) + "_" + str(view_id) + "_" + str(num_cluster).zfill(2) + ".obj")
-                        export_colored_mesh_obj_with_uv(V, F, pred_labels, uv_coords, filename=fname_mesh)
+                        fname_mesh = os.path.join(out_render_fol, "ply", name + ".obj")
+                        export_colored_mesh_obj_with_uv(mesh.vertices, mesh.faces, pred_labels, uv_coords, filename=fname_mesh)
                     else:
-                        fname_mesh = os.path.join(out_render_fol, "ply", str(uid) + "_" + str(view_id) + "_" + str(num_cluster).zfill(2) + ".ply")
-                        export_colored_mesh_ply(V, F, pred_labels, filename=fname_mesh)
-
-            else:
-                if export_mesh:
-                    fname_pc = os.path.join(out_render_fol, "ply", str(uid) + "_" + str(view_id) + "_" + str(num_cluster).zfill(2) + ".ply")
+                        fname_mesh = os.path.join(out_render_fol, "ply", name + ".ply")
+                        export_colored_mesh_ply(mesh.vertices, mesh.faces, pred_labels, filename=fname_mesh)
+                else:
+                    fname_pc = os.path.join(out_render_fol, "ply", name + ".ply")
                     export_pointcloud_with_labels_to_ply(pc, pred_labels, filename=fname_pc)
-        
-    else:
-        if is_pc:
-            print("Not implemented error. Agglomerative clustering only for mesh inputs.")
-            exit()
-
-        if option == 0:
-            adj_matrix = construct_face_adjacency_matrix_naive(mesh.faces)
-        elif option == 1:
-            adj_matrix = construct_face_adjacency_matrix_facemst(mesh.faces, mesh.vertices, with_knn=with_knn)
-        else:
-            adj_matrix = construct_face_adjacency_matrix_ccmst(mesh.faces, mesh.vertices, with_knn=with_knn)
-
-        clustering = AgglomerativeClustering(connectivity=adj_matrix,
-                                    n_clusters=1,
-                                    ).fit(point_feat)
-        hierarchical_labels = hierarchical_clustering_labels(clustering.children_, point_feat.shape[0], max_cluster=max_num_clusters)
-
-        all_FL = []
-        for n_cluster in range(max_num_clusters):
-            print("Processing cluster: "+str(n_cluster))
-            labels = hierarchical_labels[n_cluster]
-            all_FL.append(labels)
-        
-        
-        all_FL = np.array(all_FL)
-        unique_labels = np.unique(all_FL)
 
-        for n_cluster in range(max_num_clusters):
-            FL = all_FL[n_cluster]
-            relabel = np.zeros((len(FL), 1))
-            for i, label in enumerate(unique_labels):
-                relabel[FL == label] = i  # Assign RGB values to each label
+            fname_clustering = os.path.join(out_render_fol, "cluster_out", name)
+            np.save(fname_clustering, pred_labels)
+        print(f"Saved labels to {fname_clustering}.npy")
 
-            V = mesh.vertices
-            F = mesh.faces
+    metrics.record_memory('clustering', uid=uid)
 
-            if export_mesh:
-                # Determine output format
-                use_obj = (output_format == 'obj') or (output_format == 'auto' and uv_coords is not None)
-                if use_obj and uv_coords is not None:
-                    fname_mesh = os.path.join(out_render_fol, "ply", str(uid) + "_" + str(view_id) + "_" + str(max_num_clusters - n_cluster).zfill(2) + ".obj")
-                    export_colored_mesh_obj_with_uv(V, F, FL, uv_coords, filename=fname_mesh)
-                else:
-                    fname_mesh = os.path.join(out_render_fol, "ply", str(uid) + "_" + str(view_id) + "_" + str(max_num_clusters - n_cluster).zfill(2) + ".ply")
-                    export_colored_mesh_ply(V, F, FL, filename=fname_mesh)
 
-            fname_clustering = os.path.join(out_render_fol, "cluster_out", str(uid) + "_" + str(view_id) + "_" + str(max_num_clusters - n_cluster).zfill(2))
-            np.save(fname_clustering, FL)
-        
-        
-            
 if __name__ == '__main__':
 
     def str2bool(v):
@@ -837,6 +899,8 @@ if __name__ == '__main__':
     parser.add_argument('--export_mesh', default= True, type=str2bool)
     parser.add_argument('--output_format', default='auto', choices=['ply', 'obj', 'auto'],
                         help='Output format: ply, obj, or auto (obj if UV available, ply otherwise)')
+    parser.add_argument('--vertex_feature', default=False, type=str2bool,
+                        help='features were extracted with vertex_feature True (one per vertex)')
 
     FLAGS = parser.parse_args()
     root = FLAGS.root
@@ -864,32 +928,18 @@ if __name__ == '__main__':
         os.makedirs(ply_fol, exist_ok=True)    
 
     #### Get existing model_ids ###
-    all_files = os.listdir(os.path.join(OUTPUT_FOL, "ply"))
-
-    existing_model_ids = []
-    for sample in all_files:
-        uid = sample.split("_")[0]
-        view_id = sample.split("_")[1]
-        # sample_name = str(uid) + "_" + str(view_id)
-        sample_name = str(uid)
-
-        if sample_name not in existing_model_ids:
-            existing_model_ids.append(sample_name)
+    # Outputs are the labels, the meshes are only there with --export_mesh
+    existing_model_ids = clustered_uids(os.path.join(OUTPUT_FOL, "ply" if EXPORT_MESH else "cluster_out"))
     ##############################
 
-    all_files = os.listdir(SOURCE_DIR)
-    selected = []
-    for f in all_files:
-        if ".ply" in f and IS_PC and f.split(".")[0] not in existing_model_ids:
-            selected.append(f)
-        elif (".obj" in f or ".glb" in f) and not IS_PC and f.split(".")[0] not in existing_model_ids:
-            selected.append(f)
+    # Same files and uids as the inference dataset, nested folders included
+    selected = [f for f in discover_files(SOURCE_DIR, PC_EXTENSIONS if IS_PC else MESH_EXTENSIONS) if file_uid(f) not in existing_model_ids]
     
     print("Number of models to process: " + str(len(selected)))
     
     for model in selected:
         fname = os.path.join(SOURCE_DIR, model)
-        uid = model.split(".")[-2]
+        uid = file_uid(model)
         view_id = 0
 
-        solve_clustering(fname, uid, view_id, save_dir=root, out_render_fol= OUTPUT_FOL, use_agglo=USE_AGGLO, max_num_clusters=MAX_NUM_CLUSTERS, is_pc=IS_PC, option=OPTION, with_knn=WITH_KNN, export_mesh=EXPORT_MESH, output_format=OUTPUT_FORMAT)
+        solve_clustering(fname, uid, view_id, save_dir=root, out_render_fol= OUTPUT_FOL, use_agglo=USE_AGGLO, max_num_clusters=MAX_NUM_CLUSTERS, is_pc=IS_PC, option=OPTION, with_knn=WITH_KNN, export_mesh=EXPORT_MESH, output_format=OUTPUT_FORMAT, vertex_feature=FLAGS.vertex_feature)
@@ -409,31 +409,19 @@ if __name__ == '__main__':
     os.makedirs(cluster_fol, exist_ok=True) 
 
     #### Get existing model_ids ###
-    all_files = os.listdir(os.path.join(OUTPUT_FOL, "ply"))
-
-    existing_model_ids = []
-    for sample in all_files:
-        uid = sample.split("_")[0]
-        view_id = sample.split("_")[1]
-        # sample_name = str(uid) + "_" + str(view_id)
-        sample_name = str(uid)
-
-        if sample_name not in existing_model_ids:
-            existing_model_ids.append(sample_name)
+    # Outputs are the labels, the meshes are only there with --export_mesh
+    existing_model_ids = clustered_uids(os.path.join(OUTPUT_FOL, "ply" if EXPORT_MESH else "cluster_out"))
     ##############################
 
-    all_files = os.listdir(SOURCE_DIR)
-    selected = []
-    for f in all_files:
-        if (".obj" in f or ".glb" in f) and f.split(".")[0] not in existing_model_ids:
-            selected.append(f)
+    # Same files and uids as the inference dataset, nested folders included
+    selected = [f for f in discover_files(SOURCE_DIR, (".obj", ".glb")) if file_uid(f) not in existing_model_ids]
     
     print("Number of models to process: " + str(len(selected)))
     
 
     for model in selected:
         fname = os.path.join(SOURCE_DIR, model)
-        uid = model.split(".")[-2]
+        uid = file_uid(model)
         view_id = 0
 
         solve_clustering(fname, uid, view_id, save_dir=root, out_render_fol= OUTPUT_FOL, use_agglo=USE_AGGLO, max_num_clusters=MAX_NUM_CLUSTERS, viz_dense=FLAGS.viz_dense, export_mesh=EXPORT_MESH)
\ No newline at end of file